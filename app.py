@@ -2,12 +2,16 @@ import streamlit as st
 import pandas as pd
 import os
 from data_loader import DataLoader
-from report_gen import ReportGenerator
+from report_gen import ReportGenerator, generate_prep_sheets_zip
+import report_jobs
 from ephy_fetcher import EphyFetcher
 import json
+import time
+import functools
 import tempfile
 from datetime import datetime
 from email_utils import send_email_with_attachment
+import perf
 
 # Page Configuration
 st.set_page_config(
@@ -31,6 +35,53 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --- INSTRUMENTATION (mode debug : ?debug=1 ou secret DEBUG_PERF) ---
+# Hors debug, les appels décorés par perf.timed ne font qu'un test d'attribut.
+DEBUG_PERF = st.query_params.get("debug", "") in ("1", "true") or bool("DEBUG_PERF" in st.secrets and st.secrets["DEBUG_PERF"])
+perf.start_run(DEBUG_PERF)
+if DEBUG_PERF and st.session_state.pop("_profile_next_run", False):
+    perf.start_profile()
+
+# --- QR VALIDATION (route légère) ---
+# Le QR code d'une fiche de préparation ouvre l'app avec ?validate_phyto=<ID>.
+# On traite ce cas avant tout le reste (bandeau, campagnes, formulaires) puis on s'arrête :
+# seul JOURNAL_INTERVENTION est lu, et seulement après affichage du bouton de confirmation.
+def render_qr_validation(intervention_id):
+    st.title("✅ Validation Traitement")
+    st.info(f"🔍 Scan détecté pour l'intervention : {intervention_id}")
+
+    credentials_dict = dict(st.secrets["gcp_service_account"]) if "gcp_service_account" in st.secrets else None
+    qr_loader = DataLoader("dummy_path.xlsx", use_cloud=True, credentials_dict=credentials_dict)
+
+    if st.button("✅ Confirmer : Traitement RÉALISÉ"):
+        with st.spinner("Mise à jour du statut..."):
+            success = qr_loader.load_source() and qr_loader.update_intervention_status(intervention_id, "Réalisé")
+            if success:
+                st.success("Statut mis à jour avec succès ! Vous pouvez fermer.")
+            else:
+                st.error("Échec de la mise à jour (Vérifiez les logs ou la connexion).")
+    elif qr_loader.load_source():
+        # Détail du mélange à valider (lignes 'Prévu' des parcelles / date du QR)
+        df_qr = qr_loader.get_qr_intervention_rows(intervention_id)
+        if df_qr.empty:
+            st.warning("Aucune intervention prévue correspondante (ou déjà réalisée).")
+        else:
+            cols = [c for c in ['Date', 'ID_Parcelle', 'Nom_Produit', 'Dose_Ha', 'Unité_Dose', 'Cible'] if c in df_qr.columns]
+            st.dataframe(df_qr[cols], use_container_width=True, hide_index=True)
+
+    if st.button("🚜 Ouvrir l'application complète"):
+        st.query_params.clear()
+        st.rerun()
+
+# Handle list vs string (Streamlit versions differ)
+qr_intervention_id = st.query_params.get("validate_phyto", None)
+if isinstance(qr_intervention_id, list):
+    qr_intervention_id = qr_intervention_id[0] if qr_intervention_id else None
+
+if qr_intervention_id:
+    render_qr_validation(qr_intervention_id)
+    st.stop()
+
 # --- EN-TÊTE / BANDEAU ---
 base_dir = os.path.dirname(os.path.abspath(__file__))
 logo_path = os.path.join(base_dir, "LOGO.png")
@@ -44,6 +95,25 @@ except Exception as e:
 
 st.title("🚜 Agri Automation")
 
+# --- SECTIONS (fragments) ---
+def section_fragment(name):
+    """
+    Section indépendante (st.fragment) : une interaction dans la section ne réexécute qu'elle.
+    Durée de la dernière exécution conservée dans st.session_state["_section_timings"].
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                st.session_state.setdefault("_section_timings", {})[name] = duration
+                perf.record("Section", name, duration)
+        return st.fragment(timed)
+    return decorator
+
 # --- CONFIG ---
 # URL de l'application pour le QR Code
 APP_BASE_URL = "https://agri-automation-app-kwz7hjkyb8hjxwhe9w7rsv.streamlit.app"
@@ -72,23 +142,9 @@ if not active_loader:
     st.stop()
 
 # --- Campaigns ---
+# Calculées une fois par version de JOURNAL_INTERVENTION / RELEVES_COMPTEURS (cache DataLoader)
 try:
-    df_intervention = active_loader.get_interventions()
-    df_releves = active_loader.get_releves_compteurs()
-    
-    years = set()
-    
-    # Years from Interventions
-    if not df_intervention.empty:
-        df_intervention['Campagne'] = pd.to_numeric(df_intervention['Campagne'], errors='coerce').fillna(0).astype(int)
-        years.update(df_intervention[df_intervention['Campagne'] > 0]['Campagne'].unique())
-    
-    # Years from Irrigation Readings
-    if not df_releves.empty:
-        df_releves['Date_Relevé'] = pd.to_datetime(df_releves['Date_Relevé'], errors='coerce', dayfirst=True)
-        years.update(df_releves['Date_Relevé'].dt.year.dropna().unique())
-        
-    available_campaigns = sorted([int(y) for y in years], reverse=True)
+    available_campaigns = active_loader.get_campaigns()
     
     if not available_campaigns:
         st.warning("Aucune donnée (intervention ou relevé) trouvée.")
@@ -102,948 +158,869 @@ except Exception as e:
 selected_campaign = st.selectbox("📅 Choisir la Campagne", available_campaigns)
 
 # Backend filtering logic
-df_campaign = df_intervention[df_intervention['Campagne'].astype(str) == str(selected_campaign)]
+df_intervention = active_loader.get_interventions()
+df_campaign = active_loader.get_campaign_interventions(selected_campaign)
 available_parcelles = sorted(df_campaign['ID_Parcelle'].unique())
 
 # --- Saisie Rapide Groupée ---
-import string
-import random
-
-def generate_intervention_id():
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+def build_treatment_rows(parcelles_data, produits_data, campagne, date_interv, statut, type_interv,
+                         tracteur, outil, volume_bouillie, stade, observations):
+    """
+    Lignes JOURNAL_INTERVENTION d'une saisie groupée : produit cartésien parcelles × produits en une
+    seule opération, quantités/volumes calculés par colonne, IDs uniques (8 car.) générés en lot.
+    """
+    rows = pd.DataFrame(parcelles_data, columns=['id', 'culture', 'surface']).merge(
+        pd.DataFrame(produits_data, columns=['nom', 'cible', 'dose', 'unite']), how='cross')
+    surface = rows['surface'].astype(float)
+    unite = rows['unite'].astype(str)
+
+    return pd.DataFrame({
+        'ID_Intervention': DataLoader.new_intervention_ids(len(rows)),
+        'ID_Parcelle': rows['id'],
+        'Campagne': campagne,
+        'Date': date_interv.strftime('%d/%m/%Y'),
+        'Statut_Intervention': statut,
+        'Nature_Intervention': 'Traitement',
+        'Type_Intervention': type_interv,
+        'Culture': rows['culture'],
+        'Surface_Travaillée_Ha': surface,
+        'Tracteur': tracteur,
+        'Outil': outil if outil != "- Aucun -" else "",
+        'Nom_Produit': rows['nom'],
+        'Cible': rows['cible'].fillna(''),   # 🆕 Cible depuis REF_USAGES_PHYTO
+        'Num_AMM': '', # Auto-rempli si N_AMM dans REF_INTRANTS
+        'Dose_Ha': rows['dose'],
+        'Unité_Dose': rows['unite'],
+        'Quantité_Totale_Produit': (rows['dose'].astype(float) * surface).round(2),
+        'Unité_Quantité': unite.str.replace('/ha', '', regex=False).str.replace('/Ha', '', regex=False),
+        'Volume_Bouillie_L_Ha': volume_bouillie,
+        'Volume_Total_Bouillie_L': (volume_bouillie * surface).round(2),
+        'Stade_Culture': stade,
+        'BBCH': '',
+        'Observations': observations
+    })
 
 st.divider()
-st.subheader("✍️ Saisie Rapide : Traitement Phyto (Multi-Parcelles)")
-with st.expander("Ouvrir le formulaire de saisie groupée", expanded=False):
-    st.markdown("##### 1. Informations Générales")
-    col_g1, col_g2, col_g3 = st.columns(3)
-    with col_g1:
-        date_interv = st.date_input("Date de l'intervention")
-    with col_g2:
-        statut = st.selectbox("Statut", ["Prévu", "Réalisé"])
-    with col_g3:
-         # Default to selected campaign
-        campagne_saisie = st.number_input("Campagne", value=int(selected_campaign), format="%d")
-        
-    col_m1, col_m2, col_m3 = st.columns(3)
-    with col_m1:
-        type_interv = st.selectbox("Type d'intervention", ["Herbicide", "Fongicide", "Insecticide"])
-    with col_m2:
-        tracteur = st.selectbox("Tracteur", ["130_CVX", "220_CVX", "Berthoud_Raptor", "Axial_5140"])
-    with col_m3:
-        outil = st.selectbox("Outil", ["- Aucun -", "Agata", "Ependeur_Engrais", "DDI", "Rotative", "Cultivateur_Bonnel", "Bineuse", "Fissurateur", "Rabe"])
-        
-    stade = st.selectbox("Stade Culture", ["Pré-levée", "Levée", "2F", "4-6F", "8-10F", "12F", "Floraison", "Tallage", "Epis 1cm", "Montaison"])
-    volume_bouillie = st.number_input("Volume Bouillie (L/ha)", min_value=0.0, value=100.0, step=10.0)
-    observations = st.text_input("Observations")
-
-    st.markdown("##### 2. Choix des Parcelles")
-    selected_p_for_entry = st.multiselect("Parcelles concernées", available_parcelles)
-    
-    # Affichage dynamique des surfaces
-    parcelles_data = [] # List of dicts: {'id': ..., 'culture': ..., 'surface': ...}
-    if selected_p_for_entry:
-        st.markdown("*Surfaces travaillées (Ajustables)*")
-        metadata = active_loader.get_parcel_metadata(campagne_saisie)
-        cols = st.columns(len(selected_p_for_entry) if len(selected_p_for_entry) < 4 else 4)
-        for i, p_id in enumerate(selected_p_for_entry):
-            p_meta = metadata.get(p_id, {})
-            culture_ref = p_meta.get('Culture', 'Inconnue')
-            try:
-                surf_ref = float(str(p_meta.get('Surface', 0.0)).replace(',', '.'))
-            except:
-                surf_ref = 0.0
-                
-            with cols[i % 4]:
-                 surf_input = st.number_input(f"{p_id} ({culture_ref})", value=surf_ref, step=0.5, key=f"surf_input_{p_id}")
-                 parcelles_data.append({'id': p_id, 'culture': culture_ref, 'surface': float(surf_input)})
-
-    st.markdown("##### 3. Choix des Produits")
-    # Try to get referentiel, fallback to text input if fails
-    liste_produits = []
-    try:
-         df_intrants = active_loader._get_data("REF_INTRANTS")
-         if not df_intrants.empty and 'Nom_Produit' in df_intrants.columns:
-             liste_produits = sorted(df_intrants['Nom_Produit'].dropna().unique().tolist())
-         else:
-             st.warning("⚠️ L'onglet 'REF_INTRANTS' est vide ou la colonne 'Nom_Produit' est introuvable.")
-         
-         if not liste_produits:
-              liste_produits = ["(Saisir manuellement)"]
-    except Exception as e:
-         st.error(f"❌ Impossible de charger 'REF_INTRANTS' : {e}")
-         liste_produits = ["(Saisir manuellement)"]
+@section_fragment("Saisie Rapide")
+def render_saisie_rapide(selected_campaign, available_parcelles):
+    st.subheader("✍️ Saisie Rapide : Traitement Phyto (Multi-Parcelles)")
+    with st.expander("Ouvrir le formulaire de saisie groupée", expanded=False):
+        st.markdown("##### 1. Informations Générales")
+        col_g1, col_g2, col_g3 = st.columns(3)
+        with col_g1:
+            date_interv = st.date_input("Date de l'intervention")
+        with col_g2:
+            statut = st.selectbox("Statut", ["Prévu", "Réalisé"])
+        with col_g3:
+             # Default to selected campaign
+            campagne_saisie = st.number_input("Campagne", value=int(selected_campaign), format="%d")
+
+        col_m1, col_m2, col_m3 = st.columns(3)
+        with col_m1:
+            type_interv = st.selectbox("Type d'intervention", ["Herbicide", "Fongicide", "Insecticide"])
+        with col_m2:
+            tracteur = st.selectbox("Tracteur", ["130_CVX", "220_CVX", "Berthoud_Raptor", "Axial_5140"])
+        with col_m3:
+            outil = st.selectbox("Outil", ["- Aucun -", "Agata", "Ependeur_Engrais", "DDI", "Rotative", "Cultivateur_Bonnel", "Bineuse", "Fissurateur", "Rabe"])
+
+        stade = st.selectbox("Stade Culture", ["Pré-levée", "Levée", "2F", "4-6F", "8-10F", "12F", "Floraison", "Tallage", "Epis 1cm", "Montaison"])
+        volume_bouillie = st.number_input("Volume Bouillie (L/ha)", min_value=0.0, value=100.0, step=10.0)
+        observations = st.text_input("Observations")
+
+        st.markdown("##### 2. Choix des Parcelles")
+        selected_p_for_entry = st.multiselect("Parcelles concernées", available_parcelles)
+
+        # Affichage dynamique des surfaces
+        parcelles_data = [] # List of dicts: {'id': ..., 'culture': ..., 'surface': ...}
+        if selected_p_for_entry:
+            st.markdown("*Surfaces travaillées (Ajustables)*")
+            metadata = active_loader.get_parcel_metadata(campagne_saisie)
+            cols = st.columns(len(selected_p_for_entry) if len(selected_p_for_entry) < 4 else 4)
+            for i, p_id in enumerate(selected_p_for_entry):
+                p_meta = metadata.get(p_id, {})
+                culture_ref = p_meta.get('Culture', 'Inconnue')
+                try:
+                    surf_ref = float(str(p_meta.get('Surface', 0.0)).replace(',', '.'))
+                except:
+                    surf_ref = 0.0
+
+                with cols[i % 4]:
+                     surf_input = st.number_input(f"{p_id} ({culture_ref})", value=surf_ref, step=0.5, key=f"surf_input_{p_id}")
+                     parcelles_data.append({'id': p_id, 'culture': culture_ref, 'surface': float(surf_input)})
+
+        st.markdown("##### 3. Choix des Produits")
+        # Try to get referentiel, fallback to text input if fails
+        liste_produits = []
+        try:
+             df_intrants = active_loader._get_data("REF_INTRANTS")
+             if not df_intrants.empty and 'Nom_Produit' in df_intrants.columns:
+                 liste_produits = sorted(df_intrants['Nom_Produit'].dropna().unique().tolist())
+             else:
+                 st.warning("⚠️ L'onglet 'REF_INTRANTS' est vide ou la colonne 'Nom_Produit' est introuvable.")
+
+             if not liste_produits:
+                  liste_produits = ["(Saisir manuellement)"]
+        except Exception as e:
+             st.error(f"❌ Impossible de charger 'REF_INTRANTS' : {e}")
+             liste_produits = ["(Saisir manuellement)"]
+
+        # Charger les usages E-Phy pour auto-fill dose / cible (index dict construit une fois par version de l'onglet)
+        try:
+            usages_index = active_loader.get_usages_index()
+        except Exception:
+            usages_index = {"cibles": {}, "doses": {}}
+
+        def get_cibles_for_product(nom_produit):
+            """Retourne la liste des cibles autorisées pour un produit depuis REF_USAGES_PHYTO."""
+            return usages_index["cibles"].get(str(nom_produit).upper(), [])
+
+        def get_dose_for_cible(nom_produit, cible):
+            """Retourne la dose max + unité pour un couple produit/cible."""
+            return usages_index["doses"].get((str(nom_produit).upper(), str(cible)), (None, None))
+
+        # We hardcode up to 5 products for simplicity.
+        produits_data = []
+        for i in range(1, 6): # Allow up to 5 products at once
+            c1, c2, c3, c4 = st.columns([2, 1.5, 1, 1])
+            with c1:
+                prod = st.selectbox(f"Produit {i}", ["- Aucun -"] + liste_produits, key=f"prod_name_{i}")
+
+            # Dropdown cible (depuis REF_USAGES_PHYTO) si produit sélectionné
+            cible_val = ""
+            if prod != "- Aucun -":
+                cibles_dispo = get_cibles_for_product(prod)
+                with c2:
+                    if cibles_dispo:
+                        cible_val = st.selectbox(f"Cible {i}", [""] + cibles_dispo, key=f"prod_cible_{i}")
+                    else:
+                        cible_val = st.text_input(f"Cible {i}", key=f"prod_cible_txt_{i}", placeholder="Saisir la cible")
+                # Auto-fill dose depuis REF_USAGES_PHYTO
+                auto_dose, auto_unite = get_dose_for_cible(prod, cible_val) if cible_val else (None, None)
+            else:
+                with c2:
+                    st.text_input(f"Cible {i}", key=f"prod_cible_empty_{i}", disabled=True)
+                auto_dose, auto_unite = None, None
+
+            with c3:
+                dose_default = float(auto_dose) if auto_dose else 0.0
+                dose = st.number_input(f"Dose/ha", min_value=0.0, step=0.1, value=dose_default, key=f"prod_dose_{i}")
+            with c4:
+                unite_options = ["L/ha", "Kg/ha", "g/ha"]
+                unite_idx = unite_options.index(auto_unite) if auto_unite in unite_options else 0
+                unite = st.selectbox("Unité", unite_options, index=unite_idx, key=f"prod_unite_{i}")
+            if prod != "- Aucun -":
+                produits_data.append({'nom': prod, 'cible': cible_val, 'dose': dose, 'unite': unite})
+
+        st.markdown("<br>", unsafe_allow_html=True)
+        submitted = st.button("Enregistrer les interventions 🚀")
+
+        if submitted:
+            if not selected_p_for_entry:
+                 st.error("Veuillez sélectionner au moins une parcelle.")
+            elif not produits_data:
+                 st.error("Veuillez ajouter au moins un produit.")
+            else:
+                 # Construire le DataFrame à insérer (parcelles × produits)
+                 df_new = build_treatment_rows(
+                      parcelles_data, produits_data, campagne_saisie, date_interv, statut, type_interv,
+                      tracteur, outil, volume_bouillie, stade, observations
+                 )
+
+                 with st.spinner(f"Insertion de {len(df_new)} ligne(s) dans le journal..."):
+                      success = active_loader.bulk_insert_interventions(df_new)
+                      if success:
+                           st.success("✅ Interventions enregistrées avec succès ! (Rechargez la page pour la mise à jour des rapports)")
+                      else:
+                           st.error("❌ Échec de l'insertion.")
+
+render_saisie_rapide(selected_campaign, available_parcelles)
 
-    # Charger les usages E-Phy pour auto-fill dose / cible
+# --- FICHE PREPARATION PHYTO ---
+@section_fragment("Fiche de Préparation")
+def render_fiche_preparation(selected_campaign):
+    st.subheader("🧪 Fiche de Préparation Phyto")
     try:
-        df_usages_ref = active_loader.get_usages_phyto()
-    except Exception:
-        df_usages_ref = pd.DataFrame()
-
-    def get_cibles_for_product(nom_produit):
-        """Retourne la liste des cibles autorisées pour un produit depuis REF_USAGES_PHYTO."""
-        if df_usages_ref.empty or 'Nom_Produit' not in df_usages_ref.columns:
-            return []
-        sub = df_usages_ref[df_usages_ref['Nom_Produit'].astype(str).str.upper() == str(nom_produit).upper()]
-        if sub.empty:
-            return []
-        cibles = sub['Cible'].dropna().unique().tolist()
-        return sorted([str(c) for c in cibles if str(c).strip()])
-
-    def get_dose_for_cible(nom_produit, cible):
-        """Retourne la dose max + unité pour un couple produit/cible."""
-        if df_usages_ref.empty:
-            return None, None
-        sub = df_usages_ref[
-            (df_usages_ref['Nom_Produit'].astype(str).str.upper() == str(nom_produit).upper()) &
-            (df_usages_ref['Cible'].astype(str) == str(cible))
-        ]
-        if sub.empty:
-            return None, None
-        dose = pd.to_numeric(sub['Dose_Max'].iloc[0], errors='coerce')
-        unite = sub['Unite_Dose'].iloc[0] if 'Unite_Dose' in sub.columns else None
-        return (float(dose) if not pd.isna(dose) else None), unite
-         
-    # We hardcode up to 5 products for simplicity.
-    produits_data = []
-    for i in range(1, 6): # Allow up to 5 products at once
-        c1, c2, c3, c4 = st.columns([2, 1.5, 1, 1])
-        with c1:
-            prod = st.selectbox(f"Produit {i}", ["- Aucun -"] + liste_produits, key=f"prod_name_{i}")
-        
-        # Dropdown cible (depuis REF_USAGES_PHYTO) si produit sélectionné
-        cible_val = ""
-        if prod != "- Aucun -":
-            cibles_dispo = get_cibles_for_product(prod)
-            with c2:
-                if cibles_dispo:
-                    cible_val = st.selectbox(f"Cible {i}", [""] + cibles_dispo, key=f"prod_cible_{i}")
+        # Mélanges prévus (groupés par date + signature produits/doses), mis en cache par version du journal
+        mix_map = loader.get_planned_mixes(selected_campaign)
+
+        if mix_map:
+            mix_options = list(mix_map)
+
+            col_p1, col_p2 = st.columns([2, 1])
+            with col_p1:
+                selected_mix_lbl = st.selectbox("Choisir l'intervention prévue :", mix_options)
+            with col_p2:
+                pass
+
+            if st.button("Générer Fiche Préparation"):
+                # Prepare Data
+                mix = mix_map[selected_mix_lbl]
+                payload = loader.prep_sheet_payload(mix)
+                intervention_id = payload['Intervention_ID']
+
+                if payload['Volume_Bouillie_Ha'] == 0:
+                    st.warning("⚠️ Attention : Volume Bouillie / ha non renseigné.")
+
+                # Generate
+                with tempfile.TemporaryDirectory() as tmpdirname:
+                    fname = f"Fiche_Prep_{intervention_id}.pdf"
+                    fpath = os.path.join(tmpdirname, fname)
+
+                    gen = ReportGenerator(fpath)
+                    gen.generate_prep_sheet(selected_campaign, payload, base_url=APP_BASE_URL)
+
+                    with open(fpath, "rb") as f:
+                       st.download_button(
+                           label="⬇️ Télécharger Fiche",
+                           data=f,
+                           file_name=fname,
+                           mime="application/pdf"
+                       )
+                st.success("Fiche générée ! Vérifiez l'ordre d'incorporation.")
+
+            # --- Lot : toutes les fiches d'une période (journées de pulvérisation chargées) ---
+            with st.expander("📚 Fiches de Préparation en lot (période)"):
+                planned_dates = [m['Date'] for m in mix_map.values() if pd.notnull(m['Date'])]
+                if not planned_dates:
+                    st.info("Aucun mélange prévu avec une date valide.")
                 else:
-                    cible_val = st.text_input(f"Cible {i}", key=f"prod_cible_txt_{i}", placeholder="Saisir la cible")
-            # Auto-fill dose depuis REF_USAGES_PHYTO
-            auto_dose, auto_unite = get_dose_for_cible(prod, cible_val) if cible_val else (None, None)
+                    today = datetime.now().date()
+                    default_day = min((d.date() for d in planned_dates if d.date() >= today), default=max(planned_dates).date())
+
+                    col_b1, col_b2 = st.columns([2, 1])
+                    with col_b1:
+                        date_range = st.date_input("Période", value=(default_day, default_day), key="prep_batch_range")
+                    with col_b2:
+                        batch_format = st.radio("Format", ["PDF unique", "ZIP (1 PDF / mélange)"], key="prep_batch_format")
+
+                    if not isinstance(date_range, (list, tuple)):
+                        date_range = (date_range,)
+                    start_day, end_day = (date_range[0], date_range[-1]) if date_range else (default_day, default_day)
+
+                    batch = sorted(
+                        (m for m in mix_map.values() if pd.notnull(m['Date']) and start_day <= m['Date'].date() <= end_day),
+                        key=lambda m: (m['Date'], str(m['Parcelles'][0]['name']))
+                    )
+                    st.caption(f"{len(batch)} mélange(s) prévu(s) du {start_day:%d/%m/%Y} au {end_day:%d/%m/%Y}.")
+
+                    if batch and st.button("Générer les Fiches du lot", key="btn_prep_batch"):
+                        # Produits triés par rang de formulation (référentiel REF_INTRANTS chargé une fois pour tout le lot)
+                        payloads = [loader.prep_sheet_payload(m) for m in batch]
+                        fname_base = f"Fiches_Prep_{start_day:%Y%m%d}_{end_day:%Y%m%d}"
+
+                        with st.spinner(f"Génération de {len(payloads)} fiches..."):
+                            if batch_format.startswith("ZIP"):
+                                batch_data = generate_prep_sheets_zip(selected_campaign, payloads, base_url=APP_BASE_URL)
+                                batch_fname, batch_mime = f"{fname_base}.zip", "application/zip"
+                            else:
+                                with tempfile.TemporaryDirectory() as tmpdirname:
+                                    fpath = os.path.join(tmpdirname, f"{fname_base}.pdf")
+                                    ReportGenerator(fpath).generate_prep_sheets(selected_campaign, payloads, base_url=APP_BASE_URL)
+                                    with open(fpath, "rb") as f:
+                                        batch_data = f.read()
+                                batch_fname, batch_mime = f"{fname_base}.pdf", "application/pdf"
+
+                        st.download_button(
+                            label=f"⬇️ Télécharger les {len(payloads)} fiches",
+                            data=batch_data,
+                            file_name=batch_fname,
+                            mime=batch_mime,
+                            key="dl_prep_batch"
+                        )
+                        vol_missing = sum(1 for p in payloads if p['Volume_Bouillie_Ha'] == 0)
+                        if vol_missing:
+                            st.warning(f"⚠️ Volume Bouillie / ha non renseigné pour {vol_missing} mélange(s).")
+
         else:
-            with c2:
-                st.text_input(f"Cible {i}", key=f"prod_cible_empty_{i}", disabled=True)
-            auto_dose, auto_unite = None, None
-
-        with c3:
-            dose_default = float(auto_dose) if auto_dose else 0.0
-            dose = st.number_input(f"Dose/ha", min_value=0.0, step=0.1, value=dose_default, key=f"prod_dose_{i}")
-        with c4:
-            unite_options = ["L/ha", "Kg/ha", "g/ha"]
-            unite_idx = unite_options.index(auto_unite) if auto_unite in unite_options else 0
-            unite = st.selectbox("Unité", unite_options, index=unite_idx, key=f"prod_unite_{i}")
-        if prod != "- Aucun -":
-            produits_data.append({'nom': prod, 'cible': cible_val, 'dose': dose, 'unite': unite})
+            st.info("Pas d'interventions planifiées trouvées pour cette campagne.")
+    except Exception as e:
+        st.error(f"Erreur chargement planning: {e}")
 
-    st.markdown("<br>", unsafe_allow_html=True)
-    submitted = st.button("Enregistrer les interventions 🚀")
-    
-    if submitted:
-        if not selected_p_for_entry:
-             st.error("Veuillez sélectionner au moins une parcelle.")
-        elif not produits_data:
-             st.error("Veuillez ajouter au moins un produit.")
+render_fiche_preparation(selected_campaign)
+
+st.divider()
+
+# --- CONFORMITÉ RÉGLEMENTAIRE (Journal vs usages homologués) ---
+@st.cache_resource(show_spinner=False)
+def get_ephy_fetcher():
+    """Référentiel E-Phy chargé une fois par process (tables Arrow mappées en mémoire)."""
+    return EphyFetcher(auto_refresh=True)
+
+@section_fragment("Conformité")
+def render_conformite(selected_campaign):
+    st.subheader("🛡️ Conformité Réglementaire des Traitements")
+    # E-Phy : état des AMM (retraits) et usages absents de REF_USAGES_PHYTO
+    fetcher = None
+    try:
+        fetcher = get_ephy_fetcher()
+        fetcher.sync()
+    except Exception as e_init:
+        st.caption(f"⚠️ E-Phy indisponible, contrôle limité à REF_INTRANTS / REF_USAGES_PHYTO : {e_init}")
+    try:
+        df_alertes = active_loader.check_compliance(selected_campaign, ephy_fetcher=fetcher)
+        if df_alertes.empty:
+            st.success(f"✅ Aucune non-conformité détectée sur la campagne {selected_campaign} (dose, nb d'applications, AMM, DAR).")
         else:
-             # Construire le DataFrame à insérer
-             rows_to_insert = []
-             for p in parcelles_data:
-                  for prod in produits_data:
-                       # Calculs auto
-                       qty_totale = prod['dose'] * p['surface']
-                       vol_c_total = volume_bouillie * p['surface']
-                       
-                       # Generate 8 char alphanumeric ID
-                       uid = generate_intervention_id()
-                       
-                       row = {
-                            'ID_Intervention': uid,
-                            'ID_Parcelle': p['id'],
-                            'Campagne': campagne_saisie,
-                            'Date': date_interv.strftime('%d/%m/%Y'),
-                            'Statut_Intervention': statut,
-                            'Nature_Intervention': 'Traitement',
-                            'Type_Intervention': type_interv,
-                            'Culture': p['culture'],
-                            'Surface_Travaillée_Ha': p['surface'],
-                            'Tracteur': tracteur,
-                            'Outil': outil if outil != "- Aucun -" else "",
-                            'Nom_Produit': prod['nom'],
-                            'Cible': prod.get('cible', ''),   # 🆕 Cible depuis REF_USAGES_PHYTO
-                            'Num_AMM': '', # Auto-rempli si N_AMM dans REF_INTRANTS
-                            'Dose_Ha': prod['dose'],
-                            'Unité_Dose': prod['unite'],
-                            'Quantité_Totale_Produit': round(qty_totale, 2),
-                            'Unité_Quantité': str(prod['unite']).replace('/ha', '').replace('/Ha', ''),
-                            'Volume_Bouillie_L_Ha': volume_bouillie,
-                            'Volume_Total_Bouillie_L': round(vol_c_total, 2),
-                            'Stade_Culture': stade,
-                            'BBCH': '',
-                            'Observations': observations
-                       }
-                       rows_to_insert.append(row)
-             
-             df_new = pd.DataFrame(rows_to_insert)
-             
-             with st.spinner(f"Insertion de {len(df_new)} ligne(s) dans le journal..."):
-                  success = active_loader.bulk_insert_interventions(df_new)
-                  if success:
-                       st.success("✅ Interventions enregistrées avec succès ! (Rechargez la page pour la mise à jour des rapports)")
-                  else:
-                       st.error("❌ Échec de l'insertion.")
-
-# --- QR Action Logic (Must be at top generally, but works here in stream) ---
-
-# Check for 'validate_phyto' in query params
-q_params = st.query_params
-val_param = q_params.get("validate_phyto", None)
+            counts = df_alertes["Controle"].value_counts()
+            st.warning(f"⚠️ {len(df_alertes)} alerte(s) : " + ", ".join(f"{k} ({v})" for k, v in counts.items()))
+            st.dataframe(
+                df_alertes.assign(Date=df_alertes["Date"].dt.strftime("%d/%m/%Y")),
+                use_container_width=True, hide_index=True,
+            )
+    except Exception as e:
+        st.error(f"Erreur contrôle de conformité : {e}")
 
-# Handle list vs string (Streamlit versions differ)
-intervention_id = None
-if val_param:
-    if isinstance(val_param, list):
-        intervention_id = val_param[0]
-    else:
-        intervention_id = val_param
+render_conformite(selected_campaign)
 
-if intervention_id:
-    st.info(f"🔍 Scan détecté pour l'intervention : {intervention_id}")
-    
-    if st.button("✅ Confirmer : Traitement RÉALISÉ"):
-        with st.spinner("Mise à jour du statut..."):
-            success = loader.update_intervention_status(intervention_id, "Réalisé")
-            if success:
-                st.success("Statut mis à jour avec succès ! Vous pouvez fermer.")
-                # Clear param to avoid re-trigger on reload? 
-                # st.experimental_set_query_params() # Deprecated/removed in new Streamlit
-                # Just show success message.
+st.divider()
+
+# --- Rapports : travaux en arrière-plan ---
+@st.cache_resource(show_spinner=False)
+def get_report_queue():
+    """File de génération de rapports partagée par toutes les sessions du process."""
+    return report_jobs.ReportJobQueue()
+
+def report_job_ids():
+    """IDs des travaux de la session, conservés dans l'URL (?report_jobs=id1,id2)."""
+    return [j for j in st.query_params.get("report_jobs", "").split(",") if j]
+
+def render_report_jobs():
+    queue = get_report_queue()
+    jobs = [job for job in map(queue.status, report_job_ids()) if job]
+    if [job["id"] for job in jobs] != report_job_ids():
+        # Travaux expirés / inconnus retirés de l'URL
+        st.query_params["report_jobs"] = ",".join(job["id"] for job in jobs)
+    if not jobs:
+        return
+
+    active = any(job["status"] in (report_jobs.PENDING, report_jobs.RUNNING) for job in jobs)
+
+    # Rafraîchi toutes les 2 s tant qu'un travail tourne ; rerun complet à la fin pour arrêter le minuteur
+    @st.fragment(run_every=2 if active else None)
+    def jobs_panel():
+        st.markdown("##### ⏳ Rapports en préparation")
+        still_active = False
+        for job in filter(None, map(queue.status, [job["id"] for job in jobs])):
+            if job["status"] == report_jobs.DONE:
+                fname, data, mime = queue.artifact(job["id"])
+                st.download_button(label=f"⬇️ {job['label']} : {fname}", data=data, file_name=fname, mime=mime, key=f"dl_job_{job['id']}")
+            elif job["status"] == report_jobs.FAILED:
+                st.error(f"❌ {job['label']} : {job['error']}")
             else:
-                st.error("Échec de la mise à jour (Vérifiez les logs ou la connexion).")
+                still_active = True
+                progress = job["done"] / job["total"] if job["total"] else 0.0
+                current = f" — parcelle {job['current']}" if job["current"] else ""
+                st.progress(progress, text=f"{job['label']} : {job['done']}/{job['total']} parcelle(s){current} ({job['status']})")
+        if active and not still_active:
+            st.rerun()
 
-    st.divider()
+    jobs_panel()
 
-# --- FICHE PREPARATION PHYTO ---
-st.subheader("🧪 Fiche de Préparation Phyto")
-try:
-    df_planned = loader.get_planned_treatments(selected_campaign)
-    
-    if not df_planned.empty:
-        # The user selects parcelles specifically for reports below.
-        # Here we just show all planned treatments for the campaign.
-        if df_planned.empty:
-             st.info("Aucune intervention 'Prévue' pour cette sélection.")
-        else:
-             # Group by Date + Parcelle to form unique "Mixes"
-             # We need a selector.
-             # Create a list of options: "YYYY-MM-DD - Parcelle (X produits)"
-             
-             # Grouping
-             # 1. Group by (Date, Parcelle) to get interventions
-             interventions_by_dp = {}
-             for _, row in df_planned.iterrows():
-                 d_val = row['Date']
-                 d_str = "Date Inconnue"
-                 if pd.notnull(d_val):
-                     try:
-                        if isinstance(d_val, str):
-                            d_val = pd.to_datetime(d_val)
-                        d_str = d_val.strftime('%Y-%m-%d')
-                     except:
-                        d_str = str(d_val)
-                        
-                 p_id = row['ID_Parcelle']
-                 key_dp = (d_str, p_id)
-                 if key_dp not in interventions_by_dp: interventions_by_dp[key_dp] = []
-                 interventions_by_dp[key_dp].append(row)
-                 
-             # 2. Group interventions by (Date, Products_Hash)
-             mixes = {}
-             for key_dp, rows in interventions_by_dp.items():
-                 d_str, p_id = key_dp
-                 
-                 prod_signatures = []
-                 for r in rows:
-                     p_name = str(r.get('Nom_Produit', '')).strip().lower()
-                     dose = str(r.get('Dose_Ha', '')).strip()
-                     prod_signatures.append(f"{p_name}_{dose}")
-                 
-                 mix_signature = tuple(sorted(prod_signatures))
-                 mix_key = (d_str, mix_signature)
-                 
-                 if mix_key not in mixes: mixes[mix_key] = []
-                 mixes[mix_key].append({'Parcelle': p_id, 'Rows': rows})
-             
-             # Create Options
-             mix_options = []
-             mix_map = {}
-             # Keep track of unique labels
-             label_counter = {}
-             for k, intervs in mixes.items():
-                 d_str, mix_sig = k
-                 first_rows = intervs[0]['Rows']
-                 nb_p = len(first_rows)
-                 nb_parcelles = len(intervs)
-                 
-                 p_names = [i['Parcelle'] for i in intervs]
-                 if nb_parcelles <= 2:
-                     p_label = " & ".join(p_names)
-                 else:
-                     p_label = f"{nb_parcelles} Parcelles"
-                 
-                 base_label = f"{d_str} - {p_label} ({nb_p} produits)"
-                 
-                 if base_label in label_counter:
-                     label_counter[base_label] += 1
-                     label = f"{base_label} (Mix {label_counter[base_label]})"
-                 else:
-                     label_counter[base_label] = 1
-                     label = base_label
-                     
-                 mix_options.append(label)
-                 mix_map[label] = (k, intervs)
-             
-             mix_options = sorted(mix_options, reverse=True)
-             
-             col_p1, col_p2 = st.columns([2, 1])
-             with col_p1:
-                selected_mix_lbl = st.selectbox("Choisir l'intervention prévue :", mix_options)
-             with col_p2:
-                pass
-             
-             if st.button("Générer Fiche Préparation"):
-                 # Prepare Data
-                 key, intervs = mix_map[selected_mix_lbl]
-                 date_str, mix_sig = key
-                 
-                 total_surface = 0.0
-                 vol_ha_input = 0.0
-                 parcelles_info = []
-                 p_ids = []
-                 
-                 first_rows = intervs[0]['Rows']
-                 
-                 for interv in intervs:
-                     p_id = interv['Parcelle']
-                     p_ids.append(p_id)
-                     first_row_interv = interv['Rows'][0]
-                     
-                     try:
-                         surf_val = first_row_interv.get('Surface_Travaillée_Ha', 0)
-                         surface = float(surf_val) if pd.notnull(surf_val) else 0.0
-                     except:
-                         surface = 0.0
-                         
-                     total_surface += surface
-                     parcelles_info.append({'name': p_id, 'surface': surface})
-                     
-                     if vol_ha_input == 0.0:
-                         try:
-                             vol_val = first_row_interv.get('Volume_Bouillie_L_Ha', 0)
-                             vol_ha_input = float(vol_val) if pd.notnull(vol_val) else 0.0
-                         except:
-                             pass
-                             
-                 if vol_ha_input == 0:
-                     st.warning("⚠️ Attention : Volume Bouillie / ha non renseigné.")
-                 
-                 # Prepare Products List
-                 prods = []
-                 for r in first_rows:
-                     prods.append(r.to_dict())
-                 
-                 # Sort
-                 sorted_prods = loader.sort_products_by_formulation(prods)
-                 
-                 # Parse Date
-                 date_obj = first_rows[0]['Date']
-                 if isinstance(date_obj, str):
-                     try: date_obj = pd.to_datetime(date_obj)
-                     except: pass
-                        
-                 if hasattr(date_obj, 'strftime'):
-                     clean_date = date_obj.strftime('%Y%m%d')
-                 else:
-                     clean_date = "00000000"
-                     
-                 intervention_id = f"{'|'.join(p_ids)}_{clean_date}"
-                 
-                 payload = {
-                     'Parcelles': parcelles_info,
-                     'Total_Surface': total_surface,
-                     'Date': date_obj,
-                     'Volume_Bouillie_Ha': vol_ha_input,
-                     'Products': sorted_prods,
-                     'Intervention_ID': intervention_id
-                 }
-                 
-                 # Generate
-                 with tempfile.TemporaryDirectory() as tmpdirname:
-                     fname = f"Fiche_Prep_{intervention_id}.pdf"
-                     fpath = os.path.join(tmpdirname, fname)
-                     
-                     gen = ReportGenerator(fpath)
-                     gen.generate_prep_sheet(selected_campaign, payload, base_url=APP_BASE_URL)
-                     
-                     with open(fpath, "rb") as f:
-                        st.download_button(
-                            label="⬇️ Télécharger Fiche",
-                            data=f,
-                            file_name=fname,
-                            mime="application/pdf"
-                        )
-                 st.success("Fiche générée ! Vérifiez l'ordre d'incorporation.")
-                 
+# --- Generation Section ---
+@section_fragment("Rapports")
+def render_rapports(selected_campaign, df_campaign, available_parcelles):
+    st.subheader("📄 Génération de Rapports Globaux : ITK, Ferti et Registre Phyto")
+
+    # Move selectors here
+    col1, col2 = st.columns(2)
+    with col1:
+        # Just show the selected campaign from the top level
+        st.info(f"📅 Campagne active : {selected_campaign}")
+
+    with col2:
+        # Add 'Toutes' option
+        options = ["Toutes"] + list(available_parcelles)
+        selected_parcelle = st.selectbox("🌾 Choisir la Parcelle", options)
+
+    target_parcelles = []
+    if selected_parcelle == "Toutes":
+        target_parcelles = list(available_parcelles)
     else:
-        st.info("Pas d'interventions planifiées trouvées pour cette campagne.")
-except Exception as e:
-    st.error(f"Erreur chargement planning: {e}")
+        target_parcelles = [selected_parcelle]
 
-st.divider()
+    st.markdown("<br>", unsafe_allow_html=True)
 
-# --- Generation Section ---
-st.subheader("📄 Génération de Rapports Globaux : ITK, Ferti et Registre Phyto")
-
-# Move selectors here
-col1, col2 = st.columns(2)
-with col1:
-    # Just show the selected campaign from the top level
-    st.info(f"📅 Campagne active : {selected_campaign}")
-
-with col2:
-    # Add 'Toutes' option
-    options = ["Toutes"] + list(available_parcelles)
-    selected_parcelle = st.selectbox("🌾 Choisir la Parcelle", options)
-
-target_parcelles = []
-if selected_parcelle == "Toutes":
-    target_parcelles = list(available_parcelles)
-else:
-    target_parcelles = [selected_parcelle]
-
-st.markdown("<br>", unsafe_allow_html=True)
-
-# Helper for PDF Generation
-def generate_and_download(report_type):
-    # Prepare Data
-    metadata_map = active_loader.get_parcel_metadata(selected_campaign)
-    
-    # Logic copied/adapted from main.py
-    # Ideally should be refactored into a Controller class, but we keep it simple here.
-    
-    timestamp = datetime.now().strftime('%H%M%S')
-    
-    # We will generate ONE merged PDF or multiple?
-    # Web context: Better to ZIP if multiple, or just generate one specific PDF if single parcelle.
-    # If "All", maybe ZIP.
-    # For now, let's keep it simple: Single PDF if single parcelle, Zip if multiple.
-    # OR: Just one PDF merging pages? ReportGen generates one file. We can append pages?
-    # Current ReportGenerator class creates a NEW file each init.
-    
-    zip_buffer = None
-    files_generated = []
-    
-    # Patch Surface (Same logic as main.py)
-    def patch_surface_column(df):
-        if 'Surface_Travaillée_Ha' in df.columns:
-            df['Surface_Travaillée_Ha'] = df['Surface_Travaillée_Ha'].astype(float)
-            mask = df['Surface_Travaillée_Ha'] > 50
-            df.loc[mask, 'Surface_Travaillée_Ha'] = df.loc[mask, 'Surface_Travaillée_Ha'] / 100
-        return df
-
-    # --- PHYTO ---
-    if report_type == "PHYTO":
-        df_phyto = df_campaign[df_campaign['Nature_Intervention'] == "Traitement"]
-        df_phyto = df_phyto[df_phyto['ID_Parcelle'].isin(target_parcelles)]
-        df_phyto = patch_surface_column(df_phyto)
-        df_phyto = df_phyto.fillna("") # Clean NaNs
-        
-        grouped_data = {}
-        for p in df_phyto['ID_Parcelle'].unique():
-            subset = df_phyto[df_phyto['ID_Parcelle'] == p].sort_values(by='Date')
-            p_meta = metadata_map.get(p, {})
-            grouped_data[p] = {'data': subset.to_dict('records'), 'meta': p_meta}
-            
-        return grouped_data, "generate_phyto_register", "Registre_Phytosanitaire"
-
-    # --- FERTI ---
-    elif report_type == "FERTI":
-        df_ferti = df_campaign[df_campaign['Nature_Intervention'] == "Fertilisation"]
-        df_ferti = df_ferti[df_ferti['ID_Parcelle'].isin(target_parcelles)]
-        df_ferti = patch_surface_column(df_ferti)
-        df_ferti = df_ferti.fillna("") # Clean NaNs
-        
-        grouped_data = {}
-        for p in df_ferti['ID_Parcelle'].unique():
-            p_meta = metadata_map.get(p, {})
-            grouped_data[p] = {
-                 'Apports': df_ferti[df_ferti['ID_Parcelle'] == p].to_dict('records'),
-                 'Besoins': {'Culture': p_meta.get('Culture', 'Inconnue'), 'Besoin_N': 0, 'Besoin_P': 0, 'Besoin_K': 0},
-                 'Sol': {},
-                 'meta': p_meta
-            }
-        return grouped_data, "generate_ferti_balance", "Bilan_Fertilisation"
-
-    # --- ITK ---
-    elif report_type == "ITK":
-        df_itk = df_campaign[df_campaign['ID_Parcelle'].isin(target_parcelles)]
-        df_itk = patch_surface_column(df_itk)
-        df_itk = df_itk.fillna("") # Clean NaNs
-        
-        grouped_data = {}
-        if not df_itk.empty:
-            for p in df_itk['ID_Parcelle'].unique():
-                 subset = df_itk[df_itk['ID_Parcelle'] == p].sort_values(by='Date')
-                 p_meta = metadata_map.get(p, {})
-                 cat_data = {'meta': p_meta, 'Travail du sol': [], 'Semis': [], 'Fertilisation': [], 'Traitement': [], 'Récolte': []}
-                 for _, row in subset.iterrows():
-                     nature = str(row['Nature_Intervention']).strip()
-                     record = row.to_dict()
-                     if nature in ['Déchaumage', 'Labour', 'Travail du sol']: cat_data['Travail du sol'].append(record)
-                     elif nature in ['Semi', 'Semis']: cat_data['Semis'].append(record)
-                     elif nature == 'Fertilisation': cat_data['Fertilisation'].append(record)
-                     elif nature == 'Traitement': cat_data['Traitement'].append(record)
-                     elif nature in ['Récolte', 'Moisson']: cat_data['Récolte'].append(record)
-                 grouped_data[p] = cat_data
-        return grouped_data, "generate_itk", "Itineraire_Technique"
-
-    # --- IRRIGATION PARCELLE ---
-    elif report_type == "IRRIG_PARCELLE":
-        df_irrig = active_loader.get_journal_irrigation()
-        if not df_irrig.empty:
-            df_irrig['Campagne'] = pd.to_numeric(df_irrig['Campagne'], errors='coerce').fillna(0).astype(int)
-            df_irrig = df_irrig[df_irrig['Campagne'] == int(selected_campaign)]
-            
-            # Filter by targeted parcels
-            if "Toutes" not in options and target_parcelles:
-                df_irrig = df_irrig[df_irrig['ID_Parcelle'].isin(target_parcelles)]
-            elif target_parcelles and target_parcelles[0] != "Toutes":
-                df_irrig = df_irrig[df_irrig['ID_Parcelle'].isin(target_parcelles)]
+    # Helper for PDF Generation
+    def generate_and_download(report_type):
+        # Prepare Data
+        metadata_map = active_loader.get_parcel_metadata(selected_campaign)
+
+        # Logic copied/adapted from main.py
+        # Ideally should be refactored into a Controller class, but we keep it simple here.
+
+        timestamp = datetime.now().strftime('%H%M%S')
+
+        # We will generate ONE merged PDF or multiple?
+        # Web context: Better to ZIP if multiple, or just generate one specific PDF if single parcelle.
+        # If "All", maybe ZIP.
+        # For now, let's keep it simple: Single PDF if single parcelle, Zip if multiple.
+        # OR: Just one PDF merging pages? ReportGen generates one file. We can append pages?
+        # Current ReportGenerator class creates a NEW file each init.
+
+        zip_buffer = None
+        files_generated = []
+
+        # Patch Surface (Same logic as main.py)
+        def patch_surface_column(df):
+            if 'Surface_Travaillée_Ha' in df.columns:
+                df['Surface_Travaillée_Ha'] = df['Surface_Travaillée_Ha'].astype(float)
+                mask = df['Surface_Travaillée_Ha'] > 50
+                df.loc[mask, 'Surface_Travaillée_Ha'] = df.loc[mask, 'Surface_Travaillée_Ha'] / 100
+            return df
+
+        # --- PHYTO ---
+        if report_type == "PHYTO":
+            df_phyto = df_campaign[df_campaign['Nature_Intervention'] == "Traitement"]
+            df_phyto = df_phyto[df_phyto['ID_Parcelle'].isin(target_parcelles)]
+            df_phyto = patch_surface_column(df_phyto)
+            df_phyto = df_phyto.fillna("") # Clean NaNs
 
             grouped_data = {}
-            for p in df_irrig['ID_Parcelle'].unique():
-                subset = df_irrig[df_irrig['ID_Parcelle'] == p]
+            for p in df_phyto['ID_Parcelle'].unique():
+                subset = df_phyto[df_phyto['ID_Parcelle'] == p].sort_values(by='Date')
+                p_meta = metadata_map.get(p, {})
+                grouped_data[p] = {'data': subset.to_dict('records'), 'meta': p_meta}
+
+            return grouped_data, "generate_phyto_register", "Registre_Phytosanitaire"
+
+        # --- FERTI ---
+        elif report_type == "FERTI":
+            df_ferti = df_campaign[df_campaign['Nature_Intervention'] == "Fertilisation"]
+            df_ferti = df_ferti[df_ferti['ID_Parcelle'].isin(target_parcelles)]
+            df_ferti = patch_surface_column(df_ferti)
+            df_ferti = df_ferti.fillna("") # Clean NaNs
+
+            grouped_data = {}
+            for p in df_ferti['ID_Parcelle'].unique():
                 p_meta = metadata_map.get(p, {})
                 grouped_data[p] = {
-                     'Irrigations': subset.to_dict('records'),
+                     'Apports': df_ferti[df_ferti['ID_Parcelle'] == p].to_dict('records'),
+                     'Besoins': {'Culture': p_meta.get('Culture', 'Inconnue'), 'Besoin_N': 0, 'Besoin_P': 0, 'Besoin_K': 0},
+                     'Sol': {},
                      'meta': p_meta
                 }
-            return grouped_data, "generate_irrigation_parcel_report", "Bilan_Irrig_Parcelle"
-        return {}, None, None
+            return grouped_data, "generate_ferti_balance", "Bilan_Fertilisation"
+
+        # --- ITK ---
+        elif report_type == "ITK":
+            df_itk = df_campaign[df_campaign['ID_Parcelle'].isin(target_parcelles)]
+            df_itk = patch_surface_column(df_itk)
+            df_itk = df_itk.fillna("") # Clean NaNs
 
-    return None, None, None
+            grouped_data = {}
+            if not df_itk.empty:
+                for p in df_itk['ID_Parcelle'].unique():
+                     subset = df_itk[df_itk['ID_Parcelle'] == p].sort_values(by='Date')
+                     p_meta = metadata_map.get(p, {})
+                     cat_data = {'meta': p_meta, 'Travail du sol': [], 'Semis': [], 'Fertilisation': [], 'Traitement': [], 'Récolte': []}
+                     for _, row in subset.iterrows():
+                         nature = str(row['Nature_Intervention']).strip()
+                         record = row.to_dict()
+                         if nature in ['Déchaumage', 'Labour', 'Travail du sol']: cat_data['Travail du sol'].append(record)
+                         elif nature in ['Semi', 'Semis']: cat_data['Semis'].append(record)
+                         elif nature == 'Fertilisation': cat_data['Fertilisation'].append(record)
+                         elif nature == 'Traitement': cat_data['Traitement'].append(record)
+                         elif nature in ['Récolte', 'Moisson']: cat_data['Récolte'].append(record)
+                     grouped_data[p] = cat_data
+            return grouped_data, "generate_itk", "Itineraire_Technique"
+
+        # --- IRRIGATION PARCELLE ---
+        elif report_type == "IRRIG_PARCELLE":
+            df_irrig = active_loader.get_journal_irrigation()
+            if not df_irrig.empty:
+                df_irrig['Campagne'] = pd.to_numeric(df_irrig['Campagne'], errors='coerce').fillna(0).astype(int)
+                df_irrig = df_irrig[df_irrig['Campagne'] == int(selected_campaign)]
+
+                # Filter by targeted parcels
+                if "Toutes" not in options and target_parcelles:
+                    df_irrig = df_irrig[df_irrig['ID_Parcelle'].isin(target_parcelles)]
+                elif target_parcelles and target_parcelles[0] != "Toutes":
+                    df_irrig = df_irrig[df_irrig['ID_Parcelle'].isin(target_parcelles)]
+
+                grouped_data = {}
+                for p in df_irrig['ID_Parcelle'].unique():
+                    subset = df_irrig[df_irrig['ID_Parcelle'] == p]
+                    p_meta = metadata_map.get(p, {})
+                    grouped_data[p] = {
+                         'Irrigations': subset.to_dict('records'),
+                         'meta': p_meta
+                    }
+                return grouped_data, "generate_irrigation_parcel_report", "Bilan_Irrig_Parcelle"
+            return {}, None, None
 
-# UI for generation
-col_pdf1, col_pdf2, col_pdf3 = st.columns(3)
+        return None, None, None
 
-import tempfile
-import zipfile
+    # UI for generation
+    col_pdf1, col_pdf2, col_pdf3 = st.columns(3)
 
-def handle_pdf_action(report_type, btn_label):
-    if st.button(btn_label):
-        with st.spinner(f"Génération {report_type}..."):
+    def handle_pdf_action(report_type, btn_label):
+        if st.button(btn_label):
             data, method_name, prefix = generate_and_download(report_type)
-            
+
             if not data:
                 st.warning("Aucune donnée pour cette sélection.")
                 return
 
-            # Create temp directory
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                files = []
-                for p_id, p_payload in data.items():
-                    safe_pid = str(p_id).replace(" ", "_").replace("/", "-")
-                    fname = f"{prefix}_{selected_campaign}_{safe_pid}.pdf"
-                    fpath = os.path.join(tmpdirname, fname)
-                    
-                    gen = ReportGenerator(fpath)
-                    # Call method dynamically
-                    method = getattr(gen, method_name)
-                    method(selected_campaign, {p_id: p_payload})
-                    files.append(fpath)
-                
-                if not files:
-                     st.warning("Rien à générer.")
-                     return
-
-                # If single file -> Direct Download
-                if len(files) == 1:
-                    with open(files[0], "rb") as f:
-                        st.download_button(
-                            label=f"⬇️ Télécharger PDF ({report_type})",
-                            data=f,
-                            file_name=os.path.basename(files[0]),
-                            mime="application/pdf",
-                            key=f"dl_{report_type}"
-                        )
-                else:
-                    # If multiple -> Zip
-                    zip_name = f"{prefix}_Campagne_{selected_campaign}.zip"
-                    zip_path = os.path.join(tmpdirname, zip_name)
-                    with zipfile.ZipFile(zip_path, 'w') as zipf:
-                        for file in files:
-                            zipf.write(file, os.path.basename(file))
-                    
-                    with open(zip_path, "rb") as f:
-                        st.download_button(
-                            label=f"⬇️ Télécharger ZIP ({report_type})",
-                            data=f,
-                            file_name=zip_name,
-                            mime="application/zip",
-                             key=f"dl_{report_type}_zip"
-                        )
-        st.success("Génération terminée ! Cliquez ci-dessus pour télécharger.")
+            # Génération en arrière-plan : le script rend la main tout de suite, l'ID du travail
+            # est gardé dans l'URL pour retrouver le rapport après un rechargement de page.
+            job_id = get_report_queue().submit(f"{report_type} {selected_campaign}", selected_campaign, data, method_name, prefix)
+            st.query_params["report_jobs"] = ",".join(report_job_ids() + [job_id])
+            st.toast(f"Génération {report_type} lancée ({len(data)} parcelle(s)).")
+
+    col_pdf1, col_pdf2, col_pdf3, col_pdf4 = st.columns(4)
+
+    with col_pdf1:
+        handle_pdf_action("ITK", "📄 Itinéraire Technique")
+    with col_pdf2:
+        handle_pdf_action("PHYTO", "🛡️ Registre Phyto")
+    with col_pdf3:
+        handle_pdf_action("FERTI", "🧪 Bilan Ferti")
+    with col_pdf4:
+        handle_pdf_action("IRRIG_PARCELLE", "💧 Bilan Irrig Parcelle")
 
-col_pdf1, col_pdf2, col_pdf3, col_pdf4 = st.columns(4)
+    render_report_jobs()
 
-with col_pdf1:
-    handle_pdf_action("ITK", "📄 Itinéraire Technique")
-with col_pdf2:
-    handle_pdf_action("PHYTO", "🛡️ Registre Phyto")
-with col_pdf3:
-    handle_pdf_action("FERTI", "🧪 Bilan Ferti")
-with col_pdf4:
-    handle_pdf_action("IRRIG_PARCELLE", "💧 Bilan Irrig Parcelle")
+render_rapports(selected_campaign, df_campaign, available_parcelles)
 
 # --- SECTION CARNET D'ENTRETIEN ---
 st.divider()
-st.subheader("⚙️ Carnet d'Entretien Matériel")
+@section_fragment("Carnet d'Entretien")
+def render_carnet_entretien():
+    st.subheader("⚙️ Carnet d'Entretien Matériel")
 
-try:
-    with st.spinner("Chargement des matériels..."):
-        df_materiels = loader.get_materiels()
-        
-    if df_materiels.empty:
-        st.info("Aucun matériel trouvé dans REF_MATERIELS.")
-    else:
-        # Prepare dropdown options: "ID_Materiel - Marque Modele"
-        materiel_options = []
-        materiel_map = {} # label -> row
-        
-        for _, row in df_materiels.iterrows():
-            m_id = str(row.get('ID_Materiel', ''))
-            marque = str(row.get('Marque', ''))
-            modele = str(row.get('Modele', ''))
-            
-            if m_id:
-                label = f"{m_id} - {marque} {modele}".strip(" -")
-                materiel_options.append(label)
-                materiel_map[label] = row
-                
-        if not materiel_options:
-             st.warning("Aucun ID_Materiel valide trouvé.")
+    try:
+        with st.spinner("Chargement des matériels..."):
+            df_materiels = loader.get_materiels()
+
+        if df_materiels.empty:
+            st.info("Aucun matériel trouvé dans REF_MATERIELS.")
         else:
-            col_m1, col_m2 = st.columns([2, 1])
-            with col_m1:
-                selected_mat_label = st.selectbox("Sélectionnez un matériel", sorted(materiel_options))
-                
-            if st.button("📄 Générer Carnet d'Entretien"):
-                selected_row = materiel_map[selected_mat_label]
-                m_id = str(selected_row.get('ID_Materiel', ''))
-                
-                with st.spinner(f"Récupération de l'historique pour {m_id}..."):
-                    df_history = loader.get_maintenance_history(m_id)
-                    
-                    with tempfile.TemporaryDirectory() as tmpdirname:
-                        fname = f"Carnet_Entretien_{m_id}.pdf"
-                        fpath = os.path.join(tmpdirname, fname)
-                        
-                        gen = ReportGenerator(fpath)
-                        gen.generate_maintenance_log(selected_row.to_dict(), df_history)
-                        
-                        if os.path.exists(fpath):
-                            with open(fpath, "rb") as f:
-                                st.download_button(
-                                    label=f"⬇️ Télécharger Carnet ({m_id})",
-                                    data=f,
-                                    file_name=fname,
-                                    mime="application/pdf",
-                                    key=f"dl_maint_{m_id}"
-                                )
-                            st.success("Carnet généré avec succès ! Cliquez ci-dessus pour le télécharger.")
-                        else:
-                            st.error("Échec de la génération du PDF.")
+            # Prepare dropdown options: "ID_Materiel - Marque Modele"
+            materiel_options = []
+            materiel_map = {} # label -> row
+
+            for _, row in df_materiels.iterrows():
+                m_id = str(row.get('ID_Materiel', ''))
+                marque = str(row.get('Marque', ''))
+                modele = str(row.get('Modele', ''))
+
+                if m_id:
+                    label = f"{m_id} - {marque} {modele}".strip(" -")
+                    materiel_options.append(label)
+                    materiel_map[label] = row
+
+            if not materiel_options:
+                 st.warning("Aucun ID_Materiel valide trouvé.")
+            else:
+                col_m1, col_m2 = st.columns([2, 1])
+                with col_m1:
+                    selected_mat_label = st.selectbox("Sélectionnez un matériel", sorted(materiel_options))
 
-except Exception as e:
-    st.error(f"Erreur lors du traitement du carnet d'entretien : {e}")
+                if st.button("📄 Générer Carnet d'Entretien"):
+                    selected_row = materiel_map[selected_mat_label]
+                    m_id = str(selected_row.get('ID_Materiel', ''))
 
+                    with st.spinner(f"Récupération de l'historique pour {m_id}..."):
+                        df_history = loader.get_maintenance_history(m_id)
 
-def calculate_summary_table(df_filtered, selected_nets):
-    aggs = []
-    total_m3_global = 0
-    total_ha_global = 0
-    
-    for net in sorted(selected_nets):
-        net_data = df_filtered[df_filtered['Reseau_type'] == net]
-        if net_data.empty: continue
-        
-        # 1. Total m3 for network
-        total_m3 = net_data['Conso_Reelle_m3'].sum()
-        total_m3_global += total_m3
-        
-        # 2. Total Irrigated Ha
-        unique_meters = net_data.drop_duplicates(subset=['ID_cCompteur' if 'ID_cCompteur' in net_data.columns else 'ID_Compteur'])
-        
-        total_ha = 0
-        if 'Ha_irrigués_compteur' in unique_meters.columns:
-            total_ha = pd.to_numeric(unique_meters['Ha_irrigués_compteur'], errors='coerce').fillna(0).sum()
-        
-        total_ha_global += total_ha
-        
-        # 3. Calculate mm/ha : (m3 / 10) / ha
-        mm_ha = 0
-        if total_ha > 0:
-             mm_ha = (total_m3 / 10) / total_ha
-             
-        aggs.append({
-            'Réseau': net,
-            'Total m3': total_m3,
-            'Volume (mm/ha)': mm_ha
-        })
-        
-    df_agg = pd.DataFrame(aggs)
-    
-    if not df_agg.empty:
-        mm_ha_global = 0
-        if total_ha_global > 0:
-             mm_ha_global = (total_m3_global / 10) / total_ha_global
-        
-        total_row = pd.DataFrame([{
-            'Réseau': 'TOTAL',
-            'Total m3': total_m3_global,
-            'Volume (mm/ha)': mm_ha_global
-        }])
-        df_agg = pd.concat([df_agg, total_row], ignore_index=True)
-        
-    return df_agg
+                        with tempfile.TemporaryDirectory() as tmpdirname:
+                            fname = f"Carnet_Entretien_{m_id}.pdf"
+                            fpath = os.path.join(tmpdirname, fname)
+
+                            gen = ReportGenerator(fpath)
+                            gen.generate_maintenance_log(selected_row.to_dict(), df_history)
+
+                            if os.path.exists(fpath):
+                                with open(fpath, "rb") as f:
+                                    st.download_button(
+                                        label=f"⬇️ Télécharger Carnet ({m_id})",
+                                        data=f,
+                                        file_name=fname,
+                                        mime="application/pdf",
+                                        key=f"dl_maint_{m_id}"
+                                    )
+                                st.success("Carnet généré avec succès ! Cliquez ci-dessus pour le télécharger.")
+                            else:
+                                st.error("Échec de la génération du PDF.")
+
+    except Exception as e:
+        st.error(f"Erreur lors du traitement du carnet d'entretien : {e}")
+
+render_carnet_entretien()
+
+
+def calculate_summary_table(df_filtered, selected_nets, by=None):
+    """
+    Synthèse par réseau en une agrégation : m3, ha irrigués (une fois par compteur), mm/ha, puis ligne TOTAL.
+    by : colonne de regroupement supplémentaire (ex. 'Campagne') pour traiter plusieurs campagnes
+    en une seule passe ; une ligne TOTAL par valeur de by.
+    """
+    keys = [by] if by else []
+    df = df_filtered[df_filtered['Reseau_type'].isin(selected_nets)]
+    if df.empty:
+        return pd.DataFrame(columns=keys + ['Réseau', 'Total m3', 'Ha irrigués', 'Volume (mm/ha)'])
+
+    # Ha irrigués : comptés une seule fois par compteur (et par réseau / groupe)
+    meter_col = 'ID_cCompteur' if 'ID_cCompteur' in df.columns else 'ID_Compteur'
+    if 'Ha_irrigués_compteur' in df.columns:
+        ha = pd.to_numeric(df['Ha_irrigués_compteur'], errors='coerce').fillna(0)
+    else:
+        ha = 0.0
+    meters = df.assign(_ha=ha).drop_duplicates(subset=keys + ['Reseau_type', meter_col])
+
+    df_agg = pd.DataFrame({
+        'Total m3': df.groupby(keys + ['Reseau_type'])['Conso_Reelle_m3'].sum(),
+        'Ha irrigués': meters.groupby(keys + ['Reseau_type'])['_ha'].sum(),
+    }).reset_index()
+
+    if by:
+        total = df_agg.groupby(by, as_index=False)[['Total m3', 'Ha irrigués']].sum()
+    else:
+        total = df_agg[['Total m3', 'Ha irrigués']].sum().to_frame().T
+    total['Reseau_type'] = 'TOTAL'
+
+    df_agg = pd.concat([df_agg, total], ignore_index=True)
+    df_agg = df_agg.sort_values(keys + ['Reseau_type'], key=lambda c: c.eq('TOTAL') if c.name == 'Reseau_type' else c, kind='stable')
+
+    # mm/ha : (m3 / 10) / ha
+    df_agg['Volume (mm/ha)'] = (df_agg['Total m3'] / 10 / df_agg['Ha irrigués'].where(df_agg['Ha irrigués'] > 0)).fillna(0.0)
+    return df_agg.rename(columns={'Reseau_type': 'Réseau'}).reset_index(drop=True)
 
 # --- SECTION IRRIGATION ---
 st.divider()
-st.subheader("💧 Gestion de l'Irrigation")
+@section_fragment("Irrigation")
+def render_irrigation(selected_campaign, available_campaigns):
+    st.subheader("💧 Gestion de l'Irrigation")
 
-try:
-    with st.spinner("Chargement des données d'irrigation..."):
-        df_conso = loader.get_consumption_data(selected_campaign)
+    try:
+        with st.spinner("Chargement des données d'irrigation..."):
+            df_conso = loader.get_consumption_data(selected_campaign)
 
-    if df_conso.empty:
-        st.info(f"Aucune donnée d'irrigation trouvée pour la campagne {selected_campaign}.")
-    else:
-        # Network and Meter Filtering
-        networks = sorted(df_conso['Reseau_type'].unique())
-        
-        col_f1, col_f2 = st.columns(2)
-        with col_f1:
-            selected_nets = st.multiselect("Filtre Réseau", networks, default=networks)
-        
-        # Filter meters based on networks
-        df_net_filtered = df_conso[df_conso['Reseau_type'].isin(selected_nets)]
-        available_meters = sorted(df_net_filtered['ID_Compteur'].unique()) if not df_net_filtered.empty else []
-        
-        with col_f2:
-            selected_meters = st.multiselect("Filtre Compteurs", available_meters, default=available_meters)
-            
-        # Final filter
-        df_filtered = df_net_filtered[df_net_filtered['ID_Compteur'].isin(selected_meters)]
-        
-        # Month Selector for Monthly Reports
-        # Map Reading Month to Consumption Month (Reading - 1)
-        french_months = {
-            1: 'Janvier', 2: 'Février', 3: 'Mars', 4: 'Avril', 5: 'Mai', 6: 'Juin',
-            7: 'Juillet', 8: 'Août', 9: 'Septembre', 10: 'Octobre', 11: 'Novembre', 12: 'Décembre'
-        }
-        
-        reading_months = sorted(df_filtered['Date_Relevé'].dt.month.dropna().unique())
-        month_options = []
-        month_map = {} # Display Name -> Consumption Month Index
-        
-        for m in reading_months:
-            conso_m_idx = m - 1 if m > 1 else 12
-            label = f"{french_months[conso_m_idx]} (Relevé de {french_months[m]})"
-            month_options.append(label)
-            month_map[label] = m # We store the Reading Month to filter data
-            
-        with col_f1:
-            selected_month_label = st.selectbox("📅 Mois de Consommation (Bilan Mensuel)", month_options)
-            selected_reading_month = month_map[selected_month_label] if selected_month_label else None
-            conso_month_name = selected_month_label.split(" (")[0] if selected_month_label else ""
-        
-        if df_filtered.empty:
-            st.warning("Veuillez sélectionner au moins un réseau.")
+        if df_conso.empty:
+            st.info(f"Aucune donnée d'irrigation trouvée pour la campagne {selected_campaign}.")
         else:
-            # Display data summary
-            st.markdown(f"#### 📊 Consommation Campagne {selected_campaign}")
-            
-            # Complex aggregated view per network (including mm/ha and TOTAL)
-            df_agg = calculate_summary_table(df_filtered, selected_nets)
-            
-            # Formatting (Force 1 decimal place string for display)
-            if not df_agg.empty:
-                df_display = df_agg.copy()
-                df_display['Total m3'] = df_display['Total m3'].apply(lambda x: f"{x:.1f}")
-                df_display['Volume (mm/ha)'] = df_display['Volume (mm/ha)'].apply(lambda x: f"{x:.1f}")
-                
-            st.dataframe(df_display, use_container_width=True, hide_index=True)
-            
-            # --- Global Export Button ---
-            st.markdown("<br>", unsafe_allow_html=True)
-            if st.button("📄 Exporter Synthèse Multiannuelle PDF", key="btn_global_irr_export"):
-                with st.spinner("Génération de la synthèse globale en cours..."):
-                    campaign_summaries = {}
-                    for camp in available_campaigns:
-                        df_camp_conso = loader.get_consumption_data(camp)
-                        if not df_camp_conso.empty:
-                            df_camp_net_filtered = df_camp_conso[df_camp_conso['Reseau_type'].isin(selected_nets)]
-                            df_camp_filtered = df_camp_net_filtered[df_camp_net_filtered['ID_Compteur'].isin(selected_meters)]
-                            if not df_camp_filtered.empty:
-                                df_camp_agg = calculate_summary_table(df_camp_filtered, selected_nets)
-                                if not df_camp_agg.empty:
-                                    campaign_summaries[camp] = df_camp_agg
-                    
-                    if campaign_summaries:
-                        with tempfile.TemporaryDirectory() as tmpdirname:
-                            global_fname = "Synthese_Globale_Irrigation.pdf"
-                            global_fpath = os.path.join(tmpdirname, global_fname)
-                            gen = ReportGenerator(global_fpath)
-                            gen.generate_global_irrigation_summary(campaign_summaries)
-                            
-                            with open(global_fpath, "rb") as f:
-                                st.download_button(
-                                    label="⬇️ Télécharger Synthèse Multiannuelle",
-                                    data=f,
-                                    file_name=global_fname,
-                                    mime="application/pdf",
-                                    key="dl_global_irr"
-                                )
-                    else:
-                        st.warning("Aucune donnée d'irrigation à exporter pour les filtres actuels.")
-            st.markdown("<br>", unsafe_allow_html=True)
-            
-            # Actions par réseau
-            for net in sorted(selected_nets):
-                net_data = df_filtered[df_filtered['Reseau_type'] == net]
-                if net_data.empty: continue
-                
-                with st.expander(f"Action pour le réseau : {net}"):
-                    st.markdown("#### 📜 Bilan Campagne")
-                    col_irr1, col_irr2 = st.columns(2)
-                
-                    with col_irr1:
-                        if st.button(f"📄 PDF Campagne - {net}", key=f"btn_pdf_camp_{net}"):
-                            with tempfile.TemporaryDirectory() as tmpdirname:
-                                fname = f"Bilan_Campagne_Irrigation_{selected_campaign}_{net}.pdf"
-                                fpath = os.path.join(tmpdirname, fname)
-                                gen = ReportGenerator(fpath)
-                                gen.generate_irrigation_report(selected_campaign, net, net_data)
-                                with open(fpath, "rb") as f:
-                                    st.download_button(label=f"⬇️ Télécharger PDF Campagne", data=f, file_name=fname, mime="application/pdf", key=f"dl_camp_{net}")
-
-                    with col_irr2:
-                        # Email only for non-private networks
-                        if net in ["CUMA_Irrigation", "ASA_SaintLoup"]:
-                            recipient = net_data['Mail_Contact-Reseau'].iloc[0] if not net_data.empty and 'Mail_Contact-Reseau' in net_data.columns else None
-                            
-                            if st.button(f"📧 Envoyer Bilan Campagne - {net}", key=f"btn_mail_camp_{net}"):
-                                if not recipient:
-                                    st.error(f"Aucune adresse email trouvée pour le réseau {net}.")
-                                else:
-                                    with st.spinner(f"Envoi du bilan campagne à : {recipient}..."):
-                                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                                            fpath = tmp_file.name
-                                            gen = ReportGenerator(fpath)
-                                            gen.generate_irrigation_report(selected_campaign, net, net_data)
-                                            
-                                            # Robust secrets retrieval
-                                            sender_email = st.secrets.get("GMAIL_USER")
-                                            sender_app_password = st.secrets.get("GMAIL_PASSWORD")
-                                            
-                                            if not sender_email:
-                                                try:
-                                                    sender_email = st.secrets["connections"]["gsheets"]["GMAIL_USER"]
-                                                    sender_app_password = st.secrets["connections"]["gsheets"]["GMAIL_PASSWORD"]
-                                                except Exception:
-                                                    pass
-                                                
-                                            if not sender_email or not sender_app_password:
-                                                st.error("Identifiants d'envoi d'email introuvables (GMAIL_USER, GMAIL_PASSWORD).")
-                                            else:
-                                                subject = f"Bilan Fin de Campagne Irrigation - {net} - {selected_campaign}"
-                                                body_text = f"Bonjour,\n\nVeuillez trouver ci-joint le bilan de fin de campagne d'irrigation pour l'année {selected_campaign} concernant le réseau {net}.\n\nCordialement,\nAgri Automation"
-                                                
-                                                success = send_email_with_attachment(
-                                                    sender_email,
-                                                    sender_app_password,
-                                                    recipient,
-                                                    subject,
-                                                    body_text,
-                                                    fpath
-                                                )
-                                                
-                                                if success:
-                                                    st.success("Email envoyé avec succès !")
-                                                else:
-                                                    st.error("L'envoi a échoué. Consultez les logs locaux.")
-
-                    st.divider()
-                    st.markdown(f"#### 📅 Bilan Mensuel : {conso_month_name}")
-                    col_irr_m1, col_irr_m2 = st.columns(2)
-                    
-                    # Filter for that specific month's data
-                    monthly_data = net_data[net_data['Date_Relevé'].dt.month == selected_reading_month]
-                    
-                    with col_irr_m1:
-                        if st.button(f"📄 PDF Mensuel - {net}", key=f"btn_pdf_month_{net}"):
+            # Network and Meter Filtering
+            networks = sorted(df_conso['Reseau_type'].unique())
+
+            col_f1, col_f2 = st.columns(2)
+            with col_f1:
+                selected_nets = st.multiselect("Filtre Réseau", networks, default=networks)
+
+            # Filter meters based on networks
+            df_net_filtered = df_conso[df_conso['Reseau_type'].isin(selected_nets)]
+            available_meters = sorted(df_net_filtered['ID_Compteur'].unique()) if not df_net_filtered.empty else []
+
+            with col_f2:
+                selected_meters = st.multiselect("Filtre Compteurs", available_meters, default=available_meters)
+
+            # Final filter
+            df_filtered = df_net_filtered[df_net_filtered['ID_Compteur'].isin(selected_meters)]
+
+            # Month Selector for Monthly Reports
+            # Map Reading Month to Consumption Month (Reading - 1)
+            french_months = {
+                1: 'Janvier', 2: 'Février', 3: 'Mars', 4: 'Avril', 5: 'Mai', 6: 'Juin',
+                7: 'Juillet', 8: 'Août', 9: 'Septembre', 10: 'Octobre', 11: 'Novembre', 12: 'Décembre'
+            }
+
+            reading_months = sorted(df_filtered['Date_Relevé'].dt.month.dropna().unique())
+            month_options = []
+            month_map = {} # Display Name -> Consumption Month Index
+
+            for m in reading_months:
+                conso_m_idx = m - 1 if m > 1 else 12
+                label = f"{french_months[conso_m_idx]} (Relevé de {french_months[m]})"
+                month_options.append(label)
+                month_map[label] = m # We store the Reading Month to filter data
+
+            with col_f1:
+                selected_month_label = st.selectbox("📅 Mois de Consommation (Bilan Mensuel)", month_options)
+                selected_reading_month = month_map[selected_month_label] if selected_month_label else None
+                conso_month_name = selected_month_label.split(" (")[0] if selected_month_label else ""
+
+            if df_filtered.empty:
+                st.warning("Veuillez sélectionner au moins un réseau.")
+            else:
+                # Display data summary
+                st.markdown(f"#### 📊 Consommation Campagne {selected_campaign}")
+
+                # Complex aggregated view per network (including mm/ha and TOTAL)
+                df_agg = calculate_summary_table(df_filtered, selected_nets)
+
+                # Formatting (Force 1 decimal place string for display)
+                if not df_agg.empty:
+                    df_display = df_agg.copy()
+                    df_display['Total m3'] = df_display['Total m3'].apply(lambda x: f"{x:.1f}")
+                    df_display['Ha irrigués'] = df_display['Ha irrigués'].apply(lambda x: f"{x:.2f}")
+                    df_display['Volume (mm/ha)'] = df_display['Volume (mm/ha)'].apply(lambda x: f"{x:.1f}")
+
+                st.dataframe(df_display, use_container_width=True, hide_index=True)
+
+                # --- Global Export Button ---
+                st.markdown("<br>", unsafe_allow_html=True)
+                if st.button("📄 Exporter Synthèse Multiannuelle PDF", key="btn_global_irr_export"):
+                    with st.spinner("Génération de la synthèse globale en cours..."):
+                        # Toutes les campagnes agrégées en une passe (groupby Campagne × Réseau)
+                        campaign_summaries = {}
+                        df_all_conso = loader.get_consumption_data()
+                        if not df_all_conso.empty:
+                            df_all_conso = df_all_conso.assign(Campagne=df_all_conso['Date_Relevé'].dt.year)
+                            df_all_filtered = df_all_conso[
+                                df_all_conso['Campagne'].isin(available_campaigns) & df_all_conso['ID_Compteur'].isin(selected_meters)
+                            ]
+                            df_all_agg = calculate_summary_table(df_all_filtered, selected_nets, by='Campagne')
+                            campaign_summaries = {
+                                int(camp): df_camp_agg.drop(columns='Campagne').reset_index(drop=True)
+                                for camp, df_camp_agg in df_all_agg.groupby('Campagne')
+                            }
+
+                        if campaign_summaries:
                             with tempfile.TemporaryDirectory() as tmpdirname:
-                                fname = f"Bilan_Mensuel_{conso_month_name}_{selected_campaign}_{net}.pdf"
-                                fpath = os.path.join(tmpdirname, fname)
-                                gen = ReportGenerator(fpath)
-                                gen.generate_monthly_network_report(selected_campaign, conso_month_name, net, monthly_data)
-                                with open(fpath, "rb") as f:
-                                    st.download_button(label=f"⬇️ Télécharger PDF Mensuel", data=f, file_name=fname, mime="application/pdf", key=f"dl_month_{net}")
-                                    
-                    with col_irr_m2:
-                        # Email only for non-private networks
-                        if net in ["CUMA_Irrigation", "ASA_SaintLoup"]:
-                            recipient = monthly_data['Mail_Contact-Reseau'].iloc[0] if not monthly_data.empty and 'Mail_Contact-Reseau' in monthly_data.columns else None
-                            
-                            if st.button(f"📧 Envoyer Bilan Mensuel - {net}", key=f"btn_mail_month_{net}"):
-                                if not recipient:
-                                    st.error(f"Aucune adresse email trouvée pour le réseau {net}.")
-                                else:
-                                    with st.spinner(f"Envoi du bilan mensuel à : {recipient}..."):
-                                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                                            fpath = tmp_file.name
-                                            gen = ReportGenerator(fpath)
-                                            gen.generate_monthly_network_report(selected_campaign, conso_month_name, net, monthly_data)
-                                            
-                                            # Robust secrets retrieval
-                                            sender_email = st.secrets.get("GMAIL_USER")
-                                            app_password = st.secrets.get("GMAIL_PASSWORD")
-                                            
-                                            # If not at root, try nested in connections.gsheets
-                                            if not sender_email:
-                                                try:
-                                                    sender_email = st.secrets["connections"]["gsheets"]["GMAIL_USER"]
-                                                    app_password = st.secrets["connections"]["gsheets"]["GMAIL_PASSWORD"]
-                                                except:
-                                                    pass
-                                            
-                                            if not sender_email or not app_password:
-                                                st.error(f"Identifiants Gmail manquants. (Clés vues : {list(st.secrets.keys())})")
-                                            else:
-                                                success = send_email_with_attachment(
-                                                    sender_email, app_password, recipient,
-                                                    f"Bilan Irrigation Mensuel ({conso_month_name}) - {net}",
-                                                    f"Bonjour,\n\nVeuillez trouver ci-joint le bilan de consommation mensuel pour le réseau {net} (Mois concerné : {conso_month_name}).\n\nCordialement.",
-                                                    fpath
-                                                )
-                                                if success: st.success(f"Email envoyé à {recipient} !")
-                                                else: st.error("Échec de l'envoi.")
-                                            if os.path.exists(fpath): os.remove(fpath)
+                                global_fname = "Synthese_Globale_Irrigation.pdf"
+                                global_fpath = os.path.join(tmpdirname, global_fname)
+                                gen = ReportGenerator(global_fpath)
+                                gen.generate_global_irrigation_summary(campaign_summaries)
+
+                                with open(global_fpath, "rb") as f:
+                                    st.download_button(
+                                        label="⬇️ Télécharger Synthèse Multiannuelle",
+                                        data=f,
+                                        file_name=global_fname,
+                                        mime="application/pdf",
+                                        key="dl_global_irr"
+                                    )
                         else:
-                            st.info("Privé : Email non requis.")
+                            st.warning("Aucune donnée d'irrigation à exporter pour les filtres actuels.")
+                st.markdown("<br>", unsafe_allow_html=True)
+
+                # Actions par réseau
+                for net in sorted(selected_nets):
+                    net_data = df_filtered[df_filtered['Reseau_type'] == net]
+                    if net_data.empty: continue
+
+                    with st.expander(f"Action pour le réseau : {net}"):
+                        st.markdown("#### 📜 Bilan Campagne")
+                        col_irr1, col_irr2 = st.columns(2)
+
+                        with col_irr1:
+                            if st.button(f"📄 PDF Campagne - {net}", key=f"btn_pdf_camp_{net}"):
+                                with tempfile.TemporaryDirectory() as tmpdirname:
+                                    fname = f"Bilan_Campagne_Irrigation_{selected_campaign}_{net}.pdf"
+                                    fpath = os.path.join(tmpdirname, fname)
+                                    gen = ReportGenerator(fpath)
+                                    gen.generate_irrigation_report(selected_campaign, net, net_data)
+                                    with open(fpath, "rb") as f:
+                                        st.download_button(label=f"⬇️ Télécharger PDF Campagne", data=f, file_name=fname, mime="application/pdf", key=f"dl_camp_{net}")
+
+                        with col_irr2:
+                            # Email only for non-private networks
+                            if net in ["CUMA_Irrigation", "ASA_SaintLoup"]:
+                                recipient = net_data['Mail_Contact-Reseau'].iloc[0] if not net_data.empty and 'Mail_Contact-Reseau' in net_data.columns else None
+
+                                if st.button(f"📧 Envoyer Bilan Campagne - {net}", key=f"btn_mail_camp_{net}"):
+                                    if not recipient:
+                                        st.error(f"Aucune adresse email trouvée pour le réseau {net}.")
+                                    else:
+                                        with st.spinner(f"Envoi du bilan campagne à : {recipient}..."):
+                                            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
+                                                fpath = tmp_file.name
+                                                gen = ReportGenerator(fpath)
+                                                gen.generate_irrigation_report(selected_campaign, net, net_data)
+
+                                                # Robust secrets retrieval
+                                                sender_email = st.secrets.get("GMAIL_USER")
+                                                sender_app_password = st.secrets.get("GMAIL_PASSWORD")
+
+                                                if not sender_email:
+                                                    try:
+                                                        sender_email = st.secrets["connections"]["gsheets"]["GMAIL_USER"]
+                                                        sender_app_password = st.secrets["connections"]["gsheets"]["GMAIL_PASSWORD"]
+                                                    except Exception:
+                                                        pass
+
+                                                if not sender_email or not sender_app_password:
+                                                    st.error("Identifiants d'envoi d'email introuvables (GMAIL_USER, GMAIL_PASSWORD).")
+                                                else:
+                                                    subject = f"Bilan Fin de Campagne Irrigation - {net} - {selected_campaign}"
+                                                    body_text = f"Bonjour,\n\nVeuillez trouver ci-joint le bilan de fin de campagne d'irrigation pour l'année {selected_campaign} concernant le réseau {net}.\n\nCordialement,\nAgri Automation"
+
+                                                    success = send_email_with_attachment(
+                                                        sender_email,
+                                                        sender_app_password,
+                                                        recipient,
+                                                        subject,
+                                                        body_text,
+                                                        fpath
+                                                    )
+
+                                                    if success:
+                                                        st.success("Email envoyé avec succès !")
+                                                    else:
+                                                        st.error("L'envoi a échoué. Consultez les logs locaux.")
+
+                        st.divider()
+                        st.markdown(f"#### 📅 Bilan Mensuel : {conso_month_name}")
+                        col_irr_m1, col_irr_m2 = st.columns(2)
+
+                        # Filter for that specific month's data
+                        monthly_data = net_data[net_data['Date_Relevé'].dt.month == selected_reading_month]
+
+                        with col_irr_m1:
+                            if st.button(f"📄 PDF Mensuel - {net}", key=f"btn_pdf_month_{net}"):
+                                with tempfile.TemporaryDirectory() as tmpdirname:
+                                    fname = f"Bilan_Mensuel_{conso_month_name}_{selected_campaign}_{net}.pdf"
+                                    fpath = os.path.join(tmpdirname, fname)
+                                    gen = ReportGenerator(fpath)
+                                    gen.generate_monthly_network_report(selected_campaign, conso_month_name, net, monthly_data)
+                                    with open(fpath, "rb") as f:
+                                        st.download_button(label=f"⬇️ Télécharger PDF Mensuel", data=f, file_name=fname, mime="application/pdf", key=f"dl_month_{net}")
+
+                        with col_irr_m2:
+                            # Email only for non-private networks
+                            if net in ["CUMA_Irrigation", "ASA_SaintLoup"]:
+                                recipient = monthly_data['Mail_Contact-Reseau'].iloc[0] if not monthly_data.empty and 'Mail_Contact-Reseau' in monthly_data.columns else None
+
+                                if st.button(f"📧 Envoyer Bilan Mensuel - {net}", key=f"btn_mail_month_{net}"):
+                                    if not recipient:
+                                        st.error(f"Aucune adresse email trouvée pour le réseau {net}.")
+                                    else:
+                                        with st.spinner(f"Envoi du bilan mensuel à : {recipient}..."):
+                                            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
+                                                fpath = tmp_file.name
+                                                gen = ReportGenerator(fpath)
+                                                gen.generate_monthly_network_report(selected_campaign, conso_month_name, net, monthly_data)
+
+                                                # Robust secrets retrieval
+                                                sender_email = st.secrets.get("GMAIL_USER")
+                                                app_password = st.secrets.get("GMAIL_PASSWORD")
+
+                                                # If not at root, try nested in connections.gsheets
+                                                if not sender_email:
+                                                    try:
+                                                        sender_email = st.secrets["connections"]["gsheets"]["GMAIL_USER"]
+                                                        app_password = st.secrets["connections"]["gsheets"]["GMAIL_PASSWORD"]
+                                                    except:
+                                                        pass
+
+                                                if not sender_email or not app_password:
+                                                    st.error(f"Identifiants Gmail manquants. (Clés vues : {list(st.secrets.keys())})")
+                                                else:
+                                                    success = send_email_with_attachment(
+                                                        sender_email, app_password, recipient,
+                                                        f"Bilan Irrigation Mensuel ({conso_month_name}) - {net}",
+                                                        f"Bonjour,\n\nVeuillez trouver ci-joint le bilan de consommation mensuel pour le réseau {net} (Mois concerné : {conso_month_name}).\n\nCordialement.",
+                                                        fpath
+                                                    )
+                                                    if success: st.success(f"Email envoyé à {recipient} !")
+                                                    else: st.error("Échec de l'envoi.")
+                                                if os.path.exists(fpath): os.remove(fpath)
+                            else:
+                                st.info("Privé : Email non requis.")
 
-except Exception as e:
-    st.error(f"Erreur lors du traitement de l'irrigation : {e}")
+    except Exception as e:
+        st.error(f"Erreur lors du traitement de l'irrigation : {e}")
+
+render_irrigation(selected_campaign, available_campaigns)
 
 # ===========================================================================
 # 🌿 RÉFÉRENTIEL PHYTO — Recherche E-Phy + Auto-remplissage REF_INTRANTS
@@ -1051,230 +1028,399 @@ except Exception as e:
 st.divider()
 st.subheader("🌿 Référentiel Phytosanitaire (E-Phy)")
 
-with st.expander("🔍 Rechercher un produit et remplir REF_INTRANTS + REF_USAGES_PHYTO", expanded=False):
+def build_intrant_row(intrant: dict) -> dict:
+    """Ligne REF_INTRANTS à écrire (uniquement les champs auto E-Phy)."""
+    return {
+        "Nom_Produit":       intrant.get("Nom_Produit", ""),
+        "Type":              intrant.get("Type", ""),
+        "N_AMM":             intrant.get("N_AMM", ""),
+        "Matieres_Actives":  intrant.get("Matieres_Actives", ""),
+        "Concentration":     intrant.get("Concentration", ""),
+        "Culture":           intrant.get("Culture", ""),
+        "Nb_Applications_Max_An": intrant.get("Nb_Applications_Max_An", ""),
+        "ZNT_Aqua":          intrant.get("ZNT_Aqua", ""),
+        "ZNT_Riverains":     intrant.get("ZNT_Riverains", ""),
+        "DVP":               intrant.get("DVP", ""),
+        "DAR":               intrant.get("DAR", ""),
+        "Dose_Max_Homologuee": intrant.get("Dose_Max_Homologuee", ""),
+        "Mentions_Danger":   intrant.get("Mentions_Danger", ""),
+        "Unité_utilisation": intrant.get("Unité_utilisation", ""),
+        "Formulation":       intrant.get("Formulation", ""),
+        "Etat_AMM":          intrant.get("Etat_AMM", ""),
+        "Date_Fin_AMM":      intrant.get("Date_Fin_AMM", ""),
+        "Classement_CMR":    intrant.get("Classement_CMR", ""),
+        "Titulaire_AMM":     intrant.get("Titulaire_AMM", ""),
+        "Lien_Ephy":         intrant.get("Lien_Ephy", ""),
+        "Date_MAJ_Ephy":     datetime.now().strftime("%d/%m/%Y"),
+    }
+
+@section_fragment("Référentiel E-Phy")
+def render_referentiel_ephy(selected_campaign, df_campaign, df_intervention):
+    with st.expander("🔍 Rechercher un produit et remplir REF_INTRANTS + REF_USAGES_PHYTO", expanded=False):
 
-    # --- Init EphyFetcher dans la session Streamlit ---
-    if "ephy_fetcher" not in st.session_state:
+        # --- EphyFetcher unique pour le process, partagé (lecture seule) par toutes les sessions ---
+        fetcher: EphyFetcher | None = None
         with st.spinner("🔄 Chargement du référentiel E-Phy (première fois : ~30s)..."):
             try:
-                st.session_state["ephy_fetcher"] = EphyFetcher(auto_refresh=True)
+                fetcher = get_ephy_fetcher()
+                fetcher.sync()  # Version basculée par un autre process (rafraîchissement en arrière-plan)
             except Exception as e_init:
                 st.error(f"❌ Erreur initialisation E-Phy : {e_init}")
-                st.session_state["ephy_fetcher"] = None
-
-    fetcher: EphyFetcher | None = st.session_state.get("ephy_fetcher")
-
-    # --- Barre d'état du cache ---
-    col_info1, col_info2, col_info3 = st.columns(3)
-    with col_info1:
-        st.metric("📂 Produits E-Phy indexés", fetcher.nb_produits if fetcher else 0)
-    with col_info2:
-        st.metric("📅 Dernière MAJ", fetcher.last_update if fetcher else "N/A")
-    with col_info3:
-        if st.button("🔄 Forcer mise à jour E-Phy", key="btn_refresh_ephy"):
-            with st.spinner("Téléchargement du référentiel E-Phy en cours..."):
-                ok = fetcher.refresh(force=True) if fetcher else False
-            if ok:
-                st.success("✅ Référentiel E-Phy mis à jour !")
-                st.rerun()
-            else:
-                st.error("❌ Échec de la mise à jour.")
 
-    st.markdown("---")
+        # --- Barre d'état du cache ---
+        col_info1, col_info2, col_info3 = st.columns(3)
+        with col_info1:
+            st.metric("📂 Produits E-Phy indexés", fetcher.nb_produits if fetcher else 0)
+        with col_info2:
+            st.metric("📅 Dernière MAJ", fetcher.last_update if fetcher else "N/A")
+        with col_info3:
+            if fetcher and fetcher.refresh_in_progress:
+                st.info("⏳ Mise à jour E-Phy en arrière-plan (recherches sur la version actuelle)...")
+            elif st.button("🔄 Forcer mise à jour E-Phy", key="btn_refresh_ephy"):
+                if fetcher and fetcher.refresh_async(force=True):
+                    st.success("🔄 Mise à jour lancée en arrière-plan. Le référentiel sera basculé à la fin du téléchargement.")
+                else:
+                    st.error("❌ Échec du lancement de la mise à jour.")
+            elif fetcher and fetcher.last_refresh_ok is False:
+                st.error("❌ Échec de la dernière mise à jour (référentiel précédent conservé).")
+        if fetcher:
+            cache_stats = fetcher.search_cache_stats
+            st.caption(f"Cache de recherche : {cache_stats['size']} requête(s), "
+                       f"taux de hit {cache_stats['hit_rate']:.0%} ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})")
+
+        st.markdown("---")
+
+        # --- Zone de recherche ---
+        st.markdown("#### 🔍 Recherche par nom commercial")
+        search_query = st.text_input(
+            "Nom commercial du produit",
+            placeholder="Ex: TOPSIN M 70 WG, ROUNDUP FLEX, COMET PRO...",
+            key="ephy_search_query"
+        )
+
+        if search_query and fetcher:
+            suggestions = fetcher.autocomplete(search_query, limit=8)
+            if suggestions:
+                st.caption("💡 Suggestions : " + " · ".join(suggestions))
+
+            with st.spinner(f"Recherche de '{search_query}' dans E-Phy..."):
+                results = fetcher.search(search_query, top_n=8)
+
+            if not results:
+                st.warning("⚠️ Aucun produit trouvé. Vérifiez l'orthographe ou essayez un nom partiel.")
+            else:
+                # Préparer les options de sélection
+                options_labels = []
+                for r in results:
+                    nom = r['intrant'].get('Nom_Produit', '?')
+                    amm = r['intrant'].get('N_AMM', '')
+                    score = r['score']
+                    etat = r['intrant'].get('Etat_AMM', '')
+                    badge = "✅" if "autoris" in str(etat).lower() else ("🔴" if "retir" in str(etat).lower() else "🟡")
+                    label = f"{badge} {nom} | AMM: {amm} | Score: {score}%"
+                    options_labels.append(label)
+
+                selected_label = st.radio(
+                    "Sélectionnez le produit correspondant :",
+                    options_labels,
+                    key="ephy_select_result"
+                )
+                selected_idx = options_labels.index(selected_label)
+                selected_result = results[selected_idx]
+                intrant = selected_result['intrant']
+                usages  = selected_result['usages']
+
+                # --- Fiche produit ---
+                # Valeur affichée : vide si absente (None pour une colonne numérique E-Phy)
+                fiche = lambda col: "" if intrant.get(col) is None else intrant[col]
+                st.markdown("#### 📄 Fiche réglementaire E-Phy")
+                col_f1, col_f2 = st.columns(2)
+                with col_f1:
+                    st.markdown(f"**Nom** : {fiche('Nom_Produit')}")
+                    st.markdown(f"**N° AMM** : `{fiche('N_AMM')}`")
+                    st.markdown(f"**Type** : {fiche('Type')}")
+                    st.markdown(f"**Formulation** : {fiche('Formulation')}")
+                    st.markdown(f"**Titulaire** : {fiche('Titulaire_AMM')}")
+                    st.markdown(f"**État AMM** : {fiche('Etat_AMM')}")
+                    st.markdown(f"**Date fin AMM** : {fiche('Date_Fin_AMM')}")
+                with col_f2:
+                    st.markdown(f"**Matières actives** : {fiche('Matieres_Actives')}")
+                    st.markdown(f"**Concentration** : {fiche('Concentration')}")
+                    st.markdown(f"**Classement CMR** : {fiche('Classement_CMR')}")
+                    st.markdown(f"**Mentions danger** : {fiche('Mentions_Danger')}")
+                    st.markdown(f"**ZNT Aquatique** : {fiche('ZNT_Aqua')} m")
+                    st.markdown(f"**ZNT Riverains** : {fiche('ZNT_Riverains')} m")
+                    st.markdown(f"**DVP** : {fiche('DVP')}")
+                    if intrant.get('Lien_Ephy'):
+                        st.markdown(f"[🔗 Fiche officielle E-Phy]({intrant['Lien_Ephy']})")
+
+                # --- Tableau des usages ---
+                if usages:
+                    st.markdown(f"#### 🌱 Usages homologués ({len(usages)} usage(s))")
+                    df_usages_display = pd.DataFrame(usages)
+                    cols_display = [c for c in ["Culture", "Cible", "Type_Cible", "Dose_Max", "Unite_Dose",
+                                                 "Nb_Applications_Max", "DAR", "DVP", "ZNT_Aqua",
+                                                 "ZNT_Arthropodes", "ZNT_Plantes", "DRE", "Etat_Usage"]
+                                    if c in df_usages_display.columns]
+                    st.dataframe(df_usages_display[cols_display], use_container_width=True, hide_index=True)
+                else:
+                    st.info("ℹ️ Aucun usage détaillé disponible pour ce N°AMM dans E-Phy.")
+
+                st.markdown("---")
+
+                # --- Boutons d'écriture ---
+                st.markdown("#### ✍️ Enregistrer dans MASTER_EXPLOITATION")
+                st.caption("⚠️ Les colonnes `Element_N/P/K`, `Espèce_Semence`, `Unite_Achat`, `Prix_Unitaire_Moyen`, `STOCK_ACTUEL`, `Valeur_Stock` ne sont pas modifiées si le produit existe déjà.")
+
+                col_btn1, col_btn2 = st.columns(2)
+                with col_btn1:
+                    if st.button("➕ Ajouter/MAJ dans REF_INTRANTS", key="btn_add_intrant", type="primary"):
+                        # Construire le dict à écrire (uniquement champs auto E-Phy)
+                        intrant_to_write = build_intrant_row(intrant)
+                        with st.spinner("Enregistrement dans REF_INTRANTS..."):
+                            orig_search = st.session_state.get("search_phyto", "")
+                            ok = active_loader.update_intrant(intrant_to_write, original_name=orig_search)
+                        if ok:
+                            st.success(f"✅ '{intrant_to_write['Nom_Produit']}' enregistré dans REF_INTRANTS !")
+                            st.rerun()  # Refraîchir la page pour afficher la nouvelle ligne dans le tableau
+
+                with col_btn2:
+                    if usages and st.button("🌱 Enregistrer usages dans REF_USAGES_PHYTO", key="btn_add_usages"):
+                        n_amm = intrant.get("N_AMM", "")
+                        with st.spinner(f"Enregistrement de {len(usages)} usage(s) dans REF_USAGES_PHYTO..."):
+                            ok = active_loader.update_usages_phyto(n_amm, usages)
+                        if ok:
+                            st.success(f"✅ {len(usages)} usages enregistrés dans REF_USAGES_PHYTO !")
+
+                # Bouton tout-en-un
+                st.markdown(" ")
+                if st.button("🚀 Tout enregistrer (REF_INTRANTS + REF_USAGES_PHYTO)",
+                             key="btn_add_all", type="primary",
+                             help="Écrit dans les deux onglets en une seule opération"):
+                    intrant_to_write = build_intrant_row(intrant)
+                    with st.spinner("Enregistrement en cours..."):
+                        orig_search = st.session_state.get("search_phyto", "")
+                        n_amm = intrant.get("N_AMM", "")
+                        ok = active_loader.sync_phyto_refs(
+                            [intrant_to_write],
+                            usages_by_amm={n_amm: usages} if usages else None,
+                            original_names={0: orig_search} if orig_search else None,
+                        )
+                    if ok:
+                        st.success("✅ Produit enregistré dans REF_INTRANTS et REF_USAGES_PHYTO !")
+                        st.balloons()
+                        st.rerun()  # Rafraîchir le tableau REF_INTRANTS
+
+                # --- Lot de produits : une seule écriture par onglet pour N produits ---
+                phyto_batch = st.session_state.setdefault("phyto_batch", {})
+                if st.button("📥 Ajouter au lot à synchroniser", key="btn_add_batch"):
+                    phyto_batch[intrant.get("N_AMM", "") or intrant.get("Nom_Produit", "")] = {
+                        "intrant": build_intrant_row(intrant),
+                        "usages": usages,
+                        "original_name": st.session_state.get("search_phyto", ""),
+                    }
+                if phyto_batch:
+                    st.caption("Lot en attente : " + ", ".join(b["intrant"]["Nom_Produit"] for b in phyto_batch.values()))
+                    if st.button(f"🚀 Synchroniser le lot ({len(phyto_batch)} produit(s))", key="btn_sync_batch", type="primary"):
+                        batch_items = list(phyto_batch.values())
+                        with st.spinner(f"Synchronisation de {len(batch_items)} produit(s)..."):
+                            ok = active_loader.sync_phyto_refs(
+                                [b["intrant"] for b in batch_items],
+                                usages_by_amm={b["intrant"]["N_AMM"]: b["usages"] for b in batch_items
+                                               if b["usages"] and b["intrant"]["N_AMM"]},
+                                original_names={i: b["original_name"] for i, b in enumerate(batch_items) if b["original_name"]},
+                            )
+                        if ok:
+                            st.session_state["phyto_batch"] = {}
+                            st.success(f"✅ {len(batch_items)} produit(s) synchronisé(s) dans REF_INTRANTS et REF_USAGES_PHYTO !")
+                            st.rerun()
+
+        elif not fetcher:
+            st.error("❌ Le module E-Phy n'a pas pu être initialisé. Vérifiez la connexion internet.")
+
+        # --- Audit en lot : REF_INTRANTS + produits du journal vs E-Phy ---
+        if fetcher:
+            st.markdown("---")
+            st.markdown("#### 🧾 Audit REF_INTRANTS / JOURNAL_INTERVENTION vs E-Phy")
+            if st.button("🔎 Rapprocher tous les produits avec E-Phy", key="btn_audit_ephy"):
+                noms_audit = []
+                df_ref_audit = active_loader.get_intrants()
+                if not df_ref_audit.empty and "Nom_Produit" in df_ref_audit.columns:
+                    noms_audit += df_ref_audit["Nom_Produit"].dropna().astype(str).tolist()
+                if not df_intervention.empty and "Nom_Produit" in df_intervention.columns:
+                    noms_audit += df_intervention["Nom_Produit"].dropna().astype(str).tolist()
+
+                with st.spinner(f"Rapprochement de {len(set(noms_audit))} produit(s)..."):
+                    df_audit = fetcher.match_products(noms_audit)
+                if df_audit.empty:
+                    st.info("ℹ️ Aucun produit à rapprocher.")
+                else:
+                    st.dataframe(df_audit, use_container_width=True, hide_index=True)
+                    nb_retires = df_audit["Etat_AMM"].astype(str).str.lower().str.contains("retir").sum()
+                    nb_inconnus = df_audit["N_AMM"].isna().sum()
+                    st.caption(f"{len(df_audit)} produit(s) rapproché(s) — {nb_retires} retiré(s), {nb_inconnus} sans correspondance")
 
-    # --- Zone de recherche ---
-    st.markdown("#### 🔍 Recherche par nom commercial")
-    search_query = st.text_input(
-        "Nom commercial du produit",
-        placeholder="Ex: TOPSIN M 70 WG, ROUNDUP FLEX, COMET PRO...",
-        key="ephy_search_query"
-    )
+        # --- Recherche inverse : produits autorisés pour une culture × cible ---
+        if fetcher:
+            st.markdown("---")
+            st.markdown("#### 🎯 Produits autorisés par culture et cible")
+            col_cult, col_cib = st.columns(2)
+            with col_cult:
+                culture_query = st.text_input("Culture", placeholder="Ex: Blé tendre", key="ephy_usage_culture")
+            with col_cib:
+                cibles_connues = fetcher.cibles_for_culture(culture_query) if culture_query else []
+                if cibles_connues:
+                    cible_query = st.selectbox("Cible", sorted(cibles_connues), key="ephy_usage_cible")
+                else:
+                    cible_query = st.text_input("Cible", placeholder="Ex: Septoriose", key="ephy_usage_cible_txt")
+            if culture_query and cible_query:
+                inclure_retires = st.checkbox("Inclure les produits retirés", key="ephy_usage_retires")
+                df_autorises = fetcher.authorized_products(culture_query, cible_query,
+                                                           autorises_seulement=not inclure_retires)
+                if df_autorises.empty:
+                    st.warning(f"Aucun produit homologué pour « {culture_query} × {cible_query} ».")
+                else:
+                    st.dataframe(df_autorises, use_container_width=True, hide_index=True)
+                    st.caption(f"{len(df_autorises)} usage(s) — classés par dose puis DAR croissants")
 
-    if search_query and fetcher:
-        with st.spinner(f"Recherche de '{search_query}' dans E-Phy..."):
-            results = fetcher.search(search_query, top_n=8)
+        # --- Historique E-Phy : état à une date + journal des changements ---
+        if fetcher:
+            st.markdown("---")
+            st.markdown("#### 🕰️ Historique E-Phy (retraits, doses, DAR)")
+            snapshots = fetcher.snapshots()
+            if not snapshots:
+                st.caption("L'historique démarre au prochain rafraîchissement de la base E-Phy.")
+            else:
+                col_h1, col_h2 = st.columns(2)
+                with col_h1:
+                    snap_from = st.selectbox("Depuis le snapshot", snapshots, index=max(len(snapshots) - 2, 0), key="ephy_snap_from")
+                with col_h2:
+                    snap_to = st.selectbox("Jusqu'au snapshot", snapshots, index=len(snapshots) - 1, key="ephy_snap_to")
+                df_changes = fetcher.changelog(snap_from, snap_to)
+                if df_changes.empty:
+                    st.info("ℹ️ Aucun changement entre ces deux snapshots.")
+                else:
+                    nb_retraits = (df_changes["Changement"] == "Retrait AMM").sum()
+                    st.caption(f"{len(df_changes)} changement(s), dont {nb_retraits} retrait(s) d'AMM")
+                    st.dataframe(df_changes, use_container_width=True, hide_index=True)
+
+                col_h3, col_h4 = st.columns(2)
+                with col_h3:
+                    amm_asof = st.text_input("N° AMM", key="ephy_asof_amm", placeholder="Ex: 2000233")
+                with col_h4:
+                    date_asof = st.date_input("État connu au", key="ephy_asof_date", format="DD/MM/YYYY")
+                if amm_asof:
+                    df_asof = fetcher.usages_as_of(date_asof, n_amm=amm_asof.strip())
+                    etat_asof = fetcher.produits_as_of(date_asof, n_amm=amm_asof.strip())
+                    if etat_asof.empty:
+                        st.warning("Produit inconnu de l'historique à cette date.")
+                    else:
+                        st.write(f"**{etat_asof.iloc[0]['Nom_Produit']}** — {etat_asof.iloc[0]['Etat_AMM']}")
+                        cols_asof = [c for c in ["Culture", "Cible", "Dose_Max", "Unite_Dose", "Nb_Applications_Max",
+                                                 "DAR", "Valid_From", "Valid_To"] if c in df_asof.columns]
+                        st.dataframe(df_asof[cols_asof], use_container_width=True, hide_index=True)
 
-        if not results:
-            st.warning("⚠️ Aucun produit trouvé. Vérifiez l'orthographe ou essayez un nom partiel.")
-        else:
-            # Préparer les options de sélection
-            options_labels = []
-            for r in results:
-                nom = r['intrant'].get('Nom_Produit', '?')
-                amm = r['intrant'].get('N_AMM', '')
-                score = r['score']
-                etat = r['intrant'].get('Etat_AMM', '')
-                badge = "✅" if "autoris" in str(etat).lower() else ("🔴" if "retir" in str(etat).lower() else "🟡")
-                label = f"{badge} {nom} | AMM: {amm} | Score: {score}%"
-                options_labels.append(label)
-
-            selected_label = st.radio(
-                "Sélectionnez le produit correspondant :",
-                options_labels,
-                key="ephy_select_result"
+        # --- Substances actives : recherche + bilan de campagne ---
+        if fetcher:
+            st.markdown("---")
+            st.markdown("#### 🧪 Substances actives")
+            substance_query = st.text_input(
+                "Rechercher une substance active",
+                placeholder="Ex: glyphosate, cuivre, prosulfocarbe...",
+                key="ephy_substance_query",
             )
-            selected_idx = options_labels.index(selected_label)
-            selected_result = results[selected_idx]
-            intrant = selected_result['intrant']
-            usages  = selected_result['usages']
+            if substance_query:
+                df_subst_prod = fetcher.products_with_substance(substance_query)
+                if df_subst_prod.empty:
+                    st.warning(f"Aucun produit ne contient « {substance_query} ».")
+                else:
+                    st.dataframe(df_subst_prod, use_container_width=True, hide_index=True)
+                    st.caption(f"{df_subst_prod['N_AMM'].nunique()} produit(s) trouvé(s)")
 
-            # --- Fiche produit ---
-            st.markdown("#### 📄 Fiche réglementaire E-Phy")
-            col_f1, col_f2 = st.columns(2)
-            with col_f1:
-                st.markdown(f"**Nom** : {intrant.get('Nom_Produit', '')}")
-                st.markdown(f"**N° AMM** : `{intrant.get('N_AMM', '')}`")
-                st.markdown(f"**Type** : {intrant.get('Type', '')}")
-                st.markdown(f"**Formulation** : {intrant.get('Formulation', '')}")
-                st.markdown(f"**Titulaire** : {intrant.get('Titulaire_AMM', '')}")
-                st.markdown(f"**État AMM** : {intrant.get('Etat_AMM', '')}")
-                st.markdown(f"**Date fin AMM** : {intrant.get('Date_Fin_AMM', '')}")
-            with col_f2:
-                st.markdown(f"**Matières actives** : {intrant.get('Matieres_Actives', '')}")
-                st.markdown(f"**Concentration** : {intrant.get('Concentration', '')}")
-                st.markdown(f"**Classement CMR** : {intrant.get('Classement_CMR', '')}")
-                st.markdown(f"**Mentions danger** : {intrant.get('Mentions_Danger', '')}")
-                st.markdown(f"**ZNT Aquatique** : {intrant.get('ZNT_Aqua', '')} m")
-                st.markdown(f"**ZNT Riverains** : {intrant.get('ZNT_Riverains', '')} m")
-                st.markdown(f"**DVP** : {intrant.get('DVP', '')}")
-                if intrant.get('Lien_Ephy'):
-                    st.markdown(f"[🔗 Fiche officielle E-Phy]({intrant['Lien_Ephy']})")
-
-            # --- Tableau des usages ---
-            if usages:
-                st.markdown(f"#### 🌱 Usages homologués ({len(usages)} usage(s))")
-                df_usages_display = pd.DataFrame(usages)
-                cols_display = [c for c in ["Culture", "Cible", "Type_Cible", "Dose_Max", "Unite_Dose",
-                                             "Nb_Applications_Max", "DAR", "DVP", "ZNT_Aqua", "Etat_Usage"]
-                                if c in df_usages_display.columns]
-                st.dataframe(df_usages_display[cols_display], use_container_width=True, hide_index=True)
+            if st.button(f"📊 Bilan substances actives — campagne {selected_campaign}", key="btn_substance_totals"):
+                df_totals = fetcher.substance_totals(df_campaign)
+                if df_totals.empty:
+                    st.info("ℹ️ Aucun traitement rapprochable avec E-Phy sur cette campagne.")
+                else:
+                    st.dataframe(
+                        df_totals.assign(Quantite_kg=(df_totals["Quantite_g"] / 1000).round(3)),
+                        use_container_width=True, hide_index=True,
+                    )
+
+        # --- Vue REF_INTRANTS actuel ---
+        st.markdown("---")
+        st.markdown("#### 📊 REF_INTRANTS actuel (produits phytosanitaires)")
+        try:
+            df_ref_current = active_loader.get_intrants()
+            if not df_ref_current.empty:
+                # Filtrer sur les produits phyto (excluant engrais/semences)
+                phyto_types = ["Herbicide", "Fongicide", "Insecticide", "Molluscicide",
+                               "Régulateur de croissance", "Nématicide", "Acaricide"]
+                if "Type" in df_ref_current.columns:
+                    df_phyto_only = df_ref_current[
+                        df_ref_current["Type"].astype(str).str.strip().isin(phyto_types)
+                    ]
+                else:
+                    df_phyto_only = df_ref_current
+
+                if not df_phyto_only.empty:
+                    # Colonnes à afficher en priorité
+                    cols_prio = ["Nom_Produit", "Type", "N_AMM", "Etat_AMM", "Date_Fin_AMM",
+                                 "Matieres_Actives", "Formulation", "DAR", "ZNT_Aqua", "DVP",
+                                 "Classement_CMR", "Date_MAJ_Ephy"]
+
+                    # Forcer la création de ces colonnes si elles n'existent pas encore dans le Sheet
+                    for c in cols_prio:
+                        if c not in df_phyto_only.columns:
+                            df_phyto_only[c] = ""
+
+                    cols_show = cols_prio
+                    st.dataframe(df_phyto_only[cols_show], use_container_width=True, hide_index=True)
+                    st.caption(f"{len(df_phyto_only)} produit(s) phytosanitaire(s) dans REF_INTRANTS")
+                else:
+                    st.info("ℹ️ Aucun produit phytosanitaire trouvé dans REF_INTRANTS (Type non reconnu).")
             else:
-                st.info("ℹ️ Aucun usage détaillé disponible pour ce N°AMM dans E-Phy.")
+                st.info("ℹ️ REF_INTRANTS est vide.")
+        except Exception as e:
+            st.error(f"Erreur chargement REF_INTRANTS : {e}")
+
+render_referentiel_ephy(selected_campaign, df_campaign, df_intervention)
+
+# --- DEBUG : temps par section / appel et profil cProfile du rerun ---
+def render_perf_sidebar():
+    profile_data = perf.stop_profile()
+    if profile_data:
+        st.session_state["_profile_data"] = (datetime.now().strftime('%Y%m%d_%H%M%S'), profile_data)
+
+    with st.sidebar:
+        st.header("🔧 Performance (debug)")
+        st.caption(f"Dernier rerun complet : {perf.elapsed() * 1000:.0f} ms")
+
+        timings = st.session_state.get("_section_timings", {})
+        if timings:
+            st.markdown("**Sections** (dernière exécution, rerun de fragment inclus)")
+            st.dataframe(
+                pd.DataFrame({"Section": list(timings), "ms": [round(v * 1000, 1) for v in timings.values()]}),
+                use_container_width=True, hide_index=True
+            )
 
-            st.markdown("---")
+        calls = perf.summary()
+        if calls:
+            st.markdown("**Appels instrumentés** (durées inclusives)")
+            st.dataframe(pd.DataFrame(calls).round({"Total_ms": 1, "Max_ms": 1}), use_container_width=True, hide_index=True)
+
+        if st.button("⏺️ Profiler le prochain rerun (cProfile)"):
+            st.session_state["_profile_next_run"] = True
+            st.rerun()
+        if "_profile_data" in st.session_state:
+            stamp, data = st.session_state["_profile_data"]
+            st.download_button(
+                label="⬇️ Télécharger le profil (.prof)",
+                data=data,
+                file_name=f"rerun_{stamp}.prof",
+                mime="application/octet-stream"
+            )
+            st.caption("Lecture : `python -m pstats rerun.prof` ou `snakeviz rerun.prof`")
 
-            # --- Boutons d'écriture ---
-            st.markdown("#### ✍️ Enregistrer dans MASTER_EXPLOITATION")
-            st.caption("⚠️ Les colonnes `Element_N/P/K`, `Espèce_Semence`, `Unite_Achat`, `Prix_Unitaire_Moyen`, `STOCK_ACTUEL`, `Valeur_Stock` ne sont pas modifiées si le produit existe déjà.")
-
-            col_btn1, col_btn2 = st.columns(2)
-            with col_btn1:
-                if st.button("➕ Ajouter/MAJ dans REF_INTRANTS", key="btn_add_intrant", type="primary"):
-                    # Construire le dict à écrire (uniquement champs auto E-Phy)
-                    intrant_to_write = {
-                        "Nom_Produit":       intrant.get("Nom_Produit", ""),
-                        "Type":              intrant.get("Type", ""),
-                        "N_AMM":             intrant.get("N_AMM", ""),
-                        "Matieres_Actives":  intrant.get("Matieres_Actives", ""),
-                        "Concentration":     intrant.get("Concentration", ""),
-                        "Culture":           intrant.get("Culture", ""),
-                        "Nb_Applications_Max_An": intrant.get("Nb_Applications_Max_An", ""),
-                        "ZNT_Aqua":          intrant.get("ZNT_Aqua", ""),
-                        "ZNT_Riverains":     intrant.get("ZNT_Riverains", ""),
-                        "DVP":               intrant.get("DVP", ""),
-                        "DAR":               intrant.get("DAR", ""),
-                        "Dose_Max_Homologuee": intrant.get("Dose_Max_Homologuee", ""),
-                        "Mentions_Danger":   intrant.get("Mentions_Danger", ""),
-                        "Unité_utilisation": intrant.get("Unité_utilisation", ""),
-                        "Formulation":       intrant.get("Formulation", ""),
-                        "Etat_AMM":          intrant.get("Etat_AMM", ""),
-                        "Date_Fin_AMM":      intrant.get("Date_Fin_AMM", ""),
-                        "Classement_CMR":    intrant.get("Classement_CMR", ""),
-                        "Titulaire_AMM":     intrant.get("Titulaire_AMM", ""),
-                        "Lien_Ephy":         intrant.get("Lien_Ephy", ""),
-                        "Date_MAJ_Ephy":     datetime.now().strftime("%d/%m/%Y"),
-                    }
-                    with st.spinner("Enregistrement dans REF_INTRANTS..."):
-                        orig_search = st.session_state.get("search_phyto", "")
-                        ok = active_loader.update_intrant(intrant_to_write, original_name=orig_search)
-                    if ok:
-                        active_loader.clear_cache()  # Invalider le cache pour forcer un rechargement
-                        st.success(f"✅ '{intrant_to_write['Nom_Produit']}' enregistré dans REF_INTRANTS !")
-                        st.rerun()  # Refraîchir la page pour afficher la nouvelle ligne dans le tableau
-
-            with col_btn2:
-                if usages and st.button("🌱 Enregistrer usages dans REF_USAGES_PHYTO", key="btn_add_usages"):
-                    n_amm = intrant.get("N_AMM", "")
-                    with st.spinner(f"Enregistrement de {len(usages)} usage(s) dans REF_USAGES_PHYTO..."):
-                        ok = active_loader.update_usages_phyto(n_amm, usages)
-                    if ok:
-                        st.success(f"✅ {len(usages)} usages enregistrés dans REF_USAGES_PHYTO !")
-
-            # Bouton tout-en-un
-            st.markdown(" ")
-            if st.button("🚀 Tout enregistrer (REF_INTRANTS + REF_USAGES_PHYTO)",
-                         key="btn_add_all", type="primary",
-                         help="Écrit dans les deux onglets en une seule opération"):
-                intrant_to_write = {
-                    "Nom_Produit":       intrant.get("Nom_Produit", ""),
-                    "Type":              intrant.get("Type", ""),
-                    "N_AMM":             intrant.get("N_AMM", ""),
-                    "Matieres_Actives":  intrant.get("Matieres_Actives", ""),
-                    "Concentration":     intrant.get("Concentration", ""),
-                    "Culture":           intrant.get("Culture", ""),
-                    "Nb_Applications_Max_An": intrant.get("Nb_Applications_Max_An", ""),
-                    "ZNT_Aqua":          intrant.get("ZNT_Aqua", ""),
-                    "ZNT_Riverains":     intrant.get("ZNT_Riverains", ""),
-                    "DVP":               intrant.get("DVP", ""),
-                    "DAR":               intrant.get("DAR", ""),
-                    "Dose_Max_Homologuee": intrant.get("Dose_Max_Homologuee", ""),
-                    "Mentions_Danger":   intrant.get("Mentions_Danger", ""),
-                    "Unité_utilisation": intrant.get("Unité_utilisation", ""),
-                    "Formulation":       intrant.get("Formulation", ""),
-                    "Etat_AMM":          intrant.get("Etat_AMM", ""),
-                    "Date_Fin_AMM":      intrant.get("Date_Fin_AMM", ""),
-                    "Classement_CMR":    intrant.get("Classement_CMR", ""),
-                    "Titulaire_AMM":     intrant.get("Titulaire_AMM", ""),
-                    "Lien_Ephy":         intrant.get("Lien_Ephy", ""),
-                    "Date_MAJ_Ephy":     datetime.now().strftime("%d/%m/%Y"),
-                }
-                with st.spinner("Enregistrement en cours..."):
-                    orig_search = st.session_state.get("search_phyto", "")
-                    ok1 = active_loader.update_intrant(intrant_to_write, original_name=orig_search)
-                    n_amm = intrant.get("N_AMM", "")
-                    ok2 = active_loader.update_usages_phyto(n_amm, usages) if usages else True
-                if ok1 and ok2:
-                    active_loader.clear_cache()  # Invalider le cache pour forcer un rechargement
-                    st.success("✅ Produit enregistré dans REF_INTRANTS et REF_USAGES_PHYTO !")
-                    st.balloons()
-                    st.rerun()  # Rafraîchir le tableau REF_INTRANTS
-
-    elif not fetcher:
-        st.error("❌ Le module E-Phy n'a pas pu être initialisé. Vérifiez la connexion internet.")
-
-    # --- Vue REF_INTRANTS actuel ---
-    st.markdown("---")
-    st.markdown("#### 📊 REF_INTRANTS actuel (produits phytosanitaires)")
-    try:
-        df_ref_current = active_loader.get_intrants()
-        if not df_ref_current.empty:
-            # Filtrer sur les produits phyto (excluant engrais/semences)
-            phyto_types = ["Herbicide", "Fongicide", "Insecticide", "Molluscicide",
-                           "Régulateur de croissance", "Nématicide", "Acaricide"]
-            if "Type" in df_ref_current.columns:
-                df_phyto_only = df_ref_current[
-                    df_ref_current["Type"].astype(str).str.strip().isin(phyto_types)
-                ]
-            else:
-                df_phyto_only = df_ref_current
-
-            if not df_phyto_only.empty:
-                # Colonnes à afficher en priorité
-                cols_prio = ["Nom_Produit", "Type", "N_AMM", "Etat_AMM", "Date_Fin_AMM",
-                             "Matieres_Actives", "Formulation", "DAR", "ZNT_Aqua", "DVP",
-                             "Classement_CMR", "Date_MAJ_Ephy"]
-                
-                # Forcer la création de ces colonnes si elles n'existent pas encore dans le Sheet
-                for c in cols_prio:
-                    if c not in df_phyto_only.columns:
-                        df_phyto_only[c] = ""
-                
-                cols_show = cols_prio
-                st.dataframe(df_phyto_only[cols_show], use_container_width=True, hide_index=True)
-                st.caption(f"{len(df_phyto_only)} produit(s) phytosanitaire(s) dans REF_INTRANTS")
-            else:
-                st.info("ℹ️ Aucun produit phytosanitaire trouvé dans REF_INTRANTS (Type non reconnu).")
-        else:
-            st.info("ℹ️ REF_INTRANTS est vide.")
-    except Exception as e:
-        st.error(f"Erreur chargement REF_INTRANTS : {e}")
+if DEBUG_PERF:
+    render_perf_sidebar()
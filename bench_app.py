@@ -0,0 +1,113 @@
+"""
+bench_app.py
+============
+Mesure du temps de rerun de app.py avec le harnais AppTest de Streamlit.
+
+Sans fragments, toute interaction réexécute le script entier : c'est le temps
+d'un rerun complet. Avec les sections en st.fragment, une interaction ne réexécute
+que sa section : c'est la durée de la section (st.session_state["_section_timings"]).
+
+Usage : python bench_app.py [nb_repetitions] [--baseline DOSSIER]
+  --baseline : dossier d'une autre version de l'application, mesurée avec le même harnais
+               pour comparer les reruns complets avant / après, par exemple l'état d'origine :
+                   git worktree add ../agri_baseline 36b3d0b
+                   python bench_app.py 10 --baseline ../agri_baseline
+Chaque version est mesurée dans son propre process (modules importés depuis son dossier),
+avec ce dossier comme répertoire courant.
+Nécessite les secrets Streamlit (.streamlit/secrets.toml du dossier mesuré, ou ~/.streamlit)
+et l'accès à MASTER_EXPLOITATION.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+RESULT_PREFIX = "BENCH_RESULT "
+
+
+def _report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[int(0.95 * (len(timings) - 1))]
+    print(f"{label:<28} médiane {statistics.median(timings):8.1f} ms | p95 {p95:8.1f} ms | max {timings[-1]:8.1f} ms")
+
+
+def _measure(app_dir, repeat):
+    """Mesure l'app de app_dir dans le process courant (appelé par _run_worker)."""
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(app_dir, "app.py"), default_timeout=300)
+    t0 = time.perf_counter()
+    at.run()
+    result = {"first_ms": (time.perf_counter() - t0) * 1000, "full_ms": [], "sections_ms": {}}
+    if at.exception:
+        result["error"] = str(at.exception)
+        return result
+
+    # Interaction typique : modification du volume de bouillie dans "Saisie Rapide"
+    volume = next(w for w in at.number_input if w.label.startswith("Volume Bouillie"))
+    for i in range(repeat):
+        volume.set_value(100.0 + 10 * (i + 1))
+        t0 = time.perf_counter()
+        at.run()
+        result["full_ms"].append((time.perf_counter() - t0) * 1000)
+        # Absent des versions sans fragments
+        timings = at.session_state["_section_timings"] if "_section_timings" in at.session_state else {}
+        for name, seconds in timings.items():
+            result["sections_ms"].setdefault(name, []).append(seconds * 1000)
+    return result
+
+
+def _run_worker(app_dir, repeat):
+    """Mesure app_dir dans un process séparé : aucun module partagé entre deux versions."""
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), str(repeat), "--worker", app_dir],
+        cwd=app_dir, capture_output=True, text=True,
+    )
+    for line in proc.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return {"error": (proc.stderr.strip().splitlines() or ["aucun résultat"])[-1]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Temps de rerun de app.py (AppTest)")
+    parser.add_argument("repeat", nargs="?", type=int, default=5)
+    parser.add_argument("--baseline", help="dossier d'une autre version de l'application à comparer")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(RESULT_PREFIX + json.dumps(_measure(os.path.abspath(args.worker), args.repeat)))
+        return
+
+    runs = [("Version courante", os.path.dirname(os.path.abspath(__file__)))]
+    if args.baseline:
+        runs.insert(0, ("Baseline", os.path.abspath(args.baseline)))
+
+    results = {}
+    for label, app_dir in runs:
+        result = _run_worker(app_dir, args.repeat)
+        if "error" in result:
+            print(f"{label} ({app_dir}) : erreur d'exécution : {result['error']}")
+            return
+        print(f"{label} ({app_dir}) : premier rendu (caches froids) {result['first_ms']:.0f} ms")
+        results[label] = result
+
+    print(f"\nRerun complet du script ({args.repeat} interactions)")
+    for label, result in results.items():
+        _report(label, result["full_ms"])
+    sections = results["Version courante"]["sections_ms"]
+    if sections:
+        print("\nVersion courante : rerun du seul fragment concerné")
+        for name, timings in sections.items():
+            _report(name, timings)
+
+
+if __name__ == "__main__":
+    main()
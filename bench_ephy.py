@@ -0,0 +1,78 @@
+"""
+bench_ephy.py
+=============
+Mesure de latence de la recherche E-Phy (autocomplétion par préfixe vs recherche floue)
+sur un jeu de saisies partielles réalistes.
+
+Usage : python bench_ephy.py [nb_repetitions]
+Utilise le cache _ephy_cache (le télécharge si absent).
+"""
+
+import sys
+import time
+import statistics
+from ephy_fetcher import EphyFetcher
+
+# Saisies partielles typiques dans la barre de recherche (frappe en cours, fautes, accents)
+PARTIAL_QUERIES = [
+    "R", "RO", "ROU", "ROUND", "ROUNDUP F",
+    "TOP", "TOPSIN", "TOPSIN M 7",
+    "COM", "COMET P", "OPU", "OPUS NE",
+    "DEC", "DECIS PR", "KARA", "KARATE Z",
+    "ISAR", "SPECT", "MILDI", "AVAUN",
+    "prio", "prosaro", "atlan", "héros",
+    "glyfo", "sonr", "bravo 5", "ampera",
+]
+
+
+def _time_ms(func, query, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(query)
+        timings.append((time.perf_counter() - t0) * 1000)
+    return timings
+
+
+def _report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[int(0.95 * (len(timings) - 1))]
+    print(f"{label:<28} médiane {statistics.median(timings):8.2f} ms | p95 {p95:8.2f} ms | max {timings[-1]:8.2f} ms")
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    t0 = time.perf_counter()
+    fetcher = EphyFetcher(auto_refresh=True)
+    print(f"Chargement référentiel : {(time.perf_counter() - t0) * 1000:.0f} ms "
+          f"({fetcher.nb_produits} produits, {len(fetcher._state._noms)} noms indexés)")
+    if not fetcher.nb_produits:
+        print("Référentiel E-Phy vide : benchmark impossible.")
+        return
+
+    # search() sert les requêtes déjà vues depuis son cache LRU : la recherche floue complète
+    # est mesurée sur le snapshot chargé (_search_uncached), le cache séparément.
+    state = fetcher._state
+    prefix_t, fallback_t, search_t, cached_t = [], [], [], []
+    for q in PARTIAL_QUERIES:
+        if fetcher.autocomplete(q, fuzzy_fallback=False):
+            prefix_t += _time_ms(lambda x: fetcher.autocomplete(x, limit=10), q, repeat)
+        else:
+            fallback_t += _time_ms(lambda x: fetcher.autocomplete(x, limit=10), q, repeat)
+        query = " ".join(q.upper().split())
+        search_t += _time_ms(lambda x: state._search_uncached(x, 8), query, max(1, repeat // 5))
+        fetcher.search(q, top_n=8)
+        cached_t += _time_ms(lambda x: fetcher.search(x, top_n=8), q, repeat)
+
+    print(f"{len(PARTIAL_QUERIES)} saisies partielles, {repeat} répétitions")
+    if prefix_t:
+        _report("autocomplete (préfixe)", prefix_t)
+    if fallback_t:
+        _report("autocomplete (repli flou)", fallback_t)
+    _report("search (WRatio complet)", search_t)
+    _report("search (cache LRU)", cached_t)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,30 @@
 import pandas as pd
+import numpy as np
 import os
+import secrets
+import string
+import time
 import streamlit as st
 from streamlit_gsheets import GSheetsConnection
+import perf
 
 class DataLoader:
+    READ_TTL = 300  # TTL (s) du cache de lecture GSheetsConnection
+    # (name, *args) -> (sheet version, structure derived from the sheet). Shared by every DataLoader of the
+    # process: entries are keyed on sheet content, so reruns and sessions reading the same data reuse them.
+    _derived = {}
+    # Worksheets read from the source, shared by the process: sheet_name -> (read_at, dataframe, version).
+    # Served (as copies) for READ_TTL seconds, so the content fingerprint is computed once per actual read.
+    _sheet_store = {}
+    _fresh_until = {} # sheet_name -> timestamp until which reads bypass the connection TTL cache
+
     def __init__(self, file_path, use_cloud=True, credentials_dict=None):
         self.file_path = file_path
         self.use_cloud = use_cloud
         self.conn = None
         self.xl = None 
         self._cache = {} # Local session cache
+        self._versions = {} # sheet_name -> content fingerprint of the cached dataframe
 
     def load_source(self):
         """Loads data source: Google Sheets if available/requested, else local Excel."""
@@ -31,18 +46,29 @@ class DataLoader:
         print("Fichier Local chargé.")
         return False
 
+    @perf.timed("DataLoader", detail_arg=1)
     def _get_data(self, sheet_name):
         """Internal helper to get dataframe from active source with caching."""
         if sheet_name in self._cache:
             return self._cache[sheet_name]
 
+        stored = self._sheet_store.get(sheet_name)
+        if stored is not None and time.time() - stored[0] < self.READ_TTL:
+            # Copy: callers normalize columns of their frame in place
+            df = stored[1].copy()
+            self._cache[sheet_name] = df
+            self._versions[sheet_name] = stored[2]
+            return df
+
         SPREADSHEET_NAME = "MASTER_EXPLOITATION"
         
         df = pd.DataFrame()
         if self.conn:
             try:
                 # Use a small TTL for the connection itself, but our _cache handles the session
-                df = self.conn.read(worksheet=sheet_name, spreadsheet=SPREADSHEET_NAME, ttl=300)
+                # Onglet écrit récemment : l'entrée TTL de la connexion est périmée, on relit la source
+                ttl = 0 if time.time() < self._fresh_until.get(sheet_name, 0) else self.READ_TTL
+                df = self.conn.read(worksheet=sheet_name, spreadsheet=SPREADSHEET_NAME, ttl=ttl)
             except Exception as e:
                 st.error(f"Erreur lecture onglet '{sheet_name}' : {e}")
         elif self.xl:
@@ -51,16 +77,102 @@ class DataLoader:
             raise Exception("Source de données non initialisée.")
         
         if not df.empty:
+            version = self._fingerprint(df)
+            self._sheet_store[sheet_name] = (time.time(), df.copy(), version)
             self._cache[sheet_name] = df
+            self._versions[sheet_name] = version
         return df
 
+    @staticmethod
+    def _fingerprint(df):
+        """Content hash of a sheet (same data -> same version, across sessions)."""
+        try:
+            hashed = pd.util.hash_pandas_object(df, index=False).sum()
+        except Exception:
+            hashed = hash(df.to_csv(index=False))
+        return f"{len(df)}-{int(hashed) & 0xFFFFFFFFFFFF:012x}"
+
+    def sheet_version(self, sheet_name):
+        """Version (content fingerprint) of a sheet as currently loaded; None if empty/unavailable."""
+        df = self._get_data(sheet_name)
+        if df.empty:
+            return None
+        if sheet_name not in self._versions:
+            self._versions[sheet_name] = self._fingerprint(df)
+        return self._versions[sheet_name]
+
+    @perf.timed("DataLoader", detail_arg=1)
+    def _derived_cache(self, name, sheet_name, build, *args):
+        """
+        Memoizes build(*args) per (name, args) until the content version of sheet_name changes
+        (sheet_name may be a tuple of sheets the structure is derived from).
+        """
+        if isinstance(sheet_name, tuple):
+            version = tuple(self.sheet_version(s) for s in sheet_name)
+        else:
+            version = self.sheet_version(sheet_name)
+        key = (name,) + args
+        hit = self._derived.get(key)
+        if hit is not None and hit[0] == version:
+            return hit[1]
+        value = build(*args)
+        self._derived[key] = (version, value)
+        return value
+
     def clear_cache(self):
         """Clears the local session cache."""
         self._cache = {}
+        self._versions = {}
+
+    def invalidate_sheets(self, *sheet_names):
+        """
+        Invalidates only the given worksheets (instead of st.cache_data.clear(), which drops
+        every cached sheet and function): local and shared cache entries removed, and reads
+        bypass the connection's TTL cache until its stale entry has expired.
+        """
+        for sheet_name in sheet_names:
+            self._cache.pop(sheet_name, None)
+            self._versions.pop(sheet_name, None)
+            self._sheet_store.pop(sheet_name, None)
+            self._fresh_until[sheet_name] = time.time() + self.READ_TTL
 
     def get_interventions(self):
         return self._get_data("JOURNAL_INTERVENTION")
 
+    def get_campaigns(self):
+        """
+        Campaigns found in JOURNAL_INTERVENTION (Campagne) and RELEVES_COMPTEURS (year of Date_Relevé),
+        most recent first. Computed once per version of the two sheets.
+        """
+        return self._campaign_index()["campaigns"]
+
+    def get_campaign_interventions(self, campaign):
+        """JOURNAL_INTERVENTION rows of one campaign (Campagne as int), from the cached campaign index."""
+        df = self.get_interventions()
+        rows = self._campaign_index()["rows"].get(int(campaign))
+        if df.empty or rows is None:
+            return df.iloc[0:0]
+        return df.loc[rows].assign(Campagne=int(campaign))
+
+    def _campaign_index(self):
+        return self._derived_cache("campaigns", ("JOURNAL_INTERVENTION", "RELEVES_COMPTEURS"), self._build_campaign_index)
+
+    def _build_campaign_index(self):
+        rows = {}
+        df = self.get_interventions()
+        if not df.empty and 'Campagne' in df.columns:
+            campagne = pd.to_numeric(df['Campagne'], errors='coerce').fillna(0).astype(int)
+            campagne = campagne[campagne > 0]
+            rows = {int(year): idx for year, idx in campagne.groupby(campagne).groups.items()}
+
+        years = set(rows)
+        df_releves = self.get_releves_compteurs()
+        if not df_releves.empty and 'Date_Relevé' in df_releves.columns:
+            dates = pd.to_datetime(df_releves['Date_Relevé'], errors='coerce', dayfirst=True)
+            years.update(int(y) for y in dates.dt.year.dropna().unique())
+
+        return {"campaigns": sorted(years, reverse=True), "rows": rows}
+
     def get_intrants(self):
         """Loads REF_INTRANTS."""
         return self._get_data("REF_INTRANTS")
@@ -133,9 +245,9 @@ class DataLoader:
         """Loads JOURNAL_IRRIGATION (ID_Secteur, Date_Debut, Date_Fin, Vol_m3, etc.)."""
         return self._get_data("JOURNAL_IRRIGATION")
 
-    def get_consumption_data(self, campaign):
+    def get_consumption_data(self, campaign=None):
         """
-        Calculates consumption per meter for a given campaign.
+        Calculates consumption per meter for a given campaign (every campaign if None).
         Consommation = (Index_N - Index_N-1) * Usage%
         """
         df_releves = self.get_releves_compteurs()
@@ -153,7 +265,10 @@ class DataLoader:
         df_releves['Diff_m3'] = df_releves.groupby('ID_Compteur')['Index_m3'].diff()
 
         # Filter by Campaign AFTER diff calculation
-        df_filtered_releves = df_releves[df_releves['Date_Relevé'].dt.year == int(campaign)]
+        if campaign is None:
+            df_filtered_releves = df_releves[df_releves['Date_Relevé'].notna()]
+        else:
+            df_filtered_releves = df_releves[df_releves['Date_Relevé'].dt.year == int(campaign)]
 
         if df_filtered_releves.empty:
             return pd.DataFrame()
@@ -171,6 +286,7 @@ class DataLoader:
 
         return df_merged
 
+    @perf.timed("DataLoader")
     def get_parcel_metadata(self, campaign):
         """
         Returns a dictionary keyed by ID_Parcelle containing: 
@@ -222,6 +338,122 @@ class DataLoader:
         df = df[df['Nature_Intervention'] == "Traitement"]
         return df
 
+    def get_planned_mixes(self, campaign):
+        """
+        Groups the planned treatments of a campaign into tank mixes: parcels treated on the same
+        date with the same product/dose signature share one preparation sheet.
+        Returns {label: mix}, labels sorted newest first. Cached per campaign and JOURNAL_INTERVENTION version.
+        """
+        return self._derived_cache("planned_mixes", "JOURNAL_INTERVENTION", self._build_planned_mixes, int(campaign))
+
+    def _build_planned_mixes(self, campaign):
+        df_planned = self.get_planned_treatments(campaign)
+        if df_planned.empty:
+            return {}
+
+        p = pd.DataFrame(index=df_planned.index)
+        p["Ordre"] = range(len(p))
+        p["Parcelle"] = df_planned["ID_Parcelle"]
+        p["Date"] = pd.to_datetime(df_planned["Date"], errors="coerce", dayfirst=True)
+        p["Date_Str"] = (p["Date"].dt.strftime("%Y-%m-%d").fillna(df_planned["Date"].astype(str))
+                         .where(df_planned["Date"].notna(), "Date Inconnue"))
+        col = lambda c: df_planned[c] if c in df_planned.columns else pd.Series("", index=df_planned.index)
+        p["Sig"] = (col("Nom_Produit").fillna("").astype(str).str.strip().str.lower()
+                    + "_" + col("Dose_Ha").fillna("").astype(str).str.strip())
+        num = lambda c: pd.to_numeric(col(c), errors="coerce").fillna(0.0)
+        p["Surface"] = num("Surface_Travaillée_Ha")
+        p["Volume"] = num("Volume_Bouillie_L_Ha")
+
+        # 1. Signature du mélange par (Date, Parcelle) : produits/doses triés puis concaténés
+        dp = (p.sort_values(["Date_Str", "Parcelle", "Sig"], kind="stable")
+               .groupby(["Date_Str", "Parcelle"], sort=False)
+               .agg(Signature=("Sig", "\x1f".join), Ordre=("Ordre", "min"), Nb_Produits=("Sig", "size")))
+        first = p.drop_duplicates(["Date_Str", "Parcelle"]).set_index(["Date_Str", "Parcelle"])
+        dp = dp.join(first[["Surface", "Volume", "Date"]]).reset_index().sort_values("Ordre")
+
+        # 2. Parcelles partageant (Date, Signature) -> un mélange
+        dp["Volume"] = dp["Volume"].where(dp["Volume"] != 0)
+        mixes = (dp.groupby(["Date_Str", "Signature"], sort=False)
+                   .agg(Parcelles=("Parcelle", list), Surfaces=("Surface", list), Volume=("Volume", "first"),
+                        Nb_Produits=("Nb_Produits", "first"), Date=("Date", "first"), Parcelle=("Parcelle", "first")))
+
+        rows_by_dp = p.groupby(["Date_Str", "Parcelle"], sort=False).groups
+        # Produits du mélange = lignes de la première parcelle (seules lignes matérialisées en dict)
+        product_rows = {k: rows_by_dp[k] for k in zip(mixes.index.get_level_values("Date_Str"), mixes["Parcelle"])}
+        records = df_planned.loc[[i for rows in product_rows.values() for i in rows]].to_dict("index")
+
+        result = {}
+        label_counter = {}
+        for (d_str, _), mix in mixes.iterrows():
+            nb_parcelles = len(mix["Parcelles"])
+            p_label = " & ".join(map(str, mix["Parcelles"])) if nb_parcelles <= 2 else f"{nb_parcelles} Parcelles"
+            base_label = f"{d_str} - {p_label} ({mix['Nb_Produits']} produits)"
+            label_counter[base_label] = label_counter.get(base_label, 0) + 1
+            label = base_label if label_counter[base_label] == 1 else f"{base_label} (Mix {label_counter[base_label]})"
+            result[label] = {
+                "Date": mix["Date"],
+                "Date_Str": d_str,
+                "Parcelles": [{"name": n, "surface": float(s)} for n, s in zip(mix["Parcelles"], mix["Surfaces"])],
+                "Volume_Bouillie_Ha": 0.0 if pd.isna(mix["Volume"]) else float(mix["Volume"]),
+                "Products": [records[i] for i in product_rows[(d_str, mix["Parcelle"])]],
+            }
+        return {label: result[label] for label in sorted(result, reverse=True)}
+
+    def get_formulation_map(self):
+        """Product name (stripped, lower) -> Formulation code (upper) from REF_INTRANTS. Cached per sheet version."""
+        return self._derived_cache("formulation_map", "REF_INTRANTS", self._build_formulation_map)
+
+    def _build_formulation_map(self):
+        # Load Ref Intrants (User said 'REF_INTRANTS' has the data)
+        df_ref = self.get_intrants()
+        
+        # Create a mapping Product -> Formulation
+        # Assuming cols in REF_INTRANTS: 'Nom_Intrant', 'Formulation'
+        # User insists on 'Formulation' column only.
+        if df_ref.empty:
+            return {}
+        
+        # We look for a column that contains "Formulation" (case insensitive)
+        target_col = next((col for col in df_ref.columns if "formulation" in str(col).lower()), None)
+        
+        # Name is 'Nom_Produit' based on debug output
+        name_col = 'Nom_Produit' if 'Nom_Produit' in df_ref.columns else 'Nom_Intrant'
+        if name_col not in df_ref.columns:
+            return {}
+        
+        names = df_ref[name_col].fillna("").astype(str).str.strip().str.lower()
+        if target_col:
+            forms = df_ref[target_col].fillna("").astype(str).str.strip().str.upper()
+        else:
+            forms = pd.Series("", index=df_ref.index)
+        
+        # Last occurrence wins (same as successive dict assignments)
+        return dict(zip(names[names != ""].tolist(), forms[names != ""].tolist()))
+
+    def prep_sheet_payload(self, mix):
+        """
+        Builds the ReportGenerator.generate_prep_sheet payload of a planned mix (see get_planned_mixes):
+        parcels, total surface, volume/ha, products sorted by formulation rank and the QR intervention ID.
+        """
+        parcelles_info = [dict(p) for p in mix['Parcelles']]
+        p_ids = [str(p['name']) for p in parcelles_info]
+        
+        date_obj = mix['Date']
+        if pd.notnull(date_obj):
+            clean_date = date_obj.strftime('%Y%m%d')
+        else:
+            date_obj = mix['Products'][0].get('Date')
+            clean_date = "00000000"
+        
+        return {
+            'Parcelles': parcelles_info,
+            'Total_Surface': sum(p['surface'] for p in parcelles_info),
+            'Date': date_obj,
+            'Volume_Bouillie_Ha': mix['Volume_Bouillie_Ha'],
+            'Products': self.sort_products_by_formulation([dict(r) for r in mix['Products']]),
+            'Intervention_ID': f"{'|'.join(p_ids)}_{clean_date}"
+        }
+
     def sort_products_by_formulation(self, products_list):
         """
         Sorts a list of product dicts based on formulation priority.
@@ -232,35 +464,8 @@ class DataLoader:
         4. EC (Emulsions)
         5. SL (Liquides)
         """
-        # Load Ref Intrants (User said 'REF_INTRANTS' has the data)
-        df_ref = self.get_intrants()
-        
-        # Load Ref Intrants (User said 'REF_INTRANTS' has the data)
-        df_ref = self.get_intrants()
-        
-        # Create a mapping Product -> Formulation
-        # Assuming cols in REF_INTRANTS: 'Nom_Intrant', 'Formulation'
-        # User insists on 'Formulation' column only.
-        form_map = {}
-        if not df_ref.empty:
-            # Normalize cols to match user request exactly
-            # We look for a column that contains "Formulation" (case insensitive)
-            target_col = None
-            for col in df_ref.columns:
-                if "formulation" in str(col).lower():
-                    target_col = col
-                    break
-            
-            # If not found, double check 'Type' just in case but prioritize Formulation
-            if not target_col:
-                target_col = 'Formulation' # Hope for the best or it will be empty
-                
-            for _, row in df_ref.iterrows():
-                # Name is 'Nom_Produit' based on debug output
-                p_name_ref = str(row.get('Nom_Produit', row.get('Nom_Intrant', ''))).strip().lower()
-                form_val = str(row.get(target_col, '')).strip().upper()
-                if p_name_ref:
-                    form_map[p_name_ref] = form_val
+        # Product -> Formulation from REF_INTRANTS (built once per sheet version, shared by batch sheets)
+        form_map = self.get_formulation_map()
         
         # Define Priority
         # We need to map actual codes (WG, EC...) to 1, 2, 3...
@@ -293,6 +498,46 @@ class DataLoader:
             
         return sorted(products_list, key=get_rank)
 
+    @staticmethod
+    def _qr_target_mask(df, intervention_id):
+        """
+        Rows targeted by a preparation sheet QR ID "PARCELLE1|PARCELLE2_YYYYMMDD": planned treatments
+        of those parcels on that date. Returns (mask, status_col); mask is None if the ID is malformed,
+        status_col is None if no status column exists.
+        """
+        # Helper to parse ID
+        # Let's assume ID is "P_DATE" e.g. "Parcelle1_20240415"
+        # FIX: Use rsplit to allow underscores in Parcelle Name
+        # (If parcelle is "A2_Buissons", ID is "A2_Buissons_20240415", rsplit gives ["A2_Buissons", "20240415"])
+        status_col = next((c for c in ['Statut_Intervention', 'Statut', 'Etat'] if c in df.columns), None)
+        parts = str(intervention_id).rsplit('_', 1)
+        if len(parts) < 2 or status_col is None:
+            return None, status_col
+        
+        p_targets = parts[0].split('|')
+        d_target_str = parts[1] # YYYYMMDD
+        
+        m_p = df['ID_Parcelle'].astype(str).isin(p_targets)
+        m_n = df['Nature_Intervention'] == 'Traitement'
+        m_s = df[status_col].astype(str).str.lower().str.startswith('prév')
+        mask = m_p & m_n & m_s
+        
+        # Dates parsed only on the candidate rows (a few per parcel), not over the whole journal
+        dates = pd.to_datetime(df.loc[mask, 'Date'], errors='coerce', dayfirst=True)
+        mask.loc[mask] = (dates.dt.strftime('%Y%m%d') == d_target_str).to_numpy()
+        return mask, status_col
+
+    def get_qr_intervention_rows(self, intervention_id):
+        """Planned treatment rows a preparation sheet QR code will validate (empty if none)."""
+        df = self._get_data("JOURNAL_INTERVENTION")
+        if df.empty:
+            return pd.DataFrame()
+        mask, _ = self._qr_target_mask(df, intervention_id)
+        if mask is None:
+            return pd.DataFrame()
+        return df[mask]
+
+    @perf.timed("DataLoader")
     def update_intervention_status(self, intervention_id, new_status="Réalisé"):
         """
         Updates the status of an intervention (or group) in the source.
@@ -322,55 +567,20 @@ class DataLoader:
             # OR specific row ID. 
             # Given the Phyto Sheet is for a MIX (Bouillie), it applies to multiple rows (one per product).
             # So updating by Parcelle + Date + Nature='Traitement' is the logical action.
+            mask, status_col = self._qr_target_mask(df, intervention_id)
+            if status_col is None:
+                st.error("Colonne 'Statut_Intervention', 'Statut' ou 'Etat' introuvable dans JOURNAL_INTERVENTION.")
+                return False
+            if mask is None:
+                return False
             
-            # Helper to parse ID
-            # Let's assume ID is "P_DATE" e.g. "Parcelle1_20240415"
-            # FIX: Use rsplit to allow underscores in Parcelle Name
-            # (If parcelle is "A2_Buissons", ID is "A2_Buissons_20240415", rsplit gives ["A2_Buissons", "20240415"])
-            parts = intervention_id.rsplit('_', 1) 
-            if len(parts) < 2: return False
-            
-            p_targets_str = parts[0]
-            d_target_str = parts[1] # YYYYMMDD
-            
-            p_targets = p_targets_str.split('|')
-            
-            # Normalize Date in DF
-            df['Date'] = pd.to_datetime(df['Date'], errors='coerce', dayfirst=True)
-            
-            # Determine Status Column
-            status_col = 'Statut_Intervention'
-            if 'Statut_Intervention' not in df.columns:
-                if 'Statut' in df.columns:
-                    status_col = 'Statut'
-                elif 'Etat' in df.columns:
-                    status_col = 'Etat'
-                else:
-                    st.error("Colonne 'Statut_Intervention', 'Statut' ou 'Etat' introuvable dans JOURNAL_INTERVENTION.")
-                    return False
-
-            # Filter
-            # Flexible Match
-            # Date Matching (Flexible)
-            df['Target_Date_Str'] = df['Date'].dt.strftime('%Y%m%d')
-            
-            m_p = df['ID_Parcelle'].isin(p_targets)
-            m_d = df['Target_Date_Str'] == d_target_str
-            m_n = df['Nature_Intervention'] == 'Traitement'
-            m_s = df[status_col].astype(str).str.lower().str.startswith('prév')
-            
-            mask = m_p & m_d & m_n & m_s
-                   
             if not df[mask].empty:
                 # Update
                 df.loc[mask, status_col] = new_status
                 
-                # Cleanup temporary column
-                if 'Target_Date_Str' in df.columns:
-                     df = df.drop(columns=['Target_Date_Str'])
-                     
                 # Write back
                 self.conn.update(worksheet="JOURNAL_INTERVENTION", data=df, spreadsheet="MASTER_EXPLOITATION")
+                self.invalidate_sheets("JOURNAL_INTERVENTION")
                 return True
             else:
                 st.warning("Aucune intervention correspondante trouvée (ou déjà réalisée).")
@@ -380,9 +590,32 @@ class DataLoader:
             st.error(f"Erreur mise à jour: {e}")
             return False
 
+    ID_ALPHABET = np.array(list(string.ascii_uppercase + string.digits))
+
+    @classmethod
+    def new_intervention_ids(cls, n, existing=()):
+        """
+        Generates n distinct 8-character IDs (A-Z, 0-9), none of them in `existing`, in vectorized draws.
+        The generator is seeded from the OS (secrets), not from the process-wide random state, so
+        concurrent submitters and worker processes never share a sequence.
+        """
+        rng = np.random.default_rng(secrets.randbits(128))
+        taken = set(map(str, existing))
+        ids = []
+        while len(ids) < n:
+            draw = rng.integers(0, len(cls.ID_ALPHABET), size=(n - len(ids), 8))
+            candidates = pd.Series(cls.ID_ALPHABET[draw].view("<U8").ravel()).drop_duplicates()
+            candidates = candidates[~candidates.isin(taken)].tolist()
+            ids.extend(candidates)
+            taken.update(candidates)
+        return ids[:n]
+
+    @perf.timed("DataLoader")
     def bulk_insert_interventions(self, df_to_append):
         """
         Appends multiple new intervention rows to the JOURNAL_INTERVENTION sheet.
+        ID_Intervention values already present in the sheet (e.g. written by a concurrent submitter
+        since the IDs were drawn) or repeated in the batch are redrawn against the fresh sheet.
         """
         if not self.conn:
             st.error("Insertion impossible en local (Lecture seule).")
@@ -392,6 +625,15 @@ class DataLoader:
             # 1. Read existing data
             df_existing = self.conn.read(worksheet="JOURNAL_INTERVENTION", ttl=0, spreadsheet="MASTER_EXPLOITATION")
             
+            if "ID_Intervention" in df_to_append.columns:
+                existing_ids = df_existing["ID_Intervention"].dropna().astype(str) if "ID_Intervention" in df_existing.columns else pd.Series(dtype=str)
+                new_ids = df_to_append["ID_Intervention"].astype(str)
+                clash = new_ids.isin(existing_ids) | new_ids.duplicated()
+                if clash.any():
+                    df_to_append = df_to_append.copy()
+                    df_to_append.loc[clash, "ID_Intervention"] = self.new_intervention_ids(
+                        int(clash.sum()), existing=pd.concat([existing_ids, new_ids[~clash]]))
+            
             # 2. Append new data
             # Use pd.concat for pandas >= 1.4.0 instead of append
             df_updated = pd.concat([df_existing, df_to_append], ignore_index=True)
@@ -399,6 +641,7 @@ class DataLoader:
             # 3. Write back
             # Streamlit GSheets update replaces the entire worksheet's data with the dataframe
             self.conn.update(worksheet="JOURNAL_INTERVENTION", data=df_updated, spreadsheet="MASTER_EXPLOITATION")
+            self.invalidate_sheets("JOURNAL_INTERVENTION")
             return True
             
         except Exception as e:
@@ -416,43 +659,8 @@ class DataLoader:
         Sinon, la ligne est ajoutée en bas.
         Fonctionne uniquement en mode Cloud.
         """
-        if not self.conn:
-            st.error("Écriture impossible en local (Lecture seule).")
-            return False
-        try:
-            df = self.conn.read(worksheet="REF_INTRANTS", ttl=0, spreadsheet="MASTER_EXPLOITATION")
-            nom = str(intrant_dict.get("Nom_Produit", "")).strip().upper()
-
-            # S'assurer que toutes les colonnes du dict existent dans le df
-            for col in intrant_dict:
-                if col not in df.columns:
-                    df[col] = ""
-
-            # Chercher une ligne existante par le nouveau nom ou l'ancien nom recherché
-            mask = df["Nom_Produit"].astype(str).str.strip().str.upper() == nom
-            if original_name:
-                orig_nom = str(original_name).strip().upper()
-                if orig_nom:
-                    mask = mask | (df["Nom_Produit"].astype(str).str.strip().str.upper() == orig_nom)
-
-            new_row = pd.DataFrame([intrant_dict])
-
-            if mask.any():
-                # Remplacer les cellules de la ligne existante pour écraser les vieilles données
-                idx = df[mask].index[0]
-                for col in intrant_dict:
-                    df.at[idx, col] = intrant_dict[col]
-            else:
-                # Ajouter une nouvelle ligne
-                df = pd.concat([df, new_row], ignore_index=True)
-
-            self.conn.update(worksheet="REF_INTRANTS", data=df, spreadsheet="MASTER_EXPLOITATION")
-            self._cache.pop("REF_INTRANTS", None)  # Invalider le cache local
-            st.cache_data.clear() # Force Streamlit GSheetsConnection to drop its TTL cache
-            return True
-        except Exception as e:
-            st.error(f"Erreur écriture REF_INTRANTS : {e}")
-            return False
+        original_names = {0: original_name} if original_name else None
+        return self.sync_phyto_refs([intrant_dict], original_names=original_names)
 
     def update_usages_phyto(self, n_amm: str, usages: list[dict]) -> bool:
         """
@@ -460,34 +668,118 @@ class DataLoader:
         par la nouvelle liste fournie.
         Crée l'onglet s'il n'existe pas encore.
         """
+        return self.sync_phyto_refs(usages_by_amm={n_amm: usages})
+
+    @perf.timed("DataLoader")
+    def sync_phyto_refs(self, intrants: list[dict] = None, usages_by_amm: dict = None,
+                        original_names: dict = None) -> bool:
+        """
+        Synchronisation en lot de REF_INTRANTS et REF_USAGES_PHYTO : chaque onglet concerné
+        est lu une fois (ttl=0), le diff est calculé localement puis écrit en une seule mise à jour.
+        - intrants       : lignes REF_INTRANTS, upsert par Nom_Produit (la dernière l'emporte en cas de doublon)
+        - usages_by_amm  : {N_AMM: [usages]}, remplace tous les usages existants de chaque N_AMM
+        - original_names : {position dans intrants: ancien nom} pour écraser une ligne renommée
+        Seuls ces deux onglets sont invalidés. Fonctionne uniquement en mode Cloud.
+        """
         if not self.conn:
             st.error("Écriture impossible en local (Lecture seule).")
             return False
-        try:
+        intrants = intrants or []
+        usages_by_amm = usages_by_amm or {}
+        original_names = original_names or {}
+
+        if intrants:
             try:
-                df = self.conn.read(worksheet="REF_USAGES_PHYTO", ttl=0, spreadsheet="MASTER_EXPLOITATION")
-            except Exception:
-                # Onglet inexistant : on part d'un DataFrame vide
-                df = pd.DataFrame()
-
-            # Supprimer les anciens usages pour ce N_AMM
-            if not df.empty and "N_AMM" in df.columns:
-                df = df[df["N_AMM"].astype(str).str.strip() != str(n_amm).strip()]
-
-            # S'assurer des colonnes
-            new_df = pd.DataFrame(usages)
-            for col in new_df.columns:
-                if col not in df.columns:
-                    df[col] = ""
-
-            df = pd.concat([df, new_df], ignore_index=True)
-            self.conn.update(worksheet="REF_USAGES_PHYTO", data=df, spreadsheet="MASTER_EXPLOITATION")
-            self._cache.pop("REF_USAGES_PHYTO", None)
-            st.cache_data.clear() # Force Streamlit GSheetsConnection to drop its TTL cache
-            return True
-        except Exception as e:
-            st.error(f"Erreur écriture REF_USAGES_PHYTO : {e}")
-            return False
+                df = self.conn.read(worksheet="REF_INTRANTS", ttl=0, spreadsheet="MASTER_EXPLOITATION")
+                df = self._upsert_intrants(df, intrants, original_names)
+                self.conn.update(worksheet="REF_INTRANTS", data=df, spreadsheet="MASTER_EXPLOITATION")
+                self.invalidate_sheets("REF_INTRANTS")
+            except Exception as e:
+                st.error(f"Erreur écriture REF_INTRANTS : {e}")
+                return False
+
+        if usages_by_amm:
+            try:
+                try:
+                    df = self.conn.read(worksheet="REF_USAGES_PHYTO", ttl=0, spreadsheet="MASTER_EXPLOITATION")
+                except Exception:
+                    # Onglet inexistant : on part d'un DataFrame vide
+                    df = pd.DataFrame()
+
+                # Supprimer les anciens usages des N_AMM synchronisés
+                amms = {str(a).strip() for a in usages_by_amm}
+                if not df.empty and "N_AMM" in df.columns:
+                    df = df[~df["N_AMM"].astype(str).str.strip().isin(amms)]
+
+                new_df = pd.DataFrame([u for usages in usages_by_amm.values() for u in usages])
+                df = pd.concat([df, new_df], ignore_index=True)
+                self.conn.update(worksheet="REF_USAGES_PHYTO", data=df, spreadsheet="MASTER_EXPLOITATION")
+                self.invalidate_sheets("REF_USAGES_PHYTO")
+            except Exception as e:
+                st.error(f"Erreur écriture REF_USAGES_PHYTO : {e}")
+                return False
+        return True
+
+    @staticmethod
+    def _upsert_intrants(df: pd.DataFrame, intrants: list[dict], original_names: dict) -> pd.DataFrame:
+        """Upsert vectorisé des lignes REF_INTRANTS : cellules fournies écrasées, nouveaux produits ajoutés."""
+        new_rows = pd.DataFrame(intrants)
+        key = lambda s: s.fillna("").astype(str).str.strip().str.upper()
+        new_rows["_key"] = key(new_rows["Nom_Produit"])
+        new_rows["_orig"] = key(pd.Series([original_names.get(i, "") for i in range(len(new_rows))]))
+        new_rows = new_rows.drop_duplicates("_key", keep="last")
+
+        # S'assurer que toutes les colonnes fournies existent dans le df
+        cols = [c for c in new_rows.columns if c not in ("_key", "_orig")]
+        for col in cols:
+            if col not in df.columns:
+                df[col] = ""
+        df = df.astype({col: object for col in cols})
+
+        # Ligne existante : par le nouveau nom, sinon par l'ancien nom recherché
+        existing = key(df["Nom_Produit"]) if "Nom_Produit" in df.columns else pd.Series(dtype=str)
+        first_idx = pd.Series(existing.index, index=existing.values)
+        first_idx = first_idx[~first_idx.index.duplicated()]
+        target = new_rows["_key"].map(first_idx)
+        target = target.fillna(new_rows["_orig"].where(new_rows["_orig"] != "").map(first_idx))
+
+        matched = target.notna()
+        if matched.any():
+            # Plusieurs lignes visant la même ligne existante : la dernière l'emporte
+            updates = new_rows[matched].assign(_target=target[matched].astype(int)).drop_duplicates("_target", keep="last")
+            updates = updates.set_index("_target")[cols]
+            # Clés absentes d'un dict (NaN) : la cellule existante est conservée
+            df.loc[updates.index, cols] = updates.combine_first(df.loc[updates.index, cols])[cols]
+        return pd.concat([df, new_rows.loc[~matched, cols]], ignore_index=True)
+
+    def get_usages_index(self) -> dict:
+        """
+        Dictionary index of REF_USAGES_PHYTO, built once per sheet version:
+        - "cibles": NOM_PRODUIT (upper) -> sorted list of targets
+        - "doses" : (NOM_PRODUIT, Cible) -> (Dose_Max float or None, Unite_Dose); first usage wins
+        Lookups for the entry form are then O(1) whatever the size of the sheet.
+        """
+        return self._derived_cache("usages_index", "REF_USAGES_PHYTO", self._build_usages_index)
+
+    def _build_usages_index(self):
+        df = self.get_usages_phyto()
+        index = {"cibles": {}, "doses": {}}
+        if not df.empty and "Nom_Produit" in df.columns and "Cible" in df.columns:
+            usages = pd.DataFrame({
+                "Nom": df["Nom_Produit"].fillna("").astype(str).str.upper(),
+                "Cible": df["Cible"].fillna("").astype(str),
+                "Dose": pd.to_numeric(df["Dose_Max"], errors="coerce") if "Dose_Max" in df.columns else float("nan"),
+                "Unite": df["Unite_Dose"] if "Unite_Dose" in df.columns else None,
+            })
+            first = usages.drop_duplicates(["Nom", "Cible"])
+            cibles = first[first["Cible"].str.strip() != ""].sort_values("Cible", kind="stable")
+            for nom, cible in zip(cibles["Nom"].tolist(), cibles["Cible"].tolist()):
+                index["cibles"].setdefault(nom, []).append(cible)
+            index["doses"] = {
+                (nom, cible): (None if pd.isna(dose) else float(dose), unite)
+                for nom, cible, dose, unite in zip(first["Nom"].tolist(), first["Cible"].tolist(), first["Dose"].tolist(), first["Unite"].tolist())
+            }
+        return index
 
     def get_usages_phyto(self, n_amm: str = None) -> pd.DataFrame:
         """
@@ -498,3 +790,199 @@ class DataLoader:
         if not df.empty and n_amm and "N_AMM" in df.columns:
             df = df[df["N_AMM"].astype(str).str.strip() == str(n_amm).strip()]
         return df
+
+    # -----------------------------------------------------------------------
+    # CONFORMITÉ RÉGLEMENTAIRE — JOURNAL_INTERVENTION vs usages homologués
+    # -----------------------------------------------------------------------
+
+    # Unités de dose ramenées à une base commune : (base, facteur)
+    DOSE_UNITS = {
+        "L/HA": ("L/HA", 1.0), "ML/HA": ("L/HA", 0.001), "HL/HA": ("L/HA", 100.0),
+        "KG/HA": ("KG/HA", 1.0), "G/HA": ("KG/HA", 0.001), "T/HA": ("KG/HA", 1000.0),
+        "L": ("L/HA", 1.0), "KG": ("KG/HA", 1.0),  # unité saisie sans "/ha" dans le journal
+    }
+    HARVEST_NATURES = ["Récolte", "Moisson"]
+
+    @staticmethod
+    def _norm_key(s: pd.Series) -> pd.Series:
+        """Vectorized key normalization: no accents, upper case, single spaces, '(Réf: ...)' suffix dropped."""
+        s = s.fillna("").astype(str).str.replace(r"\s*\(R[ée]f\s*:[^)]*\)\s*$", "", regex=True)
+        s = s.str.normalize("NFKD").str.encode("ascii", errors="ignore").str.decode("ascii")
+        return s.str.upper().str.split().str.join(" ")
+
+    @staticmethod
+    def _to_number(s: pd.Series) -> pd.Series:
+        """'1,5' / '1.5' / '' → float (NaN if not numeric)."""
+        return pd.to_numeric(s.astype(str).str.replace(",", ".", regex=False).str.strip(), errors="coerce")
+
+    @classmethod
+    def _dose_base(cls, dose: pd.Series, unit: pd.Series):
+        """Returns (dose in base unit, base unit) so that g/ha vs kg/ha or mL/ha vs L/ha compare."""
+        key = unit.fillna("").astype(str).str.upper().str.replace(" ", "", regex=False)
+        base = key.map(lambda u: cls.DOSE_UNITS.get(u, (None, float("nan"))))
+        return cls._to_number(dose) * base.str[1].astype(float), base.str[0]
+
+    @perf.timed("DataLoader")
+    def check_compliance(self, campaign=None, ephy_fetcher=None) -> pd.DataFrame:
+        """
+        Compliance alerts (cf. _build_compliance), memoized until JOURNAL_INTERVENTION, REF_INTRANTS,
+        REF_USAGES_PHYTO or the loaded E-Phy version change.
+        campaign: a single campaign, a list of campaigns, or None for the full history.
+        """
+        if campaign is not None:
+            campaign = tuple(sorted({int(c) for c in campaign})) if isinstance(campaign, (list, tuple, set)) else (int(campaign),)
+        ephy_version = ephy_fetcher.version if ephy_fetcher is not None else None
+        return self._derived_cache(
+            "compliance", ("JOURNAL_INTERVENTION", "REF_INTRANTS", "REF_USAGES_PHYTO"),
+            lambda campaigns, _ephy_version: self._build_compliance(campaigns, ephy_fetcher),
+            campaign, ephy_version,
+        )
+
+    def _build_compliance(self, campaigns=None, ephy_fetcher=None) -> pd.DataFrame:
+        """
+        Cross-checks every 'Traitement' row of JOURNAL_INTERVENTION against the authorised usages
+        (REF_USAGES_PHYTO, completed by E-Phy when ephy_fetcher is given) in one vectorized pass.
+        campaigns: tuple of campaigns, or None for the full history.
+
+        Controls:
+        - Dose       : Dose_Ha above Dose_Max of the usage (units converted, skipped if incompatible)
+        - Nb applications : n-th completed application of a product on a parcel beyond Nb_Applications_Max
+          ('Nb applications (prévu)' when a planned treatment would exceed it once done)
+        - AMM retirée : Etat_AMM withdrawn in REF_INTRANTS / E-Phy
+        - DAR        : fewer days than the DAR between the treatment and the parcel's first harvest
+
+        The usage is matched on (N_AMM, Culture, Cible); when the journal culture/target does not
+        match E-Phy wording, the most permissive limits of the AMM for that culture (then of the AMM) apply.
+        Returns one row per alert: Campagne, Date, ID_Parcelle, Culture, Nom_Produit, N_AMM,
+        Controle, Valeur, Limite (numeric, empty for the AMM check), Etat_AMM, Detail, ID_Intervention.
+        """
+        cols = ["Campagne", "Date", "ID_Parcelle", "Culture", "Nom_Produit", "N_AMM",
+                "Controle", "Valeur", "Limite", "Etat_AMM", "Detail", "ID_Intervention"]
+        df = self.get_interventions()
+        if df.empty or "Nature_Intervention" not in df.columns or "Nom_Produit" not in df.columns:
+            return pd.DataFrame(columns=cols)
+
+        df = df.assign(Campagne=pd.to_numeric(df["Campagne"], errors="coerce").fillna(0).astype(int))
+        if campaigns is not None:
+            df = df[df["Campagne"].isin(campaigns)]
+        df = df.assign(Date=pd.to_datetime(df.get("Date"), errors="coerce", dayfirst=True))
+
+        for col in ["ID_Parcelle", "Culture", "Cible", "Num_AMM", "Dose_Ha", "Unité_Dose", "ID_Intervention"]:
+            if col not in df.columns:
+                df[col] = None
+        trt = df[df["Nature_Intervention"] == "Traitement"].copy()
+        if trt.empty:
+            return pd.DataFrame(columns=cols)
+
+        # --- 1. Identification du produit : Num_AMM, sinon REF_INTRANTS, sinon E-Phy ---
+        trt["Nom_Key"] = self._norm_key(trt["Nom_Produit"])
+        amm = trt["Num_AMM"].fillna("").astype(str).str.strip().str.replace(r"\.0$", "", regex=True)
+        amm = amm.where(~amm.str.lower().isin(["", "nan", "none"]))
+
+        df_ref = self.get_intrants()
+        ref_etat = pd.DataFrame(columns=["N_AMM", "Etat_AMM", "Date_Fin_AMM"])
+        if not df_ref.empty and "Nom_Produit" in df_ref.columns and "N_AMM" in df_ref.columns:
+            ref = df_ref.assign(Nom_Key=self._norm_key(df_ref["Nom_Produit"]),
+                                N_AMM=df_ref["N_AMM"].fillna("").astype(str).str.strip().str.replace(r"\.0$", "", regex=True))
+            ref = ref[ref["N_AMM"] != ""]
+            amm = amm.fillna(trt["Nom_Key"].map(ref.drop_duplicates("Nom_Key").set_index("Nom_Key")["N_AMM"]))
+            ref_etat = ref.reindex(columns=["N_AMM", "Etat_AMM", "Date_Fin_AMM"]).drop_duplicates("N_AMM")
+        if ephy_fetcher is not None and amm.isna().any():
+            amm = amm.fillna(ephy_fetcher.resolve_amm(trt["Nom_Produit"]))
+        trt["N_AMM"] = amm
+
+        # --- 2. Limites d'usage : REF_USAGES_PHYTO, complété par E-Phy pour les AMM absents ---
+        usages = self.get_usages_phyto()
+        usages = usages.copy() if not usages.empty and "N_AMM" in usages.columns else pd.DataFrame(columns=["N_AMM"])
+        usages["N_AMM"] = usages["N_AMM"].fillna("").astype(str).str.strip().str.replace(r"\.0$", "", regex=True)
+        if ephy_fetcher is not None:
+            missing = sorted(set(trt["N_AMM"].dropna()) - set(usages["N_AMM"]))
+            if missing:
+                usages = pd.concat([usages, ephy_fetcher.usages_for_amms(missing)], ignore_index=True)
+                ref_etat = pd.concat([ref_etat, ephy_fetcher.products_for_amms(missing)], ignore_index=True)
+        for col in ["Culture", "Cible", "Dose_Max", "Unite_Dose", "Nb_Applications_Max", "DAR"]:
+            if col not in usages.columns:
+                usages[col] = None
+
+        usages["Culture_Key"] = self._norm_key(usages["Culture"])
+        usages["Cible_Key"] = self._norm_key(usages["Cible"])
+        usages["Dose_Max_Base"], usages["Dose_Base_Unit"] = self._dose_base(usages["Dose_Max"], usages["Unite_Dose"])
+        usages["Napp_Max"] = self._to_number(usages["Nb_Applications_Max"])
+        usages["DAR_Jours"] = self._to_number(usages["DAR"])
+
+        # Plusieurs usages peuvent correspondre : on retient la limite la plus permissive
+        limits_agg = dict(Dose_Max_Base=("Dose_Max_Base", "max"), Dose_Base_Unit=("Dose_Base_Unit", "first"),
+                          Napp_Max=("Napp_Max", "max"), DAR_Jours=("DAR_Jours", "min"))
+        limit_cols = list(limits_agg)
+        trt["Culture_Key"] = self._norm_key(trt["Culture"])
+        trt["Cible_Key"] = self._norm_key(trt["Cible"])
+        limits = None
+        for keys in (["N_AMM", "Culture_Key", "Cible_Key"], ["N_AMM", "Culture_Key"], ["N_AMM"]):
+            level = usages.groupby(keys, as_index=False).agg(**limits_agg)
+            found = trt[keys].merge(level, on=keys, how="left").set_index(trt.index)[limit_cols]
+            limits = found if limits is None else limits.fillna(found)
+        trt[limit_cols] = limits
+        trt[["Dose_Max_Base", "Napp_Max", "DAR_Jours"]] = trt[["Dose_Max_Base", "Napp_Max", "DAR_Jours"]].astype(float)
+
+        # État de l'AMM (REF_INTRANTS / E-Phy), reporté sur chaque alerte
+        etat = ref_etat.dropna(subset=["N_AMM"]).drop_duplicates("N_AMM").set_index("N_AMM")
+        trt["Etat_AMM"] = trt["N_AMM"].map(etat["Etat_AMM"]).fillna("").astype(str)
+        fin_amm = trt["N_AMM"].map(etat["Date_Fin_AMM"]).fillna("").astype(str)
+
+        alerts = []
+        nan = pd.Series(np.nan, index=trt.index)
+        fmt = lambda v: v.map(lambda x: "" if pd.isna(x) else f"{x:g}")
+
+        def _alert(mask, controle, valeur, limite, detail):
+            if mask.any():
+                a = trt.loc[mask, ["Campagne", "Date", "ID_Parcelle", "Culture", "Nom_Produit", "N_AMM",
+                                   "Etat_AMM", "ID_Intervention"]].copy()
+                a["Controle"] = controle
+                a["Valeur"] = valeur[mask].values
+                a["Limite"] = limite[mask].values
+                a["Detail"] = detail[mask].values
+                alerts.append(a)
+
+        # --- 3. Dose au-dessus de la dose homologuée ---
+        dose, dose_unit = self._dose_base(trt["Dose_Ha"], trt["Unité_Dose"])
+        over_dose = (dose_unit == trt["Dose_Base_Unit"]) & (dose > trt["Dose_Max_Base"] * (1 + 1e-9))
+        _alert(over_dose, "Dose", dose.round(4), trt["Dose_Max_Base"],
+               "Dose " + fmt(dose.round(4)) + " " + dose_unit.fillna("") + " > max "
+               + fmt(trt["Dose_Max_Base"]) + " " + trt["Dose_Base_Unit"].fillna(""))
+
+        # --- 4. Nombre d'applications par parcelle × produit sur la campagne ---
+        # Seuls les traitements réalisés comptent ; un traitement prévu est signalé à part
+        # s'il dépasserait le maximum une fois réalisé (rang parmi réalisés + prévus).
+        status_col = next((c for c in ["Statut_Intervention", "Statut", "Etat"] if c in trt.columns), None)
+        planned = (trt[status_col].astype(str).str.strip().str.lower().str.startswith("prév")
+                   if status_col else pd.Series(False, index=trt.index))
+        order = trt.assign(Realise=(~planned).astype(int)).sort_values("Date", kind="stable")
+        by_product = order.groupby(["Campagne", "ID_Parcelle", order["N_AMM"].fillna(order["Nom_Key"])])
+        rank = (by_product.cumcount() + 1).where(order["Realise"] == 0, by_product["Realise"].cumsum())
+        trt["Rang_Application"] = rank.reindex(trt.index)
+        over_napp = trt["Rang_Application"] > trt["Napp_Max"]
+        _alert(over_napp & ~planned, "Nb applications", trt["Rang_Application"].astype(float), trt["Napp_Max"],
+               "Application n°" + trt["Rang_Application"].astype(str) + " > max " + fmt(trt["Napp_Max"]))
+        _alert(over_napp & planned, "Nb applications (prévu)", trt["Rang_Application"].astype(float), trt["Napp_Max"],
+               "Application prévue n°" + trt["Rang_Application"].astype(str) + " > max " + fmt(trt["Napp_Max"]))
+
+        # --- 5. AMM retirée ---
+        retired = trt["Etat_AMM"].str.upper().str.contains("RETIR", regex=False)
+        _alert(retired, "AMM retirée", nan, nan,
+               "AMM " + trt["N_AMM"].fillna("").astype(str) + " : " + trt["Etat_AMM"] + " (fin " + fin_amm + ")")
+
+        # --- 6. DAR : délai entre le traitement et la première récolte de la parcelle ---
+        harvests = df[df["Nature_Intervention"].isin(self.HARVEST_NATURES)].dropna(subset=["Date"])
+        if not harvests.empty:
+            first_harvest = harvests.groupby(["Campagne", "ID_Parcelle"])["Date"].min().rename("Date_Recolte")
+            h = trt[["Campagne", "ID_Parcelle"]].join(first_harvest, on=["Campagne", "ID_Parcelle"])["Date_Recolte"]
+            delay = (h - trt["Date"]).dt.days
+            dar_violation = (delay >= 0) & (delay < trt["DAR_Jours"])
+            _alert(dar_violation, "DAR", delay.astype(float), trt["DAR_Jours"],
+                   "Récolte le " + h.dt.strftime("%d/%m/%Y").fillna("") + ", " + delay.astype("Int64").astype(str)
+                   + " j après traitement < DAR " + fmt(trt["DAR_Jours"]) + " j")
+
+        if not alerts:
+            return pd.DataFrame(columns=cols)
+        result = pd.concat(alerts, ignore_index=True)
+        return result.sort_values(["Campagne", "Date", "ID_Parcelle", "Controle"], kind="stable")[cols].reset_index(drop=True)
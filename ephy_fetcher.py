@@ -7,28 +7,171 @@ URL ZIP (UTF-8) : https://www.data.gouv.fr/api/1/datasets/r/cb51408e-2b97-43a4-9
 
 Fournit :
 - EphyFetcher.refresh()              → télécharge le ZIP si absent ou > 7 jours
+- EphyFetcher.refresh_async()        → idem en arrière-plan, bascule atomique de version du cache
 - EphyFetcher.search(nom_commercial) → retourne dict pour REF_INTRANTS + liste usages pour REF_USAGES_PHYTO
+- EphyFetcher.autocomplete(prefixe)  → suggestions de noms (index préfixe, repli flou)
+- EphyFetcher.match_products(noms)   → rapprochement en lot (nom, AMM, état) d'une liste de produits
+- EphyFetcher.products_with_substance(substance) → produits contenant une substance active
+- EphyFetcher.authorized_products(culture, cible)  → produits homologués pour un couple culture × cible
+- EphyFetcher.produits_as_of(date) / usages_as_of(date) / changelog(d1, d2) → historique des versions
+- EphyFetcher.substance_totals(df_journal)        → quantités de substances appliquées par campagne
 """
 
 import os
 import re
+import csv
+import time
+import bisect
+import shutil
+import threading
+import functools
+import contextlib
+import unicodedata
 import zipfile
 import io
+import copy
+import json
+import hashlib
 import logging
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
 from datetime import datetime, timedelta
 from rapidfuzz import process, fuzz
 
+import perf
+
 logger = logging.getLogger(__name__)
 
 # --- CONSTANTES ---
 EPHY_ZIP_URL = "https://www.data.gouv.fr/api/1/datasets/r/cb51408e-2b97-43a4-94e2-c0de5c3bf5b2"
 CACHE_DIR = os.path.join(os.path.dirname(__file__), "_ephy_cache")
-CACHE_PRODUITS = os.path.join(CACHE_DIR, "produits.parquet")
-CACHE_USAGES   = os.path.join(CACHE_DIR, "usages.parquet")
-CACHE_DATE_FILE = os.path.join(CACHE_DIR, "last_update.txt")
+# Chaque rafraîchissement écrit une nouvelle version complète dans VERSIONS_DIR/<horodatage>/,
+# puis bascule atomiquement le pointeur CURRENT_FILE (nom de la version active).
+VERSIONS_DIR = os.path.join(CACHE_DIR, "versions")
+CURRENT_FILE = os.path.join(CACHE_DIR, "current.txt")
+KEEP_VERSIONS = 2  # Versions conservées sur disque (l'active + la précédente)
+# Historique dédupliqué (indépendant des versions) : une ligne par état d'un produit/usage,
+# valide de Valid_From (inclus) à Valid_To (exclu, vide = état courant)
+HISTORY_DIR = os.path.join(CACHE_DIR, "history")
+HISTORY_PRODUITS_FILE = os.path.join(HISTORY_DIR, "produits_history.parquet")
+HISTORY_USAGES_FILE   = os.path.join(HISTORY_DIR, "usages_history.parquet")
+SNAPSHOTS_FILE        = os.path.join(HISTORY_DIR, "snapshots.txt")
+# Verrou inter-process de la mise à jour de l'historique (lecture → fusion → réécriture)
+HISTORY_LOCK_FILE     = os.path.join(HISTORY_DIR, "history.lock")
+HISTORY_LOCK_TIMEOUT  = 300   # Attente maximale du verrou (s)
+HISTORY_LOCK_STALE    = 1800  # Verrou plus ancien : process interrompu, verrou repris (s)
+HISTORY_IGNORED = ["Date_MAJ_Ephy"]  # Colonnes recalculées à chaque rafraîchissement, hors comparaison
+# Fichiers d'une version du cache
+PRODUITS_FILE = "produits.parquet"
+USAGES_FILE   = "usages.parquet"
+NOMS_FILE     = "noms.parquet"
+SUBSTANCES_FILE = "substances.parquet"
+# Copies Arrow IPC non compressées, mappées en mémoire (pages partagées entre sessions et process)
+SHARED_PRODUITS_FILE = "produits.arrow"
+SHARED_USAGES_FILE   = "usages.arrow"
+DATE_FILE = "last_update.txt"  # Cache historique sans manifeste
+# Manifeste écrit en dernier : version de schéma, lignes, hash du ZIP source, taille + sha256 par fichier,
+# plus son propre checksum. Une version sans manifeste valide est considérée absente et reconstruite.
+MANIFEST_FILE = "manifest.json"
+CACHE_SCHEMA_VERSION = 2  # À incrémenter à chaque changement de colonnes / format des fichiers du cache
+# Fichiers dont le sha256 est vérifié à chaque démarrage (petits) ; les autres au contrôle complet
+STARTUP_CHECKSUM_FILES = [NOMS_FILE, SUBSTANCES_FILE]
+CACHE_COMPRESSION = "zstd"
+# Colonnes produits lues au démarrage (Noms_Secondaires ne sert qu'à construire l'index des noms, persisté)
+PRODUITS_UI_COLUMNS = [
+    "Nom_Produit", "N_AMM", "Type", "Formulation", "Titulaire_AMM", "Matieres_Actives", "Concentration",
+    "Etat_AMM", "Date_Fin_AMM", "Classement_CMR", "Lien_Ephy", "Date_MAJ_Ephy", "DAR", "ZNT_Aqua", "DVP",
+    "Dose_Max_Homologuee", "Unité_utilisation", "Nb_Applications_Max_An", "Culture", "Mentions_Danger",
+    "ZNT_Riverains",
+]
 REFRESH_DAYS = 60  # Rafraîchissement tous les 2 mois
+MIN_SCORE = 40     # Score WRatio minimal pour retenir une correspondance
+MATCH_CHUNK = 256  # Requêtes scorées par matrice cdist (borne la mémoire)
+SEARCH_CACHE_SIZE = 128  # Résultats de search() conservés (LRU), vidés à chaque changement de version
+NOMS_COLUMNS = ["Nom", "Nom_Upper", "Nom_Norm", "Idx", "Etat_Rank"]
+NOMS_PRODUITS_KEY = b"produits_sha256"  # Métadonnée de noms.parquet : sha256 du produits.parquet indexé
+USAGES_ROW_GROUP = 5000  # Taille cible des row groups de usages.parquet (coupés entre deux AMM)
+ENCODING_SAMPLE = 64 * 1024  # Octets lus pour détecter l'encodage d'un CSV
+SUBSTANCES_COLUMNS = ["N_AMM", "Substance", "Substance_EN", "Substance_Norm", "Concentration", "Unite_Concentration"]
+
+# Segment de Matieres_Actives : "diméthoate (Dimethoate) 400.0 g/L"
+SUBSTANCE_PATTERN = re.compile(
+    r"^(?P<Substance>.+?)\s*(?:\((?P<Substance_EN>[^()]*)\))?\s*"
+    r"(?:(?P<Concentration>\d+(?:[.,]\d+)?)\s*(?P<Unite_Concentration>\S+))?$"
+)
+# Unité de concentration → (unité de quantité produit attendue, grammes de substance par unité de concentration)
+CONCENTRATION_UNITS = {
+    "G/L":   ("L", 1.0),
+    "MG/L":  ("L", 0.001),
+    "G/KG":  ("KG", 1.0),
+    "MG/KG": ("KG", 0.001),
+    "%":     ("KG", 10.0),  # % massique : 1 % de 1 kg = 10 g
+}
+# Unité de quantité produit (JOURNAL_INTERVENTION) → (unité de base, facteur)
+QUANTITY_UNITS = {"L": ("L", 1.0), "ML": ("L", 0.001), "KG": ("KG", 1.0), "G": ("KG", 0.001)}
+# Suffixe ajouté aux noms secondaires / PCP enregistrés dans REF_INTRANTS : "SPECTRUM (Réf: ISARD)"
+REF_SUFFIX_PATTERN = re.compile(r"\s*\(R[ée]f\s*:[^)]*\)\s*$", re.IGNORECASE)
+
+# Contraintes numériques extraites du libellé des conditions d'emploi
+# (colonne usages → motif, groupe 1 = valeur en mètres ou en heures)
+EMPLOI_CONSTRAINTS = {
+    "DVP":             re.compile(r"dispositif\s+v[é|e]g[é|e]tali?s?[é|e]?\s+permanent[^\d]*?(\d+)\s*m", re.IGNORECASE),
+    "ZNT_Arthropodes": re.compile(r"arthropodes\s+non\s+cibles?[^\d]*?(\d+)\s*m", re.IGNORECASE),
+    "ZNT_Plantes":     re.compile(r"plantes\s+non\s+cibles?[^\d]*?(\d+)\s*m", re.IGNORECASE),
+    "DRE":             re.compile(r"d[ée]lai\s+de\s+rentr[ée]e[^\d]*?(\d+)\s*h", re.IGNORECASE),
+}
+
+
+def _on_snapshot(method):
+    """
+    Exécute une lecture sur la version chargée (self._state), capturée une seule fois
+    pour tout l'appel : sans verrou, une bascule concurrente (cf. EphyFetcher._adopt)
+    ne fait que remplacer la référence, l'appel en cours garde sa version.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return method(self._state, *args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def _file_lock(path: str, timeout: float, stale: float):
+    """
+    Verrou exclusif entre process et threads : fichier créé avec O_EXCL (portable Windows / POSIX),
+    supprimé à la sortie. Un verrou plus ancien que stale secondes est considéré abandonné.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > stale:
+                    logger.warning(f"Verrou abandonné repris : {path}")
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue  # Libéré entre-temps
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Verrou occupé depuis plus de {timeout:.0f} s : {path}")
+            time.sleep(0.05)
+    try:
+        os.write(fd, str(os.getpid()).encode("ascii"))
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 
 # ---------------------------------------------------------------------------
@@ -40,13 +183,54 @@ REFRESH_DAYS = 60  # Rafraîchissement tous les 2 mois
 class EphyFetcher:
     """
     Gère le téléchargement, le parsing et l'indexation du référentiel E-Phy.
-    Conçu pour être instancié une seule fois (ex: dans app.py ou session Streamlit).
+    Conçu pour être instancié une seule fois par process (app.py : st.cache_resource)
+    et partagé en lecture seule par toutes les sessions. Les tables chargées depuis
+    le cache sont adossées aux fichiers Arrow mappés en mémoire (cf. _read_shared).
+    Un rafraîchissement se construit dans une instance séparée puis est adopté
+    d'un bloc : les recherches restent servies par la version précédente jusque-là.
+
+    La version servie est self._state : l'instance qui l'a chargée (elle-même tant que
+    rien n'a été adopté), jamais modifiée une fois adoptée. Les lectures publiques
+    s'exécutent sur cet instantané (_on_snapshot) ; seule la bascule prend le verrou.
     """
 
     def __init__(self, auto_refresh: bool = True):
-        os.makedirs(CACHE_DIR, exist_ok=True)
+        os.makedirs(VERSIONS_DIR, exist_ok=True)
+        # Protège la bascule de self._state et le cache de search() (jamais une lecture du référentiel)
+        self._swap_lock = threading.Lock()
+        self._refresh_thread: threading.Thread | None = None
+        self.last_refresh_ok: bool | None = None
+        # Dossier de la version chargée (cache à plat historique = CACHE_DIR, vide si rien de chargé)
+        self._version_dir: str = ""
+        # sha256 du ZIP E-Phy parsé (reporté dans le manifeste)
+        self._source_hash: str = ""
         self._df_produits: pd.DataFrame = pd.DataFrame()
         self._df_usages: pd.DataFrame = pd.DataFrame()
+        # N_AMM → (début, fin) : usages triés par AMM, chaque produit est une tranche contiguë
+        self._usages_offsets: dict[str, tuple[int, int]] = {}
+        # Index des noms pour la recherche floue (cf. _set_name_index)
+        self._df_noms: pd.DataFrame = pd.DataFrame()
+        self._noms: list[str] = []
+        self._noms_upper: list[str] = []
+        self._noms_idx: list[int] = []
+        self._noms_rank: list[int] = []
+        # Index préfixe (autocomplétion) : noms normalisés triés + position dans l'index des noms
+        self._prefix_keys: list[str] = []
+        self._prefix_pos: list[int] = []
+        # Nom normalisé → N_AMM (rapprochement exact des noms saisis dans le journal)
+        self._amm_by_nom: dict[str, str] = {}
+        # Table produit × substance × concentration + index inversé substance → N_AMM
+        self._df_substances: pd.DataFrame = pd.DataFrame(columns=SUBSTANCES_COLUMNS)
+        self._substance_index: dict[str, list[str]] = {}
+        # (culture, cible) normalisées → positions dans _df_usages ; culture → cibles connues
+        self._usage_index: dict[tuple[str, str], np.ndarray] = {}
+        self._cibles_by_culture: dict[str, list[str]] = {}
+        # (version, requête normalisée, top_n) → résultats de search() ; statistiques de hit
+        self._search_cache: OrderedDict = OrderedDict()
+        self._search_hits = 0
+        self._search_misses = 0
+        # Version servie (cf. _adopt) : instance de chargement immuable une fois adoptée
+        self._state: EphyFetcher = self
         if auto_refresh:
             self.refresh()
 
@@ -54,14 +238,17 @@ class EphyFetcher:
     # 1. TÉLÉCHARGEMENT & PARSING
     # ------------------------------------------------------------------
 
+    @perf.timed("EphyFetcher")
     def refresh(self, force: bool = False) -> bool:
         """
         Vérifie si le cache est à jour (< 7 jours).
-        Si non (ou force=True), télécharge le ZIP E-Phy et reparse les CSV.
+        Si non (ou force=True), télécharge le ZIP E-Phy, reparse les CSV dans une
+        nouvelle version du cache, bascule le pointeur "current" puis l'adopte.
         Retourne True si succès, False sinon.
         """
-        if not force and self._is_cache_fresh():
-            self._load_cache()
+        current_dir = self._current_dir()
+        if not force and self._is_cache_fresh(current_dir):
+            self._load_version(current_dir)
             logger.info("Cache E-Phy frais, chargement depuis le disque.")
             return True
 
@@ -70,36 +257,148 @@ class EphyFetcher:
             resp = requests.get(EPHY_ZIP_URL, timeout=60, stream=True)
             resp.raise_for_status()
             zip_bytes = io.BytesIO(resp.content)
-            self._parse_zip(zip_bytes)
-            self._save_cache()
-            self._write_date_file()
+            source_hash = hashlib.sha256(resp.content).hexdigest()
+
+            # ZIP identique à celui de la version active (intègre) : pas de reparse, seule la date est renouvelée
+            manifest = self._read_manifest(current_dir)
+            if manifest and manifest.get("source_sha256") == source_hash and self._validate_cache(current_dir, deep=True):
+                self._touch_manifest(current_dir)
+                self._load_version(current_dir)
+                logger.info("Référentiel E-Phy inchangé, version actuelle conservée.")
+                return True
+
+            staging = EphyFetcher(auto_refresh=False)
+            staging._source_hash = source_hash
+            staging._parse_zip(zip_bytes)
+            version_dir = staging._publish()
+            if not version_dir:
+                return False
+            self._load_version(version_dir)
             logger.info("Référentiel E-Phy mis à jour avec succès.")
             return True
         except requests.exceptions.RequestException as e:
             logger.error(f"Erreur téléchargement E-Phy: {e}")
-            # Fallback : charger le cache même périmé
-            if os.path.exists(CACHE_PRODUITS):
+            # Fallback : charger le cache même périmé, après contrôle complet (sha256 de tous les fichiers)
+            if os.path.exists(os.path.join(current_dir, PRODUITS_FILE)) and (
+                    not os.path.exists(os.path.join(current_dir, MANIFEST_FILE))  # cache historique sans manifeste
+                    or self._validate_cache(current_dir, deep=True)):
                 logger.warning("Utilisation du cache E-Phy périmé en fallback.")
-                self._load_cache()
+                self._load_version(current_dir)
                 return True
             return False
 
-    def _is_cache_fresh(self) -> bool:
-        if not os.path.exists(CACHE_DATE_FILE):
+    def refresh_async(self, force: bool = True) -> bool:
+        """
+        Lance refresh() dans un thread d'arrière-plan. Les recherches continuent
+        sur la version active jusqu'à la bascule. Retourne False si un
+        rafraîchissement est déjà en cours.
+        """
+        if self.refresh_in_progress:
+            return False
+        self._refresh_thread = threading.Thread(
+            target=self._refresh_background, args=(force,), name="ephy-refresh", daemon=True
+        )
+        self._refresh_thread.start()
+        return True
+
+    def _refresh_background(self, force: bool):
+        try:
+            self.last_refresh_ok = self.refresh(force=force)
+        except Exception as e:
+            logger.error(f"Erreur rafraîchissement E-Phy en arrière-plan: {e}")
+            self.last_refresh_ok = False
+
+    @property
+    def refresh_in_progress(self) -> bool:
+        return self._refresh_thread is not None and self._refresh_thread.is_alive()
+
+    @perf.timed("EphyFetcher")
+    def sync(self) -> bool:
+        """
+        Adopte la version "current" si elle a été basculée ailleurs (autre process).
+        Lecture d'un petit fichier : peut être appelé à chaque rerun.
+        """
+        current_dir = self._current_dir()
+        if self.refresh_in_progress or current_dir == self._state._version_dir:
+            return False
+        # Contrôle complet : une seule fois par version basculée
+        if not self._validate_cache(current_dir, deep=True):
             return False
-        if not os.path.exists(CACHE_PRODUITS):
+        self._load_version(current_dir)
+        return True
+
+    def _is_cache_fresh(self, version_dir: str) -> bool:
+        """Version complète et intègre (manifeste validé) et construite il y a moins de REFRESH_DAYS."""
+        if not self._validate_cache(version_dir):
             return False
         try:
-            with open(CACHE_DATE_FILE, "r") as f:
-                date_str = f.read().strip()
-            last_update = datetime.strptime(date_str, "%Y-%m-%d")
-            return (datetime.now() - last_update) < timedelta(days=REFRESH_DAYS)
+            created = datetime.strptime(self._read_manifest(version_dir)["created"], "%Y-%m-%d")
+            return (datetime.now() - created) < timedelta(days=REFRESH_DAYS)
         except Exception:
             return False
 
-    def _write_date_file(self):
-        with open(CACHE_DATE_FILE, "w") as f:
-            f.write(datetime.now().strftime("%Y-%m-%d"))
+    # --- Versions du cache -------------------------------------------------
+
+    @staticmethod
+    def _current_dir() -> str:
+        """Dossier de la version active (pointeur current.txt), CACHE_DIR si cache à plat historique."""
+        try:
+            with open(CURRENT_FILE, "r") as f:
+                version = f.read().strip()
+            if version and os.path.isdir(os.path.join(VERSIONS_DIR, version)):
+                return os.path.join(VERSIONS_DIR, version)
+        except OSError:
+            pass
+        return CACHE_DIR
+
+    def _publish(self) -> str | None:
+        """
+        Écrit les tables parsées dans un nouveau dossier de version, puis bascule
+        le pointeur current.txt (remplacement atomique). Retourne le dossier publié.
+        """
+        version = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        self._version_dir = os.path.join(VERSIONS_DIR, version)
+        os.makedirs(self._version_dir)
+        if not self._save_cache():
+            shutil.rmtree(self._version_dir, ignore_errors=True)
+            return None
+        try:
+            self._record_snapshot()
+        except Exception as e:
+            # L'historique ne doit pas bloquer la publication de la nouvelle version
+            logger.error(f"Erreur enregistrement historique E-Phy: {e}")
+
+        tmp_pointer = f"{CURRENT_FILE}.{os.getpid()}.tmp"
+        with open(tmp_pointer, "w") as f:
+            f.write(version)
+        os.replace(tmp_pointer, CURRENT_FILE)
+        self._prune_versions(keep=version)
+        return self._version_dir
+
+    @staticmethod
+    def _prune_versions(keep: str):
+        """Supprime les versions les plus anciennes au-delà de KEEP_VERSIONS."""
+        versions = sorted(v for v in os.listdir(VERSIONS_DIR) if os.path.isdir(os.path.join(VERSIONS_DIR, v)))
+        for old in versions[:-KEEP_VERSIONS]:
+            if old != keep:
+                # Sous Windows, une version encore mappée ne peut être supprimée : réessayée au prochain publish
+                shutil.rmtree(os.path.join(VERSIONS_DIR, old), ignore_errors=True)
+
+    def _load_version(self, version_dir: str):
+        """Charge une version du cache dans une instance séparée puis l'adopte d'un bloc."""
+        staging = EphyFetcher(auto_refresh=False)
+        staging._version_dir = version_dir
+        staging._load_cache()
+        self._adopt(staging)
+
+    def _adopt(self, other: "EphyFetcher"):
+        """
+        Sert désormais la version chargée par une autre instance : remplacement d'une seule
+        référence. Les lectures en cours terminent sur l'instantané qu'elles ont capturé.
+        """
+        with self._swap_lock:
+            self._state = other
+            self._search_cache.clear()
 
     def _parse_zip(self, zip_bytes: io.BytesIO):
         """
@@ -147,13 +446,19 @@ class EphyFetcher:
             logger.info(f"CSV danger: {danger_file}")
             logger.info(f"CSV PCP: {pcp_file}")
 
-            df_prod  = self._read_csv_from_zip(zf, produits_file)   if produits_file   else pd.DataFrame()
-            df_cond  = self._read_csv_from_zip(zf, conditions_file) if conditions_file else pd.DataFrame()
-            df_empl  = self._read_csv_from_zip(zf, emploi_file)     if emploi_file     else pd.DataFrame()
-            df_dang  = self._read_csv_from_zip(zf, danger_file)     if danger_file     else pd.DataFrame()
-            df_pcp   = self._read_csv_from_zip(zf, pcp_file)        if pcp_file        else pd.DataFrame()
+            # Décompression + parsing en parallèle (zlib et le lecteur CSV Arrow libèrent le GIL) :
+            # la durée totale est à peu près celle du plus gros fichier.
+            members = [produits_file, conditions_file, emploi_file, danger_file, pcp_file]
+            with ThreadPoolExecutor(max_workers=len(members), thread_name_prefix="ephy-csv") as pool:
+                futures = [pool.submit(self._read_csv_from_zip, zf, m) if m else None for m in members]
+                df_prod, df_cond, df_empl, df_dang, df_pcp = [
+                    f.result() if f else pd.DataFrame() for f in futures
+                ]
 
-        self._df_produits, self._df_usages = self._build_tables(df_prod, df_cond, df_empl, df_dang, df_pcp)
+        self._df_produits, df_usages = self._build_tables(df_prod, df_cond, df_empl, df_dang, df_pcp)
+        self._set_usages(df_usages)
+        self._set_name_index(self._build_name_index(self._df_produits))
+        self._set_substances(self._build_substances(self._df_produits))
 
     def _find_file(self, names: list, keywords: list, exclude: list = None) -> str | None:
         for name in names:
@@ -182,20 +487,59 @@ class EphyFetcher:
         return None
 
     def _read_csv_from_zip(self, zf: zipfile.ZipFile, filename: str) -> pd.DataFrame:
-        """Lit un CSV depuis un ZipFile avec gestion d'encodage."""
+        """
+        Lit un CSV depuis un ZipFile : le membre est décompressé une seule fois,
+        l'encodage est détecté sur un échantillon, puis le CSV est parsé par le
+        lecteur Arrow (repli sur le moteur pandas classique en cas d'échec).
+        """
         try:
-            for enc in ["utf-8", "latin-1", "cp1252"]:
-                try:
-                    with zf.open(filename) as f:
-                        df = pd.read_csv(f, sep=";", encoding=enc, dtype=str, low_memory=False)
-                    logger.debug(f"  {filename} lu ({enc}): {len(df)} lignes, colonnes: {list(df.columns)}")
-                    return df
-                except UnicodeDecodeError:
-                    continue
+            raw = zf.read(filename)
+            enc = self._detect_encoding(raw[:ENCODING_SAMPLE])
+            try:
+                df = self._parse_csv_arrow(raw, enc)
+            except UnicodeDecodeError:
+                # Octet non UTF-8 au-delà de l'échantillon
+                enc = "latin-1"
+                df = self._parse_csv_arrow(raw, enc)
+            except (pa.ArrowInvalid, ValueError) as e:
+                logger.warning(f"Lecture Arrow impossible pour {filename} ({e}), repli moteur pandas.")
+                df = pd.read_csv(io.BytesIO(raw), sep=";", encoding=enc, dtype=str, low_memory=False)
+            logger.debug(f"  {filename} lu ({enc}): {len(df)} lignes, colonnes: {list(df.columns)}")
+            return df
         except Exception as e:
             logger.error(f"Erreur lecture {filename}: {e}")
         return pd.DataFrame()
 
+    @staticmethod
+    def _detect_encoding(sample: bytes) -> str:
+        """UTF-8 (avec ou sans BOM) si l'échantillon se décode, sinon latin-1."""
+        try:
+            sample.decode("utf-8")
+        except UnicodeDecodeError as e:
+            # Caractère multi-octets coupé en fin d'échantillon : reste de l'UTF-8
+            if e.start < len(sample) - 3:
+                return "latin-1"
+        return "utf-8-sig"
+
+    @staticmethod
+    def _parse_csv_arrow(raw: bytes, encoding: str) -> pd.DataFrame:
+        """
+        Parse un CSV E-Phy (séparateur ';') avec pyarrow.csv, toutes colonnes en texte
+        comme dtype=str (aucune inférence : les AMM et doses gardent leur écriture).
+        """
+        first_line = raw[:ENCODING_SAMPLE].decode(encoding, errors="replace").splitlines()[0]
+        header = next(csv.reader([first_line], delimiter=";"))
+        table = pa_csv.read_csv(
+            io.BytesIO(raw),
+            read_options=pa_csv.ReadOptions(encoding=encoding),
+            parse_options=pa_csv.ParseOptions(delimiter=";", newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={col: pa.string() for col in header},
+                strings_can_be_null=True,
+            ),
+        )
+        return table.to_pandas()
+
     # ------------------------------------------------------------------
     # 2. CONSTRUCTION DES TABLES INDEXÉES
     # ------------------------------------------------------------------
@@ -226,20 +570,8 @@ class EphyFetcher:
         if not df_pcp.empty:
             logger.info(f"Colonnes CSV PCP ({len(df_pcp)}L): {list(df_pcp.columns)[:10]}")
 
-        # Extraction globale des DVP depuis les conditions d'emploi textuelles
-        dvp_map = {}
-        if df_empl is not None and not df_empl.empty:
-            c_amm_e = self._get_col(df_empl, "numero amm", "amm")
-            c_lib_e = self._get_col(df_empl, "condition d’emploi libelle", "libelle", "condition")
-            if c_amm_e and c_lib_e:
-                for amm, grp in df_empl.groupby(c_amm_e):
-                    dvps = []
-                    for txt in grp[c_lib_e].dropna():
-                        m = re.search(r"dispositif\s+v[é|e]g[é|e]tali?s?[é|e]?\s+permanent[^\d]*?(\d+)\s*m", txt, re.IGNORECASE)
-                        if m:
-                            dvps.append(int(m.group(1)))
-                    if dvps:
-                        dvp_map[str(amm)] = str(max(dvps))
+        # Extraction globale des contraintes (DVP, ZNT, DRE) depuis les conditions d'emploi textuelles
+        constraints = self._extract_emploi_constraints(df_empl)
 
         # --- Colonnes du CSV produits E-Phy (nouveau format 2026) ---
         c_nom   = self._get_col(df_prod, "nom produit", "nom commercial", "libelle", "denomination")
@@ -321,13 +653,23 @@ class EphyFetcher:
                     "Unite_Dose":          self._val(row, c_unit_d),
                     "Nb_Applications_Max": self._val(row, c_napp),
                     "DAR":                 self._val(row, c_dar_c),
-                    "DVP":                 self._val(row, c_dvp_c) or dvp_map.get(str(amm_u), None),
+                    "DVP":                 self._val(row, c_dvp_c),
                     "ZNT_Aqua":            self._val(row, c_znt_c),
                     "Etat_Usage":          self._val(row, c_etat_c),
                 })
 
             df_usages = pd.DataFrame(records_usages).reset_index(drop=True)
 
+            # Contraintes textuelles par AMM : DVP en repli, ZNT/DRE en colonnes dédiées
+            if not df_usages.empty:
+                amm_keys = df_usages["N_AMM"].astype(str)
+                for col in EMPLOI_CONSTRAINTS:
+                    from_emploi = amm_keys.map(constraints[col])
+                    if col in df_usages.columns:
+                        df_usages[col] = df_usages[col].fillna(from_emploi)
+                    else:
+                        df_usages[col] = from_emploi
+
             # Enrichir df_intrants avec ZNT/DAR/DVP agrégés depuis les usages
             if not df_usages.empty:
                 df_intrants = self._enrich_intrants(df_intrants, df_usages)
@@ -389,6 +731,32 @@ class EphyFetcher:
 
         return df_intrants, df_usages
 
+    def _extract_emploi_constraints(self, df_empl: pd.DataFrame) -> pd.DataFrame:
+        """
+        Extrait en une passe vectorisée les contraintes chiffrées (DVP, ZNT arthropodes,
+        ZNT plantes, DRE) du libellé des conditions d'emploi.
+        Retourne un DataFrame indexé par N_AMM (str), une colonne par contrainte (valeur max, str).
+        """
+        empty = pd.DataFrame(columns=list(EMPLOI_CONSTRAINTS))
+        if df_empl is None or df_empl.empty:
+            return empty
+
+        c_amm_e = self._get_col(df_empl, "numero amm", "amm")
+        c_lib_e = self._get_col(df_empl, "condition d’emploi libelle", "libelle", "condition")
+        if not c_amm_e or not c_lib_e:
+            return empty
+
+        textes = df_empl[c_lib_e].astype(str)
+        extracted = pd.DataFrame(
+            {col: pd.to_numeric(textes.str.extract(pattern, expand=False), errors="coerce")
+             for col, pattern in EMPLOI_CONSTRAINTS.items()}
+        )
+        extracted["N_AMM"] = df_empl[c_amm_e].astype(str).values
+
+        maxima = extracted.dropna(subset=list(EMPLOI_CONSTRAINTS), how="all").groupby("N_AMM").max()
+        # Valeurs en texte entier ("5", "48") comme les autres colonnes issues des CSV
+        return maxima.apply(lambda s: s.map(lambda v: str(int(v)), na_action="ignore"))
+
     def _enrich_intrants(self, df_intrants: pd.DataFrame, df_usages: pd.DataFrame) -> pd.DataFrame:
         """
         Pour chaque produit dans df_intrants, calcule les valeurs agrégées
@@ -461,32 +829,376 @@ class EphyFetcher:
 
         return df_intrants.apply(add_danger, axis=1)
 
+    def _build_name_index(self, df_produits: pd.DataFrame) -> pd.DataFrame:
+        """
+        Construit l'index des noms recherchables : un nom principal ou secondaire par ligne.
+        Colonnes : Nom (tel qu'affiché), Nom_Upper (comparé par le scorer),
+        Nom_Norm (sans accents ni espaces multiples, pour l'autocomplétion),
+        Idx (position dans df_produits), Etat_Rank (0 = autorisé, 1 = sinon).
+        """
+        if df_produits.empty:
+            return pd.DataFrame(columns=NOMS_COLUMNS)
+
+        prod = df_produits.reset_index(drop=True)
+        etat = prod["Etat_AMM"] if "Etat_AMM" in prod.columns else pd.Series("", index=prod.index)
+        etat_rank = (~etat.astype(str).str.upper().str.contains("AUTOR", regex=False)).astype(int)
+
+        principaux = pd.DataFrame({"Nom": prod["Nom_Produit"].fillna("").astype(str).str.strip(), "Idx": prod.index})
+        if "Noms_Secondaires" in prod.columns:
+            secondaires = (prod["Noms_Secondaires"].dropna().astype(str).str.split("|")
+                           .explode().str.strip().rename("Nom").reset_index())
+            secondaires = secondaires.rename(columns={"index": "Idx"})
+        else:
+            secondaires = pd.DataFrame(columns=["Nom", "Idx"])
+
+        # Nom principal puis noms secondaires, dans l'ordre des produits
+        df_noms = pd.concat([principaux, secondaires[["Nom", "Idx"]]], ignore_index=True)
+        df_noms = df_noms.sort_values("Idx", kind="stable")
+        df_noms = df_noms[df_noms["Nom"].notna() & ~df_noms["Nom"].str.lower().isin(["nan", "none", ""])]
+
+        df_noms["Idx"] = df_noms["Idx"].astype(int)
+        df_noms["Nom_Upper"] = df_noms["Nom"].str.upper()
+        df_noms["Nom_Norm"] = (df_noms["Nom"].str.normalize("NFKD")
+                               .str.encode("ascii", errors="ignore").str.decode("ascii")
+                               .str.upper().str.split().str.join(" "))
+        df_noms["Etat_Rank"] = etat_rank.iloc[df_noms["Idx"]].values
+        return df_noms[NOMS_COLUMNS].reset_index(drop=True)
+
+    def _set_name_index(self, df_noms: pd.DataFrame):
+        """Active un index de noms : listes prêtes à passer telles quelles au scorer."""
+        self._df_noms = df_noms
+        self._noms = df_noms["Nom"].tolist()
+        self._noms_upper = df_noms["Nom_Upper"].tolist()
+        self._noms_idx = df_noms["Idx"].tolist()
+        self._noms_rank = df_noms["Etat_Rank"].tolist()
+
+        order = df_noms["Nom_Norm"].sort_values(kind="stable")
+        self._prefix_keys = order.tolist()
+        self._prefix_pos = order.index.tolist()
+
+        # À nom égal, le produit autorisé l'emporte
+        uniques = df_noms.sort_values("Etat_Rank", kind="stable").drop_duplicates("Nom_Norm")
+        amm = self._df_produits["N_AMM"].astype(str).to_numpy() if not self._df_produits.empty else np.array([])
+        self._amm_by_nom = dict(zip(uniques["Nom_Norm"].tolist(), amm[uniques["Idx"].to_numpy(dtype=int)].tolist()))
+
+    def _set_usages(self, df_usages: pd.DataFrame):
+        """
+        Active la table des usages triée par N_AMM et calcule les offsets
+        (début, fin) de chaque AMM : la lecture d'un produit devient une tranche iloc.
+        """
+        self._usages_offsets = {}
+        self._usage_index = {}
+        self._cibles_by_culture = {}
+        if df_usages.empty or "N_AMM" not in df_usages.columns:
+            self._df_usages = df_usages
+            return
+
+        amm_col = df_usages["N_AMM"].astype(str)
+        # Déjà trié (cache) : pas de copie, la table mappée en mémoire reste partagée
+        if not amm_col.is_monotonic_increasing:
+            df_usages = df_usages.assign(N_AMM=amm_col)
+            df_usages = df_usages.sort_values("N_AMM", kind="stable").reset_index(drop=True)
+            amm_col = df_usages["N_AMM"]
+
+        amm = amm_col.to_numpy()
+        starts = np.flatnonzero(np.r_[True, amm[1:] != amm[:-1]])
+        stops = np.r_[starts[1:], len(amm)]
+        self._usages_offsets = dict(zip(amm[starts].tolist(), zip(starts.tolist(), stops.tolist())))
+        self._df_usages = df_usages
+        self._build_usage_index(df_usages)
+
+    def _build_usage_index(self, df_usages: pd.DataFrame):
+        """
+        Index inversé (culture, cible) → positions des usages, issu de 'identifiant usage'
+        (Culture*Traitement*Cible). Les clés sont normalisées comme les noms de produits.
+        """
+        if "Culture" not in df_usages.columns or "Cible" not in df_usages.columns:
+            return
+        # Normalisation sur les valeurs distinctes seulement (quelques milliers pour ~30k usages)
+        libelles_cible = df_usages["Cible"].fillna("").astype(str)
+        keys = pd.DataFrame({
+            "Culture": df_usages["Culture"].fillna("").astype(str),
+            "Cible":   libelles_cible,
+        })
+        for col in ("Culture", "Cible"):
+            uniques = keys[col].unique()
+            keys[col] = keys[col].map(dict(zip(uniques, [self._normalize_nom(u) for u in uniques])))
+        keys = keys[(keys["Culture"] != "") & (keys["Cible"] != "")]
+
+        groups = keys.groupby(["Culture", "Cible"], sort=True).indices
+        self._usage_index = {key: np.sort(pos) for key, pos in groups.items()}
+        cibles: dict[str, list[str]] = {}
+        for (culture, _), pos in self._usage_index.items():
+            cibles.setdefault(culture, []).append(libelles_cible.iat[pos[0]])
+        self._cibles_by_culture = cibles
+
+    def _usages_for_amm(self, n_amm: str) -> pd.DataFrame:
+        """Usages d'un N_AMM (tranche contiguë de la table triée, vide si inconnu)."""
+        start, stop = self._usages_offsets.get(str(n_amm), (0, 0))
+        return self._df_usages.iloc[start:stop]
+
+    @staticmethod
+    def _records(df: pd.DataFrame) -> list[dict]:
+        """
+        Lignes en dicts (REF_INTRANTS / REF_USAGES_PHYTO) : une valeur manquante devient ""
+        dans une colonne texte, None dans une colonne numérique (tables Arrow du cache),
+        pour que chaque colonne garde un seul type une fois remise en DataFrame.
+        """
+        blank = {col: "" if (pd.api.types.is_string_dtype(dtype) or pd.api.types.is_object_dtype(dtype)
+                             or str(dtype).startswith("null")) else None
+                 for col, dtype in df.dtypes.items()}
+        return [{k: (blank[k] if pd.isna(v) else v) for k, v in r.items()} for r in df.to_dict("records")]
+
     # ------------------------------------------------------------------
     # 3. CACHE DISQUE
     # ------------------------------------------------------------------
 
-    def _save_cache(self):
+    def _path(self, filename: str) -> str:
+        """Chemin d'un fichier du cache dans la version chargée."""
+        return os.path.join(self._version_dir, filename)
+
+    def _save_cache(self) -> bool:
         try:
             if not self._df_produits.empty:
-                self._df_produits.to_parquet(CACHE_PRODUITS, index=False)
+                self._df_produits.to_parquet(self._path(PRODUITS_FILE), index=False, compression=CACHE_COMPRESSION)
             if not self._df_usages.empty:
-                self._df_usages.to_parquet(CACHE_USAGES, index=False)
+                self._write_usages_parquet(self._df_usages, self._path(USAGES_FILE))
+            if not self._df_noms.empty:
+                self._write_name_index(self._df_noms)
+            if not self._df_substances.empty:
+                self._df_substances.to_parquet(self._path(SUBSTANCES_FILE), index=False, compression=CACHE_COMPRESSION)
+            self._write_shared()
+            self._write_manifest()
+            return True
         except Exception as e:
             logger.error(f"Erreur sauvegarde cache E-Phy: {e}")
+            return False
 
     def _load_cache(self):
         try:
-            if os.path.exists(CACHE_PRODUITS):
-                self._df_produits = pd.read_parquet(CACHE_PRODUITS)
-            if os.path.exists(CACHE_USAGES):
-                self._df_usages = pd.read_parquet(CACHE_USAGES)
+            shared_produits = self._path(SHARED_PRODUITS_FILE)
+            if not os.path.exists(shared_produits) and os.path.exists(self._path(PRODUITS_FILE)):
+                # Cache antérieur aux copies Arrow : on les crée une fois depuis le parquet
+                self._df_produits = pd.read_parquet(self._path(PRODUITS_FILE))
+                if os.path.exists(self._path(USAGES_FILE)):
+                    self._set_usages(pd.read_parquet(self._path(USAGES_FILE)))
+                self._write_shared()
+            if os.path.exists(shared_produits):
+                self._df_produits = self._read_shared(shared_produits, columns=PRODUITS_UI_COLUMNS)
+            if os.path.exists(self._path(SHARED_USAGES_FILE)):
+                self._set_usages(self._read_shared(self._path(SHARED_USAGES_FILE)))
         except Exception as e:
             logger.error(f"Erreur chargement cache E-Phy: {e}")
+        self._load_name_index()
+        self._load_substances()
+
+    # --- Manifeste & intégrité ----------------------------------------------
+
+    @staticmethod
+    def _sha256(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _write_manifest(self):
+        """Décrit la version écrite ; écrit en dernier, de façon atomique (sa présence = version complète)."""
+        tables = {PRODUITS_FILE: self._df_produits, USAGES_FILE: self._df_usages,
+                  NOMS_FILE: self._df_noms, SUBSTANCES_FILE: self._df_substances}
+        files = {}
+        for name in sorted(os.listdir(self._version_dir)):
+            path = self._path(name)
+            if name == MANIFEST_FILE or not os.path.isfile(path) or name.endswith(".tmp"):
+                continue
+            files[name] = {"size": os.path.getsize(path), "sha256": self._sha256(path)}
+        manifest = {
+            "schema_version": CACHE_SCHEMA_VERSION,
+            "created":        datetime.now().strftime("%Y-%m-%d"),
+            "source_sha256":  self._source_hash,
+            "rows":           {name: len(df) for name, df in tables.items() if name in files},
+            "files":          files,
+        }
+        self._dump_manifest(self._version_dir, manifest)
+
+    @staticmethod
+    def _manifest_checksum(manifest: dict) -> str:
+        """sha256 du contenu du manifeste (hors champ checksum), sérialisé de façon canonique."""
+        content = {k: v for k, v in manifest.items() if k != "checksum"}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _dump_manifest(cls, version_dir: str, manifest: dict):
+        """Écrit le manifeste avec son checksum (remplacement atomique)."""
+        manifest = dict(manifest, checksum=cls._manifest_checksum(manifest))
+        tmp = os.path.join(version_dir, f"{MANIFEST_FILE}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, os.path.join(version_dir, MANIFEST_FILE))
+
+    @classmethod
+    def _touch_manifest(cls, version_dir: str):
+        """Renouvelle la date de construction d'une version (source inchangée)."""
+        manifest = cls._read_manifest(version_dir)
+        if manifest:
+            manifest["created"] = datetime.now().strftime("%Y-%m-%d")
+            cls._dump_manifest(version_dir, manifest)
+
+    @classmethod
+    def _read_manifest(cls, version_dir: str) -> dict | None:
+        """Manifeste d'une version ; None s'il manque, est illisible ou a été modifié (checksum)."""
+        try:
+            with open(os.path.join(version_dir, MANIFEST_FILE), "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(manifest, dict) or manifest.get("checksum") != cls._manifest_checksum(manifest):
+            if os.path.exists(os.path.join(version_dir, MANIFEST_FILE)):
+                logger.warning(f"Cache E-Phy : manifeste altéré ({version_dir})")
+            return None
+        return manifest
+
+    def _validate_cache(self, version_dir: str, deep: bool = False) -> bool:
+        """
+        Contrôle d'une version contre son manifeste. Rapide (démarrage) : checksum du manifeste,
+        version de schéma, présence et taille des fichiers, sha256 des petits fichiers
+        (STARTUP_CHECKSUM_FILES), nombre de lignes lu dans le pied des parquet.
+        deep=True : recalcule les sha256 de tous les fichiers (lecture complète).
+        """
+        manifest = self._read_manifest(version_dir)
+        if not manifest or manifest.get("schema_version") != CACHE_SCHEMA_VERSION:
+            return False
+        try:
+            for name, meta in manifest["files"].items():
+                path = os.path.join(version_dir, name)
+                if os.path.getsize(path) != meta["size"]:
+                    logger.warning(f"Cache E-Phy : taille inattendue pour {name}")
+                    return False
+                if (deep or name in STARTUP_CHECKSUM_FILES) and self._sha256(path) != meta["sha256"]:
+                    logger.warning(f"Cache E-Phy : checksum invalide pour {name}")
+                    return False
+            for name, rows in manifest["rows"].items():
+                if pq.read_metadata(os.path.join(version_dir, name)).num_rows != rows:
+                    logger.warning(f"Cache E-Phy : nombre de lignes inattendu pour {name}")
+                    return False
+        except (OSError, KeyError, pa.ArrowException) as e:
+            logger.warning(f"Cache E-Phy invalide ({version_dir}): {e}")
+            return False
+        return True
+
+    def verify_cache(self) -> bool:
+        """Vérification complète (sha256) de la version chargée."""
+        version_dir = self._state._version_dir
+        return bool(version_dir) and self._validate_cache(version_dir, deep=True)
+
+    def _write_shared(self):
+        """Écrit les copies Arrow IPC non compressées (mappables) des tables produits et usages."""
+        if not self._df_produits.empty:
+            feather.write_feather(self._df_produits, self._path(SHARED_PRODUITS_FILE), compression="uncompressed")
+        if not self._df_usages.empty:
+            feather.write_feather(self._df_usages, self._path(SHARED_USAGES_FILE), compression="uncompressed")
+
+    @staticmethod
+    def _read_shared(path: str, columns: list[str] | None = None) -> pd.DataFrame:
+        """
+        Ouvre un fichier Arrow IPC par memory-map, sans copie : les colonnes pandas
+        (types Arrow) pointent directement sur les pages du fichier, partagées par
+        l'OS entre toutes les sessions et tous les process qui lisent le même fichier.
+        columns : projection (seules ces colonnes sont converties en pandas).
+        """
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        if columns is not None:
+            table = table.select([c for c in columns if c in table.column_names])
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+    def _write_usages_parquet(self, df_usages: pd.DataFrame, path: str):
+        """
+        Écrit les usages (déjà triés par N_AMM) en row groups d'environ USAGES_ROW_GROUP lignes,
+        coupés uniquement entre deux AMM. Avec les statistiques min/max par row group,
+        une lecture filtrée (filters=[("N_AMM", "==", amm)]) ne touche qu'un seul groupe.
+        """
+        table = pa.Table.from_pandas(df_usages, preserve_index=False)
+        starts = sorted(start for start, _ in self._usages_offsets.values())
+        targets = np.arange(USAGES_ROW_GROUP, len(df_usages), USAGES_ROW_GROUP)
+        cuts = sorted({starts[i] for i in np.searchsorted(starts, targets) if i < len(starts)} - {0})
+        bounds = [0] + cuts + [len(df_usages)]
+
+        with pq.ParquetWriter(path, table.schema, write_statistics=True, compression=CACHE_COMPRESSION) as writer:
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                writer.write_table(table.slice(lo, hi - lo))
+
+    def _produits_checksum(self) -> str:
+        """sha256 de produits.parquet (lu dans le manifeste validé, recalculé pour un cache sans manifeste)."""
+        manifest = self._read_manifest(self._version_dir)
+        if manifest and PRODUITS_FILE in manifest.get("files", {}):
+            return manifest["files"][PRODUITS_FILE]["sha256"]
+        path = self._path(PRODUITS_FILE)
+        return self._sha256(path) if os.path.exists(path) else ""
+
+    def _write_name_index(self, df_noms: pd.DataFrame):
+        """Écrit noms.parquet avec le sha256 des produits indexés (cf. _load_name_index)."""
+        table = pa.Table.from_pandas(df_noms, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[NOMS_PRODUITS_KEY] = self._produits_checksum().encode("ascii")
+        pq.write_table(table.replace_schema_metadata(metadata), self._path(NOMS_FILE), compression=CACHE_COMPRESSION)
+
+    def _load_name_index(self):
+        """
+        Charge l'index des noms persisté ; le reconstruit s'il manque ou s'il a été construit
+        sur d'autres produits (sha256 de produits.parquet différent : noms ou ordre changés).
+        """
+        df_noms = None
+        try:
+            if os.path.exists(self._path(NOMS_FILE)):
+                indexed = (pq.read_schema(self._path(NOMS_FILE)).metadata or {}).get(NOMS_PRODUITS_KEY, b"")
+                if indexed.decode("ascii") == self._produits_checksum():
+                    df_noms = pd.read_parquet(self._path(NOMS_FILE))
+                if df_noms is not None and set(NOMS_COLUMNS) - set(df_noms.columns):
+                    df_noms = None
+                elif df_noms is not None and not df_noms.empty and df_noms["Idx"].max() >= len(self._df_produits):
+                    df_noms = None
+        except Exception as e:
+            logger.error(f"Erreur chargement index noms E-Phy: {e}")
+            df_noms = None
+
+        if df_noms is None:
+            df_produits = self._df_produits
+            if "Noms_Secondaires" not in df_produits.columns and os.path.exists(self._path(PRODUITS_FILE)):
+                # Colonne hors projection de démarrage : lue seule, uniquement pour reconstruire l'index
+                secondaires = pd.read_parquet(self._path(PRODUITS_FILE), columns=["Noms_Secondaires"])
+                if len(secondaires) == len(df_produits):
+                    df_produits = df_produits.assign(Noms_Secondaires=secondaires["Noms_Secondaires"].values)
+            df_noms = self._build_name_index(df_produits)
+            if not df_noms.empty:
+                try:
+                    self._write_name_index(df_noms)
+                except Exception as e:
+                    logger.error(f"Erreur sauvegarde index noms E-Phy: {e}")
+        self._set_name_index(df_noms)
+
+    def _load_substances(self):
+        """Charge la table des substances persistée ; la reconstruit depuis les produits si absente."""
+        df_subst = None
+        try:
+            if os.path.exists(self._path(SUBSTANCES_FILE)):
+                df_subst = pd.read_parquet(self._path(SUBSTANCES_FILE))
+        except Exception as e:
+            logger.error(f"Erreur chargement substances E-Phy: {e}")
+
+        if df_subst is None:
+            df_subst = self._build_substances(self._df_produits)
+            if not df_subst.empty:
+                try:
+                    df_subst.to_parquet(self._path(SUBSTANCES_FILE), index=False, compression=CACHE_COMPRESSION)
+                except Exception as e:
+                    logger.error(f"Erreur sauvegarde substances E-Phy: {e}")
+        self._set_substances(df_subst)
 
     # ------------------------------------------------------------------
     # 4. RECHERCHE PAR NOM COMMERCIAL
     # ------------------------------------------------------------------
 
+    @perf.timed("EphyFetcher")
     def search(self, nom_commercial: str, top_n: int = 5) -> list[dict]:
         """
         Recherche floue par nom commercial dans le référentiel E-Phy.
@@ -495,79 +1207,81 @@ class EphyFetcher:
           - 'intrant'  : dict pour REF_INTRANTS (1 ligne)
           - 'usages'   : list[dict] pour REF_USAGES_PHYTO (N lignes)
           - 'score'    : score de similarité (0-100)
+        Les résultats sont mis en cache (LRU, SEARCH_CACHE_SIZE entrées) pour la version chargée.
         """
-        if self._df_produits.empty:
-            return []
+        state = self._state
+        query = " ".join(str(nom_commercial).upper().split())
+        key = (state._version_dir, query, top_n)
+        with self._swap_lock:
+            results = self._search_cache.get(key)
+            if results is not None:
+                self._search_hits += 1
+                self._search_cache.move_to_end(key)
+        if results is None:
+            # Calcul hors verrou : les recherches de plusieurs sessions s'exécutent en parallèle
+            results = state._search_uncached(query, top_n)
+            with self._swap_lock:
+                self._search_misses += 1
+                if state is self._state:
+                    self._search_cache[key] = results
+                    if len(self._search_cache) > SEARCH_CACHE_SIZE:
+                        self._search_cache.popitem(last=False)
+        # Copie : l'appelant peut modifier les dicts sans altérer le cache
+        return copy.deepcopy(results)
 
-        noms = []
-        idx_mapping = []
-        for idx, row in self._df_produits.iterrows():
-            main_nom = str(row.get("Nom_Produit", ""))
-            if main_nom and main_nom.lower() not in ("nan", "none", ""):
-                noms.append(main_nom)
-                idx_mapping.append(idx)
-            
-            sec_noms = str(row.get("Noms_Secondaires", ""))
-            if sec_noms and sec_noms.lower() not in ("nan", "none", ""):
-                for sec in sec_noms.split("|"):
-                    sec = sec.strip()
-                    if sec:
-                        noms.append(sec)
-                        idx_mapping.append(idx)
-
-        if not noms:
+    @property
+    def search_cache_stats(self) -> dict:
+        """Statistiques du cache de search() : hits, misses, taille, taux de hit (0-1)."""
+        total = self._search_hits + self._search_misses
+        return {
+            "hits":     self._search_hits,
+            "misses":   self._search_misses,
+            "size":     len(self._search_cache),
+            "hit_rate": self._search_hits / total if total else 0.0,
+        }
+
+    def _search_uncached(self, query: str, top_n: int) -> list[dict]:
+        if self._df_produits.empty or not self._noms_upper:
             return []
 
         matches = process.extract(
-            nom_commercial.upper(),
-            [n.upper() for n in noms],
+            query,
+            self._noms_upper,
             scorer=fuzz.WRatio,
             limit=top_n * 2
         )
 
-        # Tri secondaire : AUTORISÉ > RETIRÉ à score égal
-        def sort_key(m):
-            _, score, list_idx = m
-            row = self._df_produits.iloc[idx_mapping[list_idx]]
-            etat = str(row.get("Etat_AMM", "")).upper()
-            etat_rank = 0 if "AUTOR" in etat else 1  # 0 = autorisé (rank first)
-            return (-score, etat_rank)
-        
-        matches_sorted = sorted(matches, key=sort_key)
+        # Tri secondaire : AUTORISÉ > RETIRÉ à score égal (rang précalculé dans l'index)
+        matches_sorted = sorted(matches, key=lambda m: (-m[1], self._noms_rank[m[2]]))
 
         results = []
         seen_amm = set()
         for match_str, score, list_idx in matches_sorted:
-            if score < 40:
+            if score < MIN_SCORE:
                 continue
             
-            orig_str = noms[list_idx]
-            idx = idx_mapping[list_idx]
-            row = self._df_produits.iloc[idx]
-            amm = str(row.get("N_AMM", ""))
+            orig_str = self._noms[list_idx]
+            idx = self._noms_idx[list_idx]
+            # Valeurs manquantes nettoyées selon le type de chaque colonne (cf. _records)
+            intrant = self._records(self._df_produits.iloc[[idx]])[0]
+            amm = str(intrant.get("N_AMM", ""))
 
             if amm in seen_amm:
                 continue
             seen_amm.add(amm)
 
-            intrant = row.to_dict()
             intrant.pop("Noms_Secondaires", None)  # Ne pas écrire ça dans REF_INTRANTS
             
             # Si le nom trouvé est un nom secondaire (ex: SPECTRUM au lieu de ISARD),
             # on remplace le Nom_Produit pour qu'il s'affiche et s'enregistre sous ce nom.
-            main_nom = str(row.get("Nom_Produit", ""))
+            main_nom = str(intrant.get("Nom_Produit", ""))
             if orig_str.upper() != main_nom.upper():
                 intrant["Nom_Produit"] = f"{orig_str} (Réf: {main_nom})"
 
-            # Nettoyer les NaN
-            intrant = {k: ("" if (v != v or v is None) else v) for k, v in intrant.items()}
-
             # Usages associés
             usages = []
             if not self._df_usages.empty and amm:
-                sub = self._df_usages[self._df_usages["N_AMM"].astype(str) == amm]
-                for r in sub.to_dict("records"):
-                    u = {k: ("" if (v != v or v is None) else v) for k, v in r.items()}
+                for u in self._records(self._usages_for_amm(amm)):
                     u["Nom_Produit"] = intrant.get("Nom_Produit", u.get("Nom_Produit"))
                     usages.append(u)
 
@@ -581,30 +1295,495 @@ class EphyFetcher:
 
         return results
 
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
+    def autocomplete(self, prefix: str, limit: int = 10, fuzzy_fallback: bool = True) -> list[str]:
+        """
+        Suggestions de noms commerciaux pour la saisie au fil de l'eau.
+        Recherche par préfixe (bisect sur les noms normalisés triés), produits
+        autorisés en premier. Sans aucun préfixe correspondant, repli sur le
+        scorer flou (voir _autocomplete_fuzzy) si fuzzy_fallback.
+        """
+        key = self._normalize_nom(prefix)
+        if not key or not self._prefix_keys:
+            return []
+
+        lo = bisect.bisect_left(self._prefix_keys, key)
+        hi = bisect.bisect_left(self._prefix_keys, key + "\uffff")
+        if lo == hi:
+            return self._autocomplete_fuzzy(key, limit) if fuzzy_fallback else []
+
+        # Ordre alphabétique conservé (tri stable), autorisés d'abord
+        positions = sorted(self._prefix_pos[lo:hi], key=lambda pos: self._noms_rank[pos])
+        suggestions = []
+        for pos in positions:
+            nom = self._noms[pos]
+            if nom not in suggestions:
+                suggestions.append(nom)
+                if len(suggestions) >= limit:
+                    break
+        return suggestions
+
+    def _autocomplete_fuzzy(self, key: str, limit: int) -> list[str]:
+        """Repli de l'autocomplétion : meilleurs scores WRatio sur les noms normalisés."""
+        matches = process.extract(key, self._prefix_keys, scorer=fuzz.WRatio,
+                                  score_cutoff=MIN_SCORE, limit=limit * 2)
+        suggestions = []
+        for _, _, i in sorted(matches, key=lambda m: (-m[1], self._noms_rank[self._prefix_pos[m[2]]])):
+            nom = self._noms[self._prefix_pos[i]]
+            if nom not in suggestions:
+                suggestions.append(nom)
+                if len(suggestions) >= limit:
+                    break
+        return suggestions
+
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
+    def match_products(self, noms_commerciaux: list[str]) -> pd.DataFrame:
+        """
+        Rapprochement en lot d'une liste de noms (ex: tout REF_INTRANTS ou les
+        Nom_Produit distincts de JOURNAL_INTERVENTION) avec le référentiel E-Phy.
+        Tous les noms sont scorés d'un coup (rapidfuzz cdist, multi-thread).
+        Retourne un DataFrame, une ligne par nom distinct :
+          Nom_Recherche, Nom_Trouve, Nom_Produit, N_AMM, Etat_AMM, Date_Fin_AMM, Score
+        (colonnes E-Phy vides si aucun score >= MIN_SCORE).
+        """
+        cols = ["Nom_Recherche", "Nom_Trouve", "Nom_Produit", "N_AMM", "Etat_AMM", "Date_Fin_AMM", "Score"]
+        queries = pd.Series(noms_commerciaux, dtype=object).dropna().astype(str).str.strip()
+        queries = queries[queries != ""].drop_duplicates().tolist()
+        if not queries:
+            return pd.DataFrame(columns=cols)
+        if self._df_produits.empty or not self._noms_upper:
+            return pd.DataFrame({"Nom_Recherche": queries}).reindex(columns=cols)
+
+        ranks = np.asarray(self._noms_rank)
+        best_pos, best_score = [], []
+        for start in range(0, len(queries), MATCH_CHUNK):
+            chunk = [q.upper() for q in queries[start:start + MATCH_CHUNK]]
+            scores = process.cdist(chunk, self._noms_upper, scorer=fuzz.WRatio,
+                                   score_cutoff=MIN_SCORE, dtype=np.float32, workers=-1)
+            top = scores.max(axis=1)
+            # À score égal, préférer le produit autorisé (même règle que search)
+            tie_break = np.where(scores == top[:, None], 1 - ranks, -1)
+            best_pos.append(tie_break.argmax(axis=1))
+            best_score.append(top)
+        best_pos = np.concatenate(best_pos)
+        best_score = np.concatenate(best_score)
+
+        prod_pos = np.asarray(self._noms_idx)[best_pos]
+        found = self._df_produits.iloc[prod_pos].reset_index(drop=True)
+        result = pd.DataFrame({
+            "Nom_Recherche": queries,
+            "Nom_Trouve":    np.asarray(self._noms, dtype=object)[best_pos],
+            "Nom_Produit":   found.get("Nom_Produit"),
+            "N_AMM":         found.get("N_AMM"),
+            "Etat_AMM":      found.get("Etat_AMM"),
+            "Date_Fin_AMM":  found.get("Date_Fin_AMM"),
+            "Score":         best_score.astype(float).round(1),
+        }).reindex(columns=cols)
+
+        result.loc[result["Score"] < MIN_SCORE, cols[1:-1]] = None
+        return result
+
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
     def get_usages_for_product(self, n_amm: str) -> list[dict]:
         """Retourne tous les usages E-Phy pour un N_AMM donné."""
         if self._df_usages.empty:
             return []
-        sub = self._df_usages[self._df_usages["N_AMM"].astype(str) == str(n_amm)]
-        return [{k: ("" if (v != v or v is None) else v) for k, v in r.items()}
-                for r in sub.to_dict("records")]
+        return self._records(self._usages_for_amm(n_amm))
+
+    @_on_snapshot
+    def usages_for_amms(self, amms: list[str]) -> pd.DataFrame:
+        """Usages E-Phy de plusieurs N_AMM en un seul DataFrame (concaténation des tranches)."""
+        slices = [self._usages_for_amm(a) for a in amms if str(a) in self._usages_offsets]
+        if not slices:
+            return pd.DataFrame(columns=self._df_usages.columns)
+        return pd.concat(slices, ignore_index=True)
+
+    @_on_snapshot
+    def products_for_amms(self, amms: list[str]) -> pd.DataFrame:
+        """N_AMM, Nom_Produit, Etat_AMM, Date_Fin_AMM des produits E-Phy demandés."""
+        cols = ["N_AMM", "Nom_Produit", "Etat_AMM", "Date_Fin_AMM"]
+        if self._df_produits.empty:
+            return pd.DataFrame(columns=cols)
+        produits = self._df_produits.reindex(columns=cols)
+        produits = produits.assign(N_AMM=produits["N_AMM"].astype(str))
+        return produits[produits["N_AMM"].isin([str(a) for a in amms])].reset_index(drop=True)
+
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
+    def cibles_for_culture(self, culture: str) -> list[str]:
+        """Cibles (libellé E-Phy) pour lesquelles au moins un usage existe sur la culture."""
+        return list(self._cibles_by_culture.get(self._normalize_nom(culture), []))
+
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
+    def authorized_products(self, culture: str, cible: str, autorises_seulement: bool = True) -> pd.DataFrame:
+        """
+        Produits homologués pour un couple (culture, cible), ex: ("Blé tendre", "Septoriose"),
+        via l'index inversé construit au rafraîchissement. Classés par dose puis DAR croissants.
+        autorises_seulement : exclut les usages et AMM retirés.
+        """
+        cols = ["N_AMM", "Nom_Produit", "Etat_AMM", "Dose_Max", "Unite_Dose", "DAR",
+                "Nb_Applications_Max", "ZNT_Aqua", "Type_Cible"]
+        positions = self._usage_index.get((self._normalize_nom(culture), self._normalize_nom(cible)))
+        if positions is None or not len(positions):
+            return pd.DataFrame(columns=cols)
+
+        sub = self._df_usages.iloc[positions]
+        result = pd.DataFrame({
+            col: (sub[col].to_numpy() if col in sub.columns else None)
+            for col in ["N_AMM", "Nom_Produit", "Dose_Max", "Unite_Dose", "DAR",
+                        "Nb_Applications_Max", "ZNT_Aqua", "Type_Cible", "Etat_Usage"]
+        })
+        result["N_AMM"] = result["N_AMM"].astype(str)
+        result["Etat_AMM"] = None
+        produits = self._df_produits.drop_duplicates("N_AMM").set_index(
+            self._df_produits.drop_duplicates("N_AMM")["N_AMM"].astype(str).to_numpy())
+        if "Etat_AMM" in produits.columns:
+            result["Etat_AMM"] = result["N_AMM"].map(produits["Etat_AMM"])
+        if "Nom_Produit" in produits.columns:
+            result["Nom_Produit"] = result["Nom_Produit"].fillna(result["N_AMM"].map(produits["Nom_Produit"]))
+
+        if autorises_seulement:
+            retire = (result["Etat_AMM"].fillna("").astype(str).str.upper().str.contains("RETIR", regex=False)
+                      | result["Etat_Usage"].fillna("").astype(str).str.upper().str.contains("RETIR", regex=False))
+            result = result[~retire]
+
+        result = result.assign(
+            _dose=pd.to_numeric(result["Dose_Max"].astype(str).str.replace(",", ".", regex=False), errors="coerce"),
+            _dar=pd.to_numeric(result["DAR"].astype(str).str.replace(",", ".", regex=False), errors="coerce"),
+        ).sort_values(["_dose", "_dar", "Nom_Produit"], na_position="last", kind="stable")
+        return result[cols].reset_index(drop=True)
 
     @property
     def last_update(self) -> str:
         """Retourne la date de dernière mise à jour du cache (str dd/mm/yyyy)."""
+        state = self._state
         try:
-            with open(CACHE_DATE_FILE, "r") as f:
-                d = datetime.strptime(f.read().strip(), "%Y-%m-%d")
-            return d.strftime("%d/%m/%Y")
+            manifest = self._read_manifest(state._version_dir)
+            if manifest:
+                date_str = manifest["created"]
+            else:
+                with open(state._path(DATE_FILE), "r") as f:
+                    date_str = f.read().strip()
+            return datetime.strptime(date_str, "%Y-%m-%d").strftime("%d/%m/%Y")
         except Exception:
             return "Inconnue"
 
     @property
     def nb_produits(self) -> int:
-        return len(self._df_produits)
+        return len(self._state._df_produits)
+
+    @property
+    def version(self) -> str:
+        """Identifiant de la version chargée (change à chaque bascule) : clé des caches dérivés côté appelant."""
+        return self._state._version_dir
+
+    # ------------------------------------------------------------------
+    # 5. SUBSTANCES ACTIVES
+    # ------------------------------------------------------------------
+
+    def _build_substances(self, df_produits: pd.DataFrame) -> pd.DataFrame:
+        """
+        Éclate Matieres_Actives ("diméthoate (Dimethoate) 400.0 g/L | ...") en une ligne
+        par produit × substance : Substance, Substance_EN, Substance_Norm (clé de recherche),
+        Concentration (float) et Unite_Concentration.
+        """
+        if df_produits.empty or "Matieres_Actives" not in df_produits.columns:
+            return pd.DataFrame(columns=SUBSTANCES_COLUMNS)
+
+        segments = df_produits[["N_AMM", "Matieres_Actives"]].dropna(subset=["Matieres_Actives"])
+        segments = segments.assign(Segment=segments["Matieres_Actives"].astype(str).str.split("|"))
+        segments = segments.explode("Segment")
+        segments["Segment"] = segments["Segment"].str.strip()
+        segments = segments[segments["Segment"].fillna("") != ""]
+
+        parsed = segments["Segment"].str.extract(SUBSTANCE_PATTERN)
+        df_subst = pd.DataFrame({
+            "N_AMM":               segments["N_AMM"].astype(str).values,
+            "Substance":           parsed["Substance"].str.strip().values,
+            "Substance_EN":        parsed["Substance_EN"].str.strip().values,
+            "Concentration":       pd.to_numeric(parsed["Concentration"].str.replace(",", ".", regex=False),
+                                                 errors="coerce").values,
+            "Unite_Concentration": parsed["Unite_Concentration"].values,
+        })
+        df_subst = df_subst[df_subst["Substance"].notna()]
+        df_subst["Substance_Norm"] = [self._normalize_nom(x) for x in df_subst["Substance"]]
+        return df_subst[SUBSTANCES_COLUMNS].drop_duplicates().reset_index(drop=True)
+
+    def _set_substances(self, df_subst: pd.DataFrame):
+        """Active la table des substances et son index inversé (nom FR ou EN normalisé → N_AMM)."""
+        self._df_substances = df_subst
+        index: dict[str, set] = {}
+        if not df_subst.empty:
+            keys = pd.concat([
+                df_subst[["Substance_Norm", "N_AMM"]].rename(columns={"Substance_Norm": "Cle"}),
+                pd.DataFrame({"Cle": [self._normalize_nom(x) for x in df_subst["Substance_EN"].fillna("")],
+                              "N_AMM": df_subst["N_AMM"].values}),
+            ], ignore_index=True)
+            keys = keys[keys["Cle"] != ""]
+            for cle, amms in keys.groupby("Cle")["N_AMM"]:
+                index[cle] = set(amms)
+        self._substance_index = {cle: sorted(amms) for cle, amms in index.items()}
+
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
+    def products_with_substance(self, substance: str) -> pd.DataFrame:
+        """
+        Produits contenant une substance active (nom français ou anglais, sans accents
+        ni casse). Correspondance exacte via l'index inversé, sinon sur une partie du nom.
+        Retourne une ligne par produit : N_AMM, Nom_Produit, Etat_AMM, Substance, Concentration, Unite_Concentration.
+        """
+        cols = ["N_AMM", "Nom_Produit", "Etat_AMM", "Substance", "Concentration", "Unite_Concentration"]
+        key = self._normalize_nom(substance)
+        if not key or not self._substance_index:
+            return pd.DataFrame(columns=cols)
+
+        matching_keys = [key] if key in self._substance_index else [k for k in self._substance_index if key in k]
+        amms = sorted({amm for k in matching_keys for amm in self._substance_index[k]})
+        if not amms:
+            return pd.DataFrame(columns=cols)
+
+        subst = self._df_substances[self._df_substances["N_AMM"].isin(amms)]
+        subst = subst[subst["Substance_Norm"].isin(matching_keys)
+                      | subst["Substance_EN"].fillna("").map(self._normalize_nom).isin(matching_keys)]
+        produits = self._df_produits[["N_AMM", "Nom_Produit", "Etat_AMM"]].astype({"N_AMM": str})
+        result = subst.merge(produits, on="N_AMM", how="left")
+        return result[cols].sort_values(["Substance", "Nom_Produit"]).reset_index(drop=True)
+
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
+    def resolve_amm(self, noms_produits: pd.Series) -> pd.Series:
+        """
+        N_AMM des noms de produits saisis (REF_INTRANTS / JOURNAL_INTERVENTION) par
+        correspondance exacte sur le nom normalisé, suffixe "(Réf: ...)" ignoré.
+        """
+        noms = noms_produits.fillna("").astype(str).str.replace(REF_SUFFIX_PATTERN, "", regex=True)
+        return noms.map(self._normalize_nom).map(self._amm_by_nom)
+
+    @perf.timed("EphyFetcher")
+    @_on_snapshot
+    def substance_totals(self, df_interventions: pd.DataFrame) -> pd.DataFrame:
+        """
+        Quantités de substances actives appliquées, par campagne et par substance,
+        à partir des lignes 'Traitement' de JOURNAL_INTERVENTION.
+        Le produit est identifié par Num_AMM si renseigné, sinon par son nom (resolve_amm).
+        Quantité produit : Quantité_Totale_Produit, à défaut Dose_Ha × Surface_Travaillée_Ha.
+        Retourne : Campagne, Substance, Quantite_g, Nb_Traitements, Produits.
+        Les lignes dont l'unité ne permet pas la conversion (ex: g/L pour un produit en kg) sont ignorées.
+        """
+        cols = ["Campagne", "Substance", "Quantite_g", "Nb_Traitements", "Produits"]
+        if df_interventions.empty or self._df_substances.empty:
+            return pd.DataFrame(columns=cols)
+
+        df = df_interventions
+        if "Nature_Intervention" in df.columns:
+            df = df[df["Nature_Intervention"] == "Traitement"]
+        if df.empty or "Nom_Produit" not in df.columns:
+            return pd.DataFrame(columns=cols)
+
+        amm = df["Num_AMM"].fillna("").astype(str).str.strip() if "Num_AMM" in df.columns else pd.Series("", index=df.index)
+        amm = amm.where(~amm.str.lower().isin(["", "nan", "none"]), self.resolve_amm(df["Nom_Produit"]))
+
+        qty = pd.Series(np.nan, index=df.index)
+        if "Quantité_Totale_Produit" in df.columns:
+            qty = pd.to_numeric(df["Quantité_Totale_Produit"], errors="coerce")
+        if "Dose_Ha" in df.columns and "Surface_Travaillée_Ha" in df.columns:
+            qty = qty.fillna(pd.to_numeric(df["Dose_Ha"], errors="coerce")
+                             * pd.to_numeric(df["Surface_Travaillée_Ha"], errors="coerce"))
+        unit = df["Unité_Quantité"] if "Unité_Quantité" in df.columns else df.get("Unité_Dose", pd.Series("", index=df.index))
+        unit = unit.fillna("").astype(str).str.upper().str.replace("/HA", "", regex=False).str.strip()
+        base = unit.map(lambda u: QUANTITY_UNITS.get(u, (None, np.nan)))
+
+        treatments = pd.DataFrame({
+            "Campagne":    df["Campagne"].values if "Campagne" in df.columns else None,
+            "N_AMM":       amm.values,
+            "Nom_Produit": df["Nom_Produit"].values,
+            "Base":        [b[0] for b in base],
+            "Qty_Base":    qty.values * np.array([b[1] for b in base], dtype=float),
+        }).dropna(subset=["N_AMM", "Qty_Base"])
+
+        joined = treatments.merge(self._df_substances, on="N_AMM", how="inner")
+        conc = joined["Unite_Concentration"].astype(str).str.upper().map(
+            lambda u: CONCENTRATION_UNITS.get(u, (None, np.nan)))
+        joined["Base_Attendue"] = [c[0] for c in conc]
+        joined["Facteur_g"] = [c[1] for c in conc]
+        joined = joined[joined["Base"] == joined["Base_Attendue"]]
+        joined["Quantite_g"] = joined["Qty_Base"] * joined["Concentration"] * joined["Facteur_g"]
+
+        totals = (joined.dropna(subset=["Quantite_g"])
+                  .groupby(["Campagne", "Substance"], as_index=False)
+                  .agg(Quantite_g=("Quantite_g", "sum"),
+                       Nb_Traitements=("Quantite_g", "size"),
+                       Produits=("Nom_Produit", lambda s: ", ".join(sorted(set(map(str, s)))))))
+        return totals[cols].sort_values(["Campagne", "Quantite_g"], ascending=[True, False]).reset_index(drop=True)
+
+    # ------------------------------------------------------------------
+    # 6. HISTORIQUE (états successifs, requêtes à date)
+    # ------------------------------------------------------------------
+
+    def _record_snapshot(self, snapshot_date: str | None = None):
+        """
+        Ajoute l'état parsé à l'historique : seules les lignes nouvelles ou modifiées sont
+        écrites, les lignes disparues ou modifiées sont clôturées à la date du snapshot.
+        Le stockage croît avec le nombre de changements, pas avec le nombre de rafraîchissements.
+        Lecture, fusion et réécriture se font sous verrou (HISTORY_LOCK_FILE) : deux publications
+        simultanées (app, refresh_async, autre worker) ne s'écrasent pas leurs Valid_From / Valid_To.
+        """
+        date = snapshot_date or datetime.now().strftime("%Y-%m-%d")
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        with _file_lock(HISTORY_LOCK_FILE, HISTORY_LOCK_TIMEOUT, HISTORY_LOCK_STALE):
+            for path, df, keys in (
+                (HISTORY_PRODUITS_FILE, self._df_produits, ["N_AMM"]),
+                (HISTORY_USAGES_FILE, self._df_usages, ["N_AMM", "Type_Cible"]),
+            ):
+                if df.empty:
+                    continue
+                history = pd.read_parquet(path) if os.path.exists(path) else None
+                self._write_atomic(self._merge_history(history, df, keys, date), path)
+
+            dates = self.snapshots()
+            if date not in dates:
+                tmp = f"{SNAPSHOTS_FILE}.{os.getpid()}.tmp"
+                with open(tmp, "w") as f:
+                    f.write("\n".join(sorted(dates + [date])))
+                os.replace(tmp, SNAPSHOTS_FILE)
+
+    @staticmethod
+    def _history_rows(df: pd.DataFrame, keys: list[str]) -> pd.DataFrame:
+        """Lignes au format historique : colonnes texte, clé Key (doublons numérotés) et Row_Hash."""
+        rows = df.drop(columns=[c for c in HISTORY_IGNORED if c in df.columns])
+        rows = rows.astype(object).where(rows.notna(), "").astype(str)
+        key = rows[keys].agg("|".join, axis=1)
+        rows["Key"] = key + "#" + key.groupby(key).cumcount().astype(str)
+        rows["Row_Hash"] = pd.util.hash_pandas_object(rows.drop(columns=["Key"]), index=False).astype("int64")
+        return rows
+
+    def _merge_history(self, history: pd.DataFrame | None, df: pd.DataFrame,
+                       keys: list[str], date: str) -> pd.DataFrame:
+        """Fusionne l'état courant dans l'historique (clôture des états changés, ajout des nouveaux)."""
+        current = self._history_rows(df, keys)
+        current["Valid_From"] = date
+        current["Valid_To"] = ""
+        if history is None or history.empty:
+            return current.reset_index(drop=True)
+
+        is_open = history["Valid_To"] == ""
+        open_rows = history[is_open]
+        unchanged = pd.MultiIndex.from_frame(open_rows[["Key", "Row_Hash"]]).isin(
+            pd.MultiIndex.from_frame(current[["Key", "Row_Hash"]]))
+
+        closing = open_rows[~unchanged].assign(Valid_To=date)
+        # Plusieurs rafraîchissements le même jour : l'état ouvert aujourd'hui est simplement remplacé
+        closing = closing[closing["Valid_From"] < date]
+        added = current[~current["Key"].isin(open_rows.loc[unchanged, "Key"])]
+        return pd.concat([history[~is_open], open_rows[unchanged], closing, added],
+                         ignore_index=True).sort_values(["Key", "Valid_From"], kind="stable").reset_index(drop=True)
+
+    @staticmethod
+    def _write_atomic(df: pd.DataFrame, path: str):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        df.to_parquet(tmp, index=False, compression=CACHE_COMPRESSION)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _iso_date(val) -> str:
+        """date / datetime / 'dd/mm/YYYY' / 'YYYY-MM-DD' → 'YYYY-MM-DD' (comparable en texte)."""
+        if hasattr(val, "strftime"):
+            return val.strftime("%Y-%m-%d")
+        parsed = pd.to_datetime(str(val).strip(), dayfirst="/" in str(val), errors="coerce")
+        if pd.isna(parsed):
+            raise ValueError(f"Date invalide : {val!r}")
+        return parsed.strftime("%Y-%m-%d")
+
+    def _history_as_of(self, path: str, date, n_amm: str | None = None) -> pd.DataFrame:
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        filters = [("N_AMM", "==", str(n_amm))] if n_amm else None
+        history = pd.read_parquet(path, filters=filters)
+        day = self._iso_date(date)
+        valid = (history["Valid_From"] <= day) & ((history["Valid_To"] == "") | (history["Valid_To"] > day))
+        return history[valid].reset_index(drop=True)
+
+    def snapshots(self) -> list[str]:
+        """Dates (YYYY-MM-DD) des rafraîchissements enregistrés dans l'historique."""
+        try:
+            with open(SNAPSHOTS_FILE, "r") as f:
+                return [line.strip() for line in f if line.strip()]
+        except OSError:
+            return []
+
+    @perf.timed("EphyFetcher")
+    def produits_as_of(self, date, n_amm: str | None = None) -> pd.DataFrame:
+        """
+        Produits tels que connus à une date (état AMM, DAR, dose...), ex: pour un contrôle
+        portant sur un traitement passé. Vide avant le premier snapshot enregistré.
+        """
+        return self._history_as_of(HISTORY_PRODUITS_FILE, date, n_amm)
+
+    @perf.timed("EphyFetcher")
+    def usages_as_of(self, date, n_amm: str | None = None) -> pd.DataFrame:
+        """Usages (dose max, DAR, nb applications...) tels que connus à une date."""
+        return self._history_as_of(HISTORY_USAGES_FILE, date, n_amm)
+
+    @perf.timed("EphyFetcher")
+    def changelog(self, date_from, date_to=None) -> pd.DataFrame:
+        """
+        Différences entre les états connus à date_from et à date_to (défaut : aujourd'hui).
+        Une ligne par champ modifié : Table, N_AMM, Nom_Produit, Usage, Changement
+        (Nouveau / Supprimé / Retrait AMM / Modification), Champ, Avant, Apres, Date_Constat.
+        """
+        cols = ["Table", "N_AMM", "Nom_Produit", "Usage", "Changement", "Champ", "Avant", "Apres", "Date_Constat"]
+        date_to = date_to or datetime.now()
+        changes = []
+        for table, path in (("Produit", HISTORY_PRODUITS_FILE), ("Usage", HISTORY_USAGES_FILE)):
+            before = self._history_as_of(path, date_from)
+            after = self._history_as_of(path, date_to)
+            if before.empty and after.empty:
+                continue
+            merged = before.merge(after, on="Key", how="outer", suffixes=("_avant", "_apres"), indicator=True)
+            merged = merged[(merged["_merge"] != "both") | (merged["Row_Hash_avant"] != merged["Row_Hash_apres"])]
+            if merged.empty:
+                continue
+
+            def side(col):
+                return merged[f"{col}_apres"].fillna(merged[f"{col}_avant"]) if f"{col}_apres" in merged else None
+
+            base = pd.DataFrame({
+                "Table":        table,
+                "N_AMM":        side("N_AMM"),
+                "Nom_Produit":  side("Nom_Produit"),
+                "Usage":        side("Type_Cible") if table == "Usage" else "",
+                "Date_Constat": merged["Valid_From_apres"].fillna(merged["Valid_To_avant"]),
+            })
+            added = merged["_merge"] == "right_only"
+            removed = merged["_merge"] == "left_only"
+            changes.append(base[added].assign(Changement="Nouveau", Champ="", Avant="", Apres=""))
+            changes.append(base[removed].assign(Changement="Supprimé", Champ="", Avant="", Apres=""))
+
+            both = merged["_merge"] == "both"
+            fields = [c[:-len("_avant")] for c in merged.columns
+                      if c.endswith("_avant") and c[:-len("_avant")] not in ("Row_Hash", "Valid_From", "Valid_To")]
+            for field in fields:
+                diff = both & (merged[f"{field}_avant"] != merged[f"{field}_apres"])
+                if not diff.any():
+                    continue
+                retrait = (field == "Etat_AMM") & merged[f"{field}_apres"].str.upper().str.contains("RETIR", regex=False)
+                changes.append(base[diff].assign(
+                    Changement=np.where(retrait[diff], "Retrait AMM", "Modification"),
+                    Champ=field,
+                    Avant=merged.loc[diff, f"{field}_avant"],
+                    Apres=merged.loc[diff, f"{field}_apres"],
+                ))
+        if not changes:
+            return pd.DataFrame(columns=cols)
+        return pd.concat(changes, ignore_index=True)[cols].sort_values(
+            ["Date_Constat", "Table", "N_AMM"], kind="stable").reset_index(drop=True)
 
     # ------------------------------------------------------------------
-    # 5. UTILITAIRES
+    # 7. UTILITAIRES
     # ------------------------------------------------------------------
 
     @staticmethod
@@ -617,6 +1796,14 @@ class EphyFetcher:
         v = str(v).strip()
         return v if v not in ("", "nan", "NaN", "None") else None
 
+    @staticmethod
+    def _normalize_nom(nom: str) -> str:
+        """Forme de comparaison des noms : majuscules, sans accents, espaces simples."""
+        if not nom:
+            return ""
+        nom = unicodedata.normalize("NFKD", str(nom)).encode("ascii", errors="ignore").decode("ascii")
+        return " ".join(nom.upper().split())
+
     @staticmethod
     def _parse_date(val) -> str | None:
         if not val:
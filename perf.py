@@ -0,0 +1,106 @@
+"""
+perf.py
+=======
+Instrumentation des reruns Streamlit (mode debug : ?debug=1 ou secret DEBUG_PERF)
+
+Fournit :
+- perf.timed(categorie)       → décorateur : durée de chaque appel (DataLoader, EphyFetcher, ReportGenerator...)
+- perf.start_run(actif)       → début de rerun : active / désactive la collecte pour le thread du script
+- perf.summary()              → appels du rerun agrégés par (catégorie, nom) : nb, total, max
+- perf.start_profile() / perf.stop_profile() → capture cProfile d'un rerun, au format .prof (pstats)
+
+Collecte par thread (chaque session Streamlit exécute son script dans son propre
+thread). Hors mode debug, un appel décoré ne coûte qu'une lecture d'attribut.
+Les durées sont inclusives : un appel imbriqué compte aussi dans son appelant.
+"""
+
+import time
+import marshal
+import cProfile
+import functools
+import threading
+
+_local = threading.local()
+
+
+# ===================================================================
+# COLLECTE
+# ===================================================================
+
+def start_run(enabled: bool):
+    """Début d'un rerun : remet la collecte à zéro (enabled) ou la coupe."""
+    _local.records = [] if enabled else None
+    _local.started = time.perf_counter()
+
+
+def enabled() -> bool:
+    return getattr(_local, "records", None) is not None
+
+
+def elapsed() -> float:
+    """Secondes écoulées depuis start_run()."""
+    return time.perf_counter() - getattr(_local, "started", time.perf_counter())
+
+
+def record(category: str, name: str, seconds: float):
+    records = getattr(_local, "records", None)
+    if records is not None:
+        records.append((category, name, seconds))
+
+
+def timed(category: str, detail_arg: int | None = None):
+    """
+    Décorateur de mesure. detail_arg : position d'un argument ajouté au nom
+    (ex. 1 pour la feuille de DataLoader._get_data(self, sheet_name)).
+    """
+    def decorator(func):
+        name = func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            records = getattr(_local, "records", None)
+            if records is None:
+                return func(*args, **kwargs)
+            label = name
+            if detail_arg is not None and len(args) > detail_arg:
+                label = f"{name}({args[detail_arg]})"
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                records.append((category, label, time.perf_counter() - start))
+        return wrapper
+    return decorator
+
+
+def summary() -> list[dict]:
+    """Appels du rerun courant agrégés par (catégorie, nom), du plus coûteux au moins coûteux."""
+    agg = {}
+    for category, name, seconds in getattr(_local, "records", None) or []:
+        entry = agg.setdefault((category, name), {"Catégorie": category, "Appel": name, "Nb": 0, "Total_ms": 0.0, "Max_ms": 0.0})
+        entry["Nb"] += 1
+        entry["Total_ms"] += seconds * 1000
+        entry["Max_ms"] = max(entry["Max_ms"], seconds * 1000)
+    return sorted(agg.values(), key=lambda e: e["Total_ms"], reverse=True)
+
+
+# ===================================================================
+# PROFILAGE
+# ===================================================================
+
+def start_profile():
+    """Démarre une capture cProfile sur le thread courant (jusqu'à stop_profile())."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    _local.profiler = profiler
+
+
+def stop_profile() -> bytes | None:
+    """Arrête la capture en cours et la renvoie au format .prof (lisible par pstats / snakeviz)."""
+    profiler = getattr(_local, "profiler", None)
+    if profiler is None:
+        return None
+    profiler.disable()
+    _local.profiler = None
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
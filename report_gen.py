@@ -1,12 +1,47 @@
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4, landscape
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm
 from reportlab.graphics.shapes import Drawing, Rect
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import io
 import os
+import logging
+import zipfile
 import pandas as pd
+import perf
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def find_logo_path():
+    """Looks for logo.png/jpg/jpeg (case insensitive) next to this module, then in the cwd. Scanned once per process."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+    search_dirs = [base_dir, cwd]
+    
+    logo_path = None
+    
+    # Robust case-insensitive search
+    for d in search_dirs:
+        if not os.path.exists(d): continue
+        try:
+            # Scan directory for any file matching 'logo.*' (case insensitive)
+            for entry in os.scandir(d):
+                if entry.is_file():
+                    fname_lower = entry.name.lower()
+                    if fname_lower in ['logo.png', 'logo.jpg', 'logo.jpeg']:
+                        logo_path = entry.path
+                        break
+            if logo_path: break
+        except Exception as e:
+            logger.warning(f"Error scanning directory {d}: {e}")
+        
+    logger.debug(f"Logo search paths: {search_dirs}. Found: {logo_path}")
+    return logo_path
 
 class ReportGenerator:
     def __init__(self, filename):
@@ -17,44 +52,30 @@ class ReportGenerator:
         self.styles = getSampleStyleSheet()
         
         # --- LOGO INTEGRATION ---
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        cwd = os.getcwd()
-        search_dirs = [base_dir, cwd]
-        
-        logo_path = None
-        
-        # Robust case-insensitive search
-        for d in search_dirs:
-            if not os.path.exists(d): continue
-            try:
-                # Scan directory for any file matching 'logo.*' (case insensitive)
-                for entry in os.scandir(d):
-                    if entry.is_file():
-                        fname_lower = entry.name.lower()
-                        if fname_lower in ['logo.png', 'logo.jpg', 'logo.jpeg']:
-                            logo_path = entry.path
-                            break
-                if logo_path: break
-            except Exception as e:
-                print(f"Error scanning directory {d}: {e}")
-            
-        print(f"Logo search paths: {search_dirs}. Found: {logo_path}")
+        self.logo_path = find_logo_path()
+        self.elements.extend(self._logo_elements())
         
-        if logo_path:
-            try:
-                # Add Logo (Make it larger, e.g. Width 7cm instead of 5cm)
-                im = Image(logo_path)
-                desired_width = 7 * cm
-                aspect = im.imageHeight / im.imageWidth
-                im.drawWidth = desired_width
-                im.drawHeight = desired_width * aspect
-                im.hAlign = 'LEFT'
-                self.elements.append(im)
-                self.elements.append(Spacer(1, 10)) # Reduced space after logo so title isn't pushed too far down
-            except Exception as e:
-                print(f"Warning: Could not load logo: {e}")
+    def _logo_elements(self):
+        """Logo flowables (new objects on each call, so the logo can head every page of a batch)."""
+        if not self.logo_path:
+            return []
+        try:
+            # Add Logo (Make it larger, e.g. Width 7cm instead of 5cm)
+            im = Image(self.logo_path)
+            desired_width = 7 * cm
+            aspect = im.imageHeight / im.imageWidth
+            im.drawWidth = desired_width
+            im.drawHeight = desired_width * aspect
+            im.hAlign = 'LEFT'
+            return [im, Spacer(1, 10)] # Reduced space after logo so title isn't pushed too far down
+        except Exception as e:
+            logger.warning(f"Could not load logo {self.logo_path}: {e}")
+            return []
         
     def add_title(self, text):
+        self.elements.append(self._title(text))
+
+    def _title(self, text):
         title_style = ParagraphStyle(
             'CustomTitle',
             parent=self.styles['Heading1'],
@@ -62,12 +83,13 @@ class ReportGenerator:
             spaceAfter=30,
             alignment=1 # Center
         )
-        self.elements.append(Paragraph(text, title_style))
+        return Paragraph(text, title_style)
 
     def add_paragraph(self, text, style_name='Normal'):
         self.elements.append(Paragraph(text, self.styles[style_name]))
         self.elements.append(Spacer(1, 12))
 
+    @perf.timed("ReportGenerator")
     def generate_phyto_register(self, campaign, data_grouped):
         """
         Generates the Phyto Register.
@@ -144,6 +166,7 @@ class ReportGenerator:
         self.doc.build(self.elements)
         print(f"PDF Generated: {self.filename}")
 
+    @perf.timed("ReportGenerator")
     def generate_ferti_balance(self, campaign, data_grouped):
         """
         Generates the Fertilization Balance.
@@ -271,6 +294,7 @@ class ReportGenerator:
         self.doc.build(self.elements)
         print(f"PDF Generated: {self.filename}")
 
+    @perf.timed("ReportGenerator")
     def generate_itk(self, campaign, data_grouped):
         """
         Generates the Itinéraire Technique (ITK) Report.
@@ -495,6 +519,7 @@ class ReportGenerator:
         print(f"PDF Generated: {self.filename}")
 
 
+    @perf.timed("ReportGenerator")
     def generate_prep_sheet(self, campaign, intervention_data, base_url="https://share.streamlit.io"):
         """
         Generates the Phyto Preparation Sheet (Fiche de Préparation de Bouillie).
@@ -508,6 +533,35 @@ class ReportGenerator:
         base_url: str (Base URL of the Streamlit App for QR link)
         """
         self.doc.pagesize = A4 # Portrait
+        self.elements.extend(self._prep_sheet_elements(intervention_data, base_url))
+        
+        self.doc.build(self.elements)
+        print(f"PDF Generated: {self.filename}")
+
+    @perf.timed("ReportGenerator")
+    def generate_prep_sheets(self, campaign, interventions, base_url="https://share.streamlit.io", max_workers=4):
+        """
+        Generates several Preparation Sheets in one PDF, one page per mix, in the given order.
+        interventions: list of intervention_data dicts (see generate_prep_sheet).
+        Flowables (tables, QR codes) are built in parallel; the document is laid out once.
+        """
+        self.doc.pagesize = A4 # Portrait
+        
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prep-sheet") as pool:
+            sheets = list(pool.map(lambda data: self._prep_sheet_elements(data, base_url), interventions))
+        
+        for idx, sheet in enumerate(sheets):
+            if idx > 0:
+                self.elements.append(PageBreak())
+                self.elements.extend(self._logo_elements())
+            self.elements.extend(sheet)
+        
+        self.doc.build(self.elements)
+        print(f"PDF Generated: {self.filename} ({len(sheets)} fiches)")
+
+    def _prep_sheet_elements(self, intervention_data, base_url):
+        """Flowables of one Preparation Sheet (without the logo)."""
+        elements = []
         
         # --- Header ---
         parcelles_info = intervention_data.get('Parcelles', [])
@@ -523,7 +577,7 @@ class ReportGenerator:
         else:
             date_str = str(date_prevue) if date_prevue else "Non définie"
         
-        self.add_title(f"Fiche de Préparation Phyto - {date_str}")
+        elements.append(self._title(f"Fiche de Préparation Phyto - {date_str}"))
         
         # --- Parcelle Info & Volume ---
         vol_ha = float(intervention_data.get('Volume_Bouillie_Ha', 100)) # Default 100L/ha if missing
@@ -550,8 +604,8 @@ class ReportGenerator:
             ('BOTTOMPADDING', (0,0), (-1,-1), 10),
             ('TOPPADDING', (0,0), (-1,-1), 10),
         ]))
-        self.elements.append(t_header)
-        self.elements.append(Spacer(1, 10))
+        elements.append(t_header)
+        elements.append(Spacer(1, 10))
         
         # --- Détail Parcelles (if > 1) ---
         if len(parcelles_info) > 1:
@@ -566,20 +620,20 @@ class ReportGenerator:
                   ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
                   ('GRID', (0,0), (-1,-1), 0.5, colors.grey),
              ]))
-             self.elements.append(t_detail)
-             self.elements.append(Spacer(1, 15))
+             elements.append(t_detail)
+             elements.append(Spacer(1, 15))
         
         # --- Sécurité (EPI) ---
         # Text based icons for robustness
         epi_text = "⚠️ SÉCURITÉ / EPI OBLIGATOIRES ⚠️"
         epi_details = "🧤 Gants Nitrile   😷 Masque (A2P3)   🥽 Lunettes   🥼 Combinaison"
         
-        self.elements.append(Paragraph(epi_text, self.styles['Heading2']))
-        self.elements.append(Paragraph(epi_details, ParagraphStyle('EPI', parent=self.styles['Normal'], fontSize=12, alignment=1, textColor=colors.red)))
-        self.elements.append(Spacer(1, 15))
+        elements.append(Paragraph(epi_text, self.styles['Heading2']))
+        elements.append(Paragraph(epi_details, ParagraphStyle('EPI', parent=self.styles['Normal'], fontSize=12, alignment=1, textColor=colors.red)))
+        elements.append(Spacer(1, 15))
         
         # --- Checklist Produits (Mixing Order) ---
-        self.elements.append(Paragraph("<b>🛠️ ORDRE D'INCORPORATION & DOSAGES</b>", self.styles['Heading3']))
+        elements.append(Paragraph("<b>🛠️ ORDRE D'INCORPORATION & DOSAGES</b>", self.styles['Heading3']))
         
         # Columns: [ ] Check, Ordre, Produit, Formulation, Dose/ha, Qté Totale
         table_data = [['OK', 'Ordre', 'Produit', 'Formulation', 'Dose/ha', 'Qté TOTALE']]
@@ -623,8 +677,8 @@ class ReportGenerator:
             # Bold Total Quantity
             ('FONTNAME', (-1,1), (-1,-1), 'Helvetica-Bold'),
         ]))
-        self.elements.append(t_prods)
-        self.elements.append(Spacer(1, 25))
+        elements.append(t_prods)
+        elements.append(Spacer(1, 25))
         
         # --- QR Code & Validation ---
         import qrcode
@@ -652,12 +706,12 @@ class ReportGenerator:
         
         # Draw QR
         im = Image(img_buffer, width=4*cm, height=4*cm)
-        self.elements.append(im)
-        self.elements.append(Paragraph(f"Scan pour valider : {intervention_id}", self.styles['Normal']))
+        elements.append(im)
+        elements.append(Paragraph(f"Scan pour valider : {intervention_id}", self.styles['Normal']))
         
-        self.doc.build(self.elements)
-        print(f"PDF Generated: {self.filename}")
+        return elements
 
+    @perf.timed("ReportGenerator")
     def generate_irrigation_report(self, campaign, network_type, data):
         """
         Generates the Irrigation Consumption Report.
@@ -788,6 +842,7 @@ class ReportGenerator:
         self.doc.build(self.elements)
         print(f"Irrigation PDF Generated: {self.filename}")
 
+    @perf.timed("ReportGenerator")
     def generate_monthly_network_report(self, campaign, month_name, network_type, data):
         """
         Generates a summary report for a specific month and network.
@@ -842,6 +897,7 @@ class ReportGenerator:
         self.doc.build(self.elements)
         print(f"Monthly Irrigation PDF Generated: {self.filename}")
 
+    @perf.timed("ReportGenerator")
     def generate_global_irrigation_summary(self, campaign_summaries):
         """
         Generates a summary report containing tables for multiple campaigns.
@@ -920,6 +976,7 @@ class ReportGenerator:
         self.doc.build(self.elements)
         print(f"Global Irrigation Summary PDF Generated: {self.filename}")
 
+    @perf.timed("ReportGenerator")
     def generate_maintenance_log(self, materiel_info, history):
         """
         Generates the Maintenance Log for a specific equipment.
@@ -1032,6 +1089,7 @@ class ReportGenerator:
         self.doc.build(self.elements)
         print(f"Maintenance Log PDF Generated: {self.filename}")
 
+    @perf.timed("ReportGenerator")
     def generate_irrigation_parcel_report(self, campaign, data_grouped):
         """
         Generates the Parcel Irrigation Report (mm/ha).
@@ -1059,7 +1117,7 @@ class ReportGenerator:
                 im.hAlign = 'RIGHT' # Aligné à droite de sa propre cellule
                 logo_element = im
             except Exception as e:
-                print(f"Warning: Could not load LOGO_IRRI.png: {e}")
+                logger.warning(f"Could not load LOGO_IRRI.png: {e}")
                 
         # Create a title string format
         title_para = Paragraph(f"Bilan Irrigation Parcelle - Campagne {campaign}", self.styles['Heading1'])
@@ -1174,3 +1232,32 @@ class ReportGenerator:
 
         self.doc.build(self.elements)
         print(f"Parcel Irrigation PDF Generated: {self.filename}")
+
+
+def generate_prep_sheets_zip(campaign, interventions, base_url="https://share.streamlit.io", max_workers=4):
+    """
+    Renders each Preparation Sheet to its own PDF (in parallel) and returns them as ZIP bytes.
+    interventions: list of intervention_data dicts (see ReportGenerator.generate_prep_sheet).
+    Files are named after Intervention_ID (else the date); duplicates get a _2, _3... suffix.
+    """
+    def render(data):
+        buffer = io.BytesIO()
+        ReportGenerator(buffer).generate_prep_sheet(campaign, data, base_url=base_url)
+        date = data.get('Date')
+        stem = data.get('Intervention_ID') or (date.strftime('%Y%m%d') if hasattr(date, 'strftime') else 'sans_date')
+        return f"Fiche_Prep_{stem}".replace('|', '-').replace('/', '-'), buffer.getvalue()
+    
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prep-sheet") as pool:
+        pdfs = list(pool.map(render, interventions))
+    
+    zip_buffer = io.BytesIO()
+    names = set()
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for stem, content in pdfs:
+            fname, n = f"{stem}.pdf", 1
+            while fname in names:
+                n += 1
+                fname = f"{stem}_{n}.pdf"
+            names.add(fname)
+            zf.writestr(fname, content)
+    return zip_buffer.getvalue()
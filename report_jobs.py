@@ -0,0 +1,140 @@
+"""
+report_jobs.py
+==============
+File de travaux de génération de rapports PDF (ITK, Phyto, Ferti, Irrigation)
+exécutés hors du script Streamlit, par un pool de threads partagé par le process.
+
+Fournit :
+- ReportJobQueue.submit(...)   → ID du travail ; la génération (un PDF par parcelle) tourne en arrière-plan
+- ReportJobQueue.status(id)    → état, progression par parcelle, erreur éventuelle
+- ReportJobQueue.artifact(id)  → (nom de fichier, octets, type MIME) une fois terminé : PDF seul ou ZIP
+
+Le script Streamlit ne fait que soumettre et relire l'état : l'interface reste
+réactive pendant la génération, plusieurs utilisateurs ne se bloquent pas, et
+un travail survit à un rechargement de la page (son ID est conservé dans l'URL).
+"""
+
+import io
+import time
+import uuid
+import zipfile
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from report_gen import ReportGenerator
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# Constantes
+# ---------------------------------------------------------------------------
+MAX_WORKERS = 2          # rapports générés simultanément (reportlab est lié au GIL)
+JOB_TTL_SECONDS = 3600   # durée de conservation d'un travail terminé (artefact en mémoire)
+
+PENDING = "En attente"
+RUNNING = "En cours"
+DONE = "Terminé"
+FAILED = "Erreur"
+
+
+class ReportJobQueue:
+    def __init__(self, max_workers: int = MAX_WORKERS, ttl: int = JOB_TTL_SECONDS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report-job")
+        self._lock = threading.Lock()
+        self._jobs: dict[str, dict] = {}
+        self._ttl = ttl
+
+    # ===================================================================
+    # SOUMISSION
+    # ===================================================================
+
+    def submit(self, label: str, campaign, grouped_data: dict, method_name: str, prefix: str) -> str:
+        """
+        Soumet la génération d'un rapport : un PDF par parcelle de grouped_data via
+        ReportGenerator.<method_name>(campaign, {parcelle: payload}).
+        Retourne l'ID du travail.
+        """
+        self._purge()
+        job_id = uuid.uuid4().hex[:10]
+        with self._lock:
+            self._jobs[job_id] = {
+                "id": job_id,
+                "label": label,
+                "status": PENDING,
+                "done": 0,
+                "total": len(grouped_data),
+                "current": None,
+                "error": None,
+                "artifact": None,
+                "submitted": time.time(),
+                "finished": None,
+            }
+        self._pool.submit(self._run, job_id, campaign, grouped_data, method_name, prefix)
+        return job_id
+
+    def _run(self, job_id: str, campaign, grouped_data: dict, method_name: str, prefix: str):
+        self._update(job_id, status=RUNNING)
+        try:
+            files = []
+            for p_id, p_payload in grouped_data.items():
+                self._update(job_id, current=p_id)
+                safe_pid = str(p_id).replace(" ", "_").replace("/", "-")
+                buffer = io.BytesIO()
+                gen = ReportGenerator(buffer)
+                getattr(gen, method_name)(campaign, {p_id: p_payload})
+                files.append((f"{prefix}_{campaign}_{safe_pid}.pdf", buffer.getvalue()))
+                with self._lock:
+                    self._jobs[job_id]["done"] += 1
+
+            if len(files) == 1:
+                artifact = (files[0][0], files[0][1], "application/pdf")
+            else:
+                zip_buffer = io.BytesIO()
+                with zipfile.ZipFile(zip_buffer, "w") as zipf:
+                    for fname, content in files:
+                        zipf.writestr(fname, content)
+                artifact = (f"{prefix}_Campagne_{campaign}.zip", zip_buffer.getvalue(), "application/zip")
+
+            self._update(job_id, status=DONE, artifact=artifact, current=None, finished=time.time())
+        except Exception as e:
+            logger.error(f"Erreur génération rapport ({job_id}): {e}")
+            self._update(job_id, status=FAILED, error=str(e), finished=time.time())
+
+    # ===================================================================
+    # CONSULTATION
+    # ===================================================================
+
+    def status(self, job_id: str) -> dict | None:
+        """État d'un travail (copie, sans l'artefact) ; None si inconnu ou expiré."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {k: v for k, v in job.items() if k != "artifact"}
+
+    def artifact(self, job_id: str) -> tuple[str, bytes, str] | None:
+        """(nom de fichier, contenu, type MIME) d'un travail terminé ; None sinon."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job["artifact"] if job else None
+
+    def discard(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    # ===================================================================
+    # UTILITAIRES
+    # ===================================================================
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _purge(self):
+        """Oublie les travaux terminés depuis plus de ttl secondes (libère les artefacts)."""
+        limit = time.time() - self._ttl
+        with self._lock:
+            for job_id in [j for j, job in self._jobs.items() if job["finished"] and job["finished"] < limit]:
+                del self._jobs[job_id]